@@ -0,0 +1,432 @@
+import argparse
+import asyncio
+import datetime as dt
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+# Drives each conversation of the bot through fake Telegram updates against the Google Sheets
+# emulator and the SQLite store, and reports Sheets calls, bytes and wall time per command.
+# Usage: python benchmark.py [--latency 0.05] [--save results.json] [--baseline results.json]
+#        python benchmark.py --workers 1 2 4   (throughput of the sharded multi-worker mode)
+#        python benchmark.py --startup 5       (cold start time of a fresh process)
+#        python benchmark.py --quota 6000      (Sheets requests per minute, default the bot's quota)
+_tmp_dir = tempfile.mkdtemp(prefix='tele-tracker-bench-')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_DB'] = os.path.join(_tmp_dir, 'user-tele.db')
+os.environ['JOURNAL_DB'] = os.path.join(_tmp_dir, 'journal.db')
+os.environ['PERSISTENCE_DB'] = os.path.join(_tmp_dir, 'persistence.db')
+os.environ.setdefault('TRACKER_TELEGRAM_TOKEN', '1:benchmark')
+
+import bot.google_sheet as gs
+import bot.journal as journal
+import bot.row_tracker as rt
+import bot.storage as db
+import bot.summary as sm
+import bot.sharding as sharding
+import bot.sheets_quota as sheets_quota
+import bot.telegram_bot as tb
+from bot.fake_sheets import FakeSheetsService
+from telegram.request import HTTPXRequest
+
+SHEET_ID = 'benchmark-sheet'
+USER_ID = 1000
+MONTHS = [dt.date(2000, month, 1).strftime('%B') for month in range(1, 13)]
+
+# Dropdown tab of the template sheet
+DROPDOWN = {
+    'Dropdown!A2:A5': [['Transport'], ['Bus'], ['MRT'], ['Taxi']],
+    'Dropdown!B2:D5': [['Food', 'Shopping', 'Bills'], ['Breakfast', 'Clothes', 'Phone'], ['Lunch', 'Gifts', 'Internet'], ['Dinner', '', '']],
+    'Dropdown!A12:C15': [['Cash', 'Card', 'PayLah'], ['', 'Visa', ''], ['', 'Master', ''], ['', '', '']],
+    'Dropdown!L2:L3': [['Company'], ['Freelance']],
+    'Tracker!G3:J4': [['Card - Visa', 'Bus', 'Card - Visa', 'Food - Lunch'], ['', '', 'Cash', 'Shopping - Gifts']],
+}
+
+def _today():
+    return dt.datetime.now(tb.timezone)
+
+# Bank statement of 480 rows last month and 20 today, with a few lines of preamble above the header
+def _statement():
+    today = _today().date()
+    last_month = today - dt.timedelta(days=today.day)
+    lines = ['Account Statement', 'Card 1234', '', 'Transaction Date,Description,Debit Amount,Credit Amount']
+    for index in range(500):
+        date = today if index >= 480 else last_month.replace(day=index % 28 + 1)
+        description = f'GRAB RIDE {index}' if index % 5 == 0 else f'Merchant {index}'
+        lines.append(f'{date.strftime("%d/%m/%Y")},{description},{index % 40 + 1}.{index % 100:02d},')
+    lines.append(f'{today.strftime("%d/%m/%Y")},Salary,,5000.00')
+    return '\n'.join(lines).encode()
+
+SCENARIOS = {
+    'start': [('command', 'start', '/start'), ('button', 'reset_up', 'No')],
+    'addentry_others': [
+        ('command', 'add_entry', '/addentry'), ('button', 'entry', 'Others'), ('text', 'price', '12.50'),
+        ('text', 'remarks', 'Lunch with team'), ('button', 'category', 'Food'), ('button', 'subcategory', 'Lunch'),
+        ('button', 'payment', 'Card'), ('button', 'subpayment', 'Visa'),
+    ],
+    'addentry_transport': [
+        ('command', 'add_entry', '/addentry'), ('button', 'entry', 'Transport'), ('text', 'price', '2.10'),
+        ('text', 'remarks', 'Home, Work'), ('button', 'category', 'Bus'), ('button', 'payment', 'Card'),
+        ('button', 'subpayment', 'Visa'),
+    ],
+    'addtransport': [('command', 'add_transport', '/addtransport'), ('text', 'quick_add', '2.11, Home, Work')],
+    'addothers': [
+        ('command', 'add_others', '/addothers'), ('button', 'quick_add_category', 'Card - Visa, Food - Lunch'),
+        ('text', 'quick_add', '19.99, New shirt'),
+    ],
+    'retrievetransaction': [
+        ('command', 'retrieve_transaction', '/retrievetransaction'),
+        ('text', 'handle_retrieve_transaction', lambda: _today().strftime('%d %b').lstrip('0')),
+    ],
+    'addincome': [
+        ('command', 'add_income', '/addincome'), ('text', 'income', '2000, Salary'),
+        ('button', 'work_place', 'Company'), ('button', 'cpf', 'No'),
+    ],
+    'config_quick_transport': [
+        ('command', 'config', '/config'), ('button', 'config_handler', 'Configure Quick Transport'),
+        ('button', 'config_setup', 'No'),
+    ],
+    'refresh': [('command', 'refresh', '/refresh')],
+    'summary': [('command', 'summary', '/summary')],
+    'export_month': [('command', 'export', '/export')],
+    'import_statement_500': [
+        ('command', 'import_rule', '/importrule grab = Taxi, Card - Visa'),
+        ('command', 'import_rule', '/importrule * = Food - Lunch, Card - Visa'),
+        ('document', 'import_statement', _statement),
+    ],
+    'bulkadd_10': [('command', 'bulk_add', '/bulkadd\n' + '\n'.join(
+        [f'{index}.50, Item {index}, Food - Lunch, Card - Visa' for index in range(1, 9)] + ['2.10, Home, Work, Bus, Cash'] * 2))],
+}
+
+# Minimal stand-ins for the Telegram objects the handlers use
+_update_ids = itertools.count(1)
+
+class FakeChat:
+    def __init__(self, user_id):
+        self.user = SimpleNamespace(id=user_id)
+        self.replies = []
+        self.documents = []
+
+    def reply(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+        return FakeMessage(self, text)
+
+    # callback data of the button with this label in the latest keyboard
+    def button_data(self, label):
+        for _, markup in reversed(self.replies):
+            if markup is None:
+                continue
+            for row in markup.inline_keyboard:
+                for button in row:
+                    if button.text == label:
+                        return button.callback_data
+            break
+        raise LookupError(f'No button {label!r} in the last keyboard, replies: {self.replies[-3:]}')
+
+    def update(self, message=None, callback_query=None):
+        return SimpleNamespace(update_id=next(_update_ids), effective_user=self.user,
+                               effective_chat=SimpleNamespace(id=self.user.id), message=message, callback_query=callback_query)
+
+class FakeMessage:
+    def __init__(self, chat, text=None, document=None):
+        self.chat = chat
+        self.text = text
+        self.document = document
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        return self.chat.reply(text, reply_markup)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        return self.chat.reply(text, reply_markup)
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        self.chat.documents.append((filename, document))
+        return self.chat.reply(f'document {filename}')
+
+class FakeDocument:
+    def __init__(self, content):
+        self.content = content
+        self.file_size = len(content)
+
+    async def get_file(self):
+        return self
+
+    async def download_to_memory(self, out):
+        out.write(self.content)
+
+class FakeCallbackQuery:
+    def __init__(self, chat, data):
+        self.chat = chat
+        self.data = data
+        self.message = FakeMessage(chat)
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        return self.chat.reply(text, reply_markup)
+
+    async def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        return self.chat.reply(None, reply_markup)
+
+class FakeContext:
+    def __init__(self):
+        self.user_data = {}
+        self.chat_data = {}
+        self.bot_data = {}
+        self.args = []
+
+def seed(service, sheet_id=SHEET_ID, user_id=USER_ID):
+    service.create_spreadsheet(sheet_id, ['Dropdown', 'Tracker'] + MONTHS)
+    for range_name, values in DROPDOWN.items():
+        service.set_values(sheet_id, range_name, values)
+    # a new user, first entry of the day goes to row 5
+    service.set_values(sheet_id, 'Tracker!B3:E3', [[gs.date_tracker(_today()), 4, 4, 5]])
+    db.new_user_setup(user_id, sheet_id)
+
+def clear_caches():
+    gs.dropdown_cache.clear()
+    rt.day_index.clear()
+    sm.summary_cache.clear()
+    db.backend.sheet_id_cache.clear()
+
+async def run_steps(chat, context, steps):
+    for kind, handler, value in steps:
+        value = value() if callable(value) else value
+        if kind == 'button':
+            update = chat.update(callback_query=FakeCallbackQuery(chat, chat.button_data(value)))
+        elif kind == 'document':
+            update = chat.update(message=FakeMessage(chat, document=FakeDocument(value)))
+        else:
+            context.args = value.split()[1:] if kind == 'command' else context.args
+            update = chat.update(message=FakeMessage(chat, value))
+        await getattr(tb, handler)(update, context)
+
+async def measure(service, name, steps):
+    chat = FakeChat(USER_ID)
+    context = FakeContext()
+    service.reset_stats()
+    throttled_before = _throttled()
+    started_at = time.perf_counter()
+    await run_steps(chat, context, steps)
+    wall_ms = (time.perf_counter() - started_at) * 1000
+    # background writes are part of the cost of a command
+    await journal.flush_pending()
+    return {
+        'calls': sum(service.calls.values()),
+        'by_method': dict(service.calls),
+        'bytes': service.bytes_sent + service.bytes_received,
+        'throttled': _throttled() - throttled_before,
+        'wall_ms': round(wall_ms, 1),
+    }
+
+# Sheets requests that waited for quota so far
+def _throttled():
+    return sheets_quota.stats['read_throttled'] + sheets_quota.stats['write_throttled']
+
+# N entries logged at the same time on one sheet must land on N distinct rows
+async def check_concurrent_entries(service, count):
+    first_row = db.get_trackers(SHEET_ID)[1] + 1
+    user_datas = [{'sheet_id': SHEET_ID, 'entry_type': tb.EntryType.OTHERS, 'price': str(index + 1),
+                   'remarks': f'concurrent {index}', 'category': 'Food - Lunch', 'payment': 'Cash'} for index in range(count)]
+    chat = FakeChat(USER_ID + 1)
+    await asyncio.gather(*(tb.log_transaction(user_data, chat.update(message=FakeMessage(chat))) for user_data in user_datas))
+    await journal.flush_pending()
+    month = _today().strftime('%B')
+    rows = service.get_values(SHEET_ID, f'{month}!H{first_row}:K{first_row + count + 1}')
+    remarks = [row[1] for row in rows if len(row) > 1 and row[1].startswith('concurrent')]
+    return len(remarks) == count and len(set(remarks)) == count
+
+# Bot API of the scaling check, answers every request the router and workers make. getUpdates hands out
+# the updates once every worker is up, the replies to /bulkadd are counted as updates served
+class FakeBotApi:
+    def __init__(self, updates, count):
+        self.updates = updates
+        self.count = count
+        self.ready = multiprocessing.Value('i', 0)
+        self.served = multiprocessing.Value('i', 0)
+        self.started_at = self.finished_at = None
+
+    async def do_request(self, request, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            if sharding.worker_name:
+                with self.ready.get_lock():
+                    self.ready.value += 1
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif endpoint == 'getUpdates':
+            result = await self.get_updates()
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            if 'transactions logged' in parameters.get('text', ''):
+                with self.served.get_lock():
+                    self.served.value += 1
+            result = {'message_id': 1, 'date': 0, 'chat': {'id': parameters.get('chat_id', 0), 'type': 'private'},
+                      'text': parameters.get('text', '')}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    # Runs in the router, which is stopped like the real one once every update is served
+    async def get_updates(self):
+        await asyncio.sleep(0.01)
+        if self.started_at is None and self.ready.value >= self.count:
+            self.started_at = time.perf_counter()
+            return self.updates
+        if self.started_at is not None and self.finished_at is None and self.served.value >= len(self.updates):
+            self.finished_at = time.perf_counter()
+            os.kill(os.getpid(), signal.SIGTERM)
+        return []
+
+# A /bulkadd of one bus ride from user_id, one transaction per update
+def _bulk_update(update_id, user_id):
+    text = '/bulkadd 2.10, Home, Work, Bus, Cash'
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': user,
+        'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len('/bulkadd')}]}}
+
+# Updates per second of the sharded mode, run through the real router and workers in polling mode with the
+# Bot API faked. The workers are forked from this process, so they start with the emulator seeded here.
+# Quota is per process, set it with --quota so that the workers rather than the quota are measured
+def check_scaling(worker_counts, users, updates_per_user, latency):
+    service = FakeSheetsService(latency=latency)
+    for user_id in range(USER_ID, USER_ID + users):
+        seed(service, f'sheet-{user_id}', user_id)
+    gs.set_sheets_api(service)
+    updates = [_bulk_update(index + 1, USER_ID + index % users) for index in range(users * updates_per_user)]
+    throughput = {}
+    for count in worker_counts:
+        api = FakeBotApi(updates, count)
+        HTTPXRequest.do_request = lambda request, *args, **kwargs: api.do_request(request, *args, **kwargs)
+        asyncio.run(sharding.run_router('1:benchmark', count, 'polling'))
+        if api.finished_at is None:
+            print(f'{count} workers: stopped after {api.served.value} of {len(updates)} updates')
+            return throughput
+        throughput[count] = len(updates) / (api.finished_at - api.started_at)
+        print(f'{count} workers: {throughput[count]:8.1f} updates/s')
+    base = throughput[worker_counts[0]]
+    for count in worker_counts[1:]:
+        print(f'{count} workers vs {worker_counts[0]}: {throughput[count] / base:.2f}x')
+    return throughput
+
+# Run in a fresh interpreter, prints the milliseconds taken by each startup step. The Sheets client is
+# built from the bundled discovery document with anonymous credentials, as the real ones may be missing
+STARTUP_SCRIPT = '''
+import json, time
+started_at = time.perf_counter()
+steps = {}
+def step(name):
+    global started_at
+    now = time.perf_counter()
+    steps[name] = (now - started_at) * 1000
+    started_at = now
+import bot.telegram_bot as tb
+step('import bot')
+tb.build_application()
+step('build application')
+from google.auth.credentials import AnonymousCredentials
+import bot.google_sheet as gs
+gs.build_sheets_api(AnonymousCredentials())
+step('build sheets client')
+print(json.dumps(steps))
+'''
+
+# Median time of each startup step over runs fresh processes
+def check_startup(runs):
+    env = {**os.environ, 'TRACKER_TELEGRAM_TOKEN': os.getenv('TRACKER_TELEGRAM_TOKEN') or '123:benchmark'}
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output))
+    for name in samples[0]:
+        print(f'{name:<26}{statistics.median(sample[name] for sample in samples):8.1f} ms')
+    print(f'{"total":<26}{statistics.median(sum(sample.values()) for sample in samples):8.1f} ms')
+
+def compare(results, baseline, tolerance, time_tolerance):
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        for phase in ('cold', 'warm'):
+            current, previous = result[phase], expected[phase]
+            if current['calls'] > previous['calls']:
+                failures.append(f'{name} ({phase}): {current["calls"]} Sheets calls, baseline {previous["calls"]}')
+            if current['bytes'] > previous['bytes'] * (1 + tolerance):
+                failures.append(f'{name} ({phase}): {current["bytes"]} bytes, baseline {previous["bytes"]}')
+            if time_tolerance is not None and current['wall_ms'] > previous['wall_ms'] * (1 + time_tolerance):
+                failures.append(f'{name} ({phase}): {current["wall_ms"]} ms, baseline {previous["wall_ms"]} ms')
+    return failures
+
+def print_report(results):
+    print(f'{"command":<26}{"cold calls":>11}{"warm calls":>11}{"warm bytes":>12}{"throttled":>10}{"warm ms":>10}  warm calls by method')
+    for name, result in results.items():
+        cold, warm = result['cold'], result['warm']
+        methods = ', '.join(f'{method}={count}' for method, count in sorted(warm['by_method'].items()))
+        print(f'{name:<26}{cold["calls"]:>11}{warm["calls"]:>11}{warm["bytes"]:>12}{warm["throttled"]:>10}{warm["wall_ms"]:>10}  {methods}')
+
+async def main(args):
+    service = FakeSheetsService(latency=args.latency)
+    gs.set_sheets_api(service)
+    seed(service)
+
+    results = {}
+    for name, steps in SCENARIOS.items():
+        if args.only and name not in args.only:
+            continue
+        clear_caches()
+        cold = await measure(service, name, steps)
+        warm = await measure(service, name, steps)
+        results[name] = {'cold': cold, 'warm': warm}
+    print_report(results)
+
+    failures = []
+    if not args.only:
+        concurrent_ok = await check_concurrent_entries(service, args.concurrency)
+        print(f'\n{args.concurrency} concurrent entries on one sheet written to distinct rows: {"yes" if concurrent_ok else "NO"}')
+        if not concurrent_ok:
+            failures.append('concurrent entries collided')
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            failures += compare(results, json.load(file), args.tolerance, args.time_tolerance)
+    for failure in failures:
+        print(f'REGRESSION: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-command Google Sheets call and latency benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of latency injected into every Sheets call')
+    parser.add_argument('--quota', type=int, default=None, help='Sheets read and write requests allowed per minute, default the bot\'s quota')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of simultaneous entries in the collision check')
+    parser.add_argument('--only', nargs='*', help='only run these scenarios')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='fail if calls or bytes regress against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative increase in bytes')
+    parser.add_argument('--time-tolerance', type=float, default=None, help='allowed relative increase in wall time')
+    parser.add_argument('--workers', type=int, nargs='*', help='measure throughput of the sharded mode with these worker counts')
+    parser.add_argument('--startup', type=int, metavar='RUNS', help='measure the cold start time over this many fresh processes')
+    parser.add_argument('--users', type=int, default=64, help='users in the sharding check')
+    parser.add_argument('--updates-per-user', type=int, default=10, help='entries per user in the sharding check')
+    args = parser.parse_args()
+    if args.quota:
+        sheets_quota.buckets = {sheets_quota.READ: sheets_quota.TokenBucket(args.quota), sheets_quota.WRITE: sheets_quota.TokenBucket(args.quota)}
+    if args.startup:
+        check_startup(args.startup)
+        sys.exit(0)
+    if args.workers:
+        check_scaling(args.workers, args.users, args.updates_per_user, args.latency)
+        sys.exit(0)
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,56 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bot.google_sheet as gs
+import bot.metrics as metrics
+import bot.sheets_quota as sheets_quota
+
+# Number of Google Sheets calls allowed to run at the same time
+MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "8"))
+# Seconds to wait for a single Google Sheets call before giving up. Retries that couldn't finish
+# within it are not started, calls that change the store pass timeout=None as an abandoned call
+# would keep running after the caller gave up
+CALL_TIMEOUT = float(os.getenv("SHEETS_CALL_TIMEOUT", "30"))
+
+# Threads of background work (journal flushes, rollover, provisioning). It waits for Sheets quota
+# behind interactive calls, on threads of its own so interactive calls never queue behind it
+BACKGROUND_WORKERS = int(os.getenv("SHEETS_BACKGROUND_WORKERS", "4"))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="sheets")
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="sheets-background")
+
+# Time spent on the executor thread, waiting for a free thread is not included
+def _timed_call(func, *args, **kwargs):
+    with metrics.timed('sheets_call', function=f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"):
+        return func(*args, **kwargs)
+
+# Run a blocking function on the sheets executor without blocking the event loop
+async def run(func, *args, timeout=CALL_TIMEOUT, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    if timeout is not None:
+        # the last attempt of a request has to start a full request timeout before the caller gives up
+        context.run(sheets_quota.deadline.set, time.monotonic() + timeout - gs.REQUEST_TIMEOUT)
+    call = functools.partial(context.run, _timed_call, func, *args, **kwargs)
+    background = sheets_quota.priority.get() == sheets_quota.BACKGROUND
+    future = loop.run_in_executor(background_executor if background else executor, call)
+    if timeout is None:
+        return await future
+    return await asyncio.wait_for(future, timeout)
+
+# Expose every function of bot.google_sheet as a coroutine, e.g. await ags.get_trackers(sheet_id)
+def __getattr__(name):
+    func = getattr(gs, name, None)
+    if not inspect.isfunction(func):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    globals()[name] = wrapper
+    return wrapper
@@ -0,0 +1,248 @@
+import csv
+import datetime as dt
+from collections import Counter, defaultdict
+import bot.google_sheet as gs
+import bot.row_tracker as rt
+import bot.summary as sm
+from bot.common import EntryType
+
+# Bank statement CSV import. Rows are parsed one at a time, given a category by the user's import
+# rules, checked against the entries already in the sheet and written in one batchUpdate
+IMPORT_MAX_BYTES = 5 * 1024 * 1024
+# Keyword of the rule used when no other rule matches
+DEFAULT_RULE = '*'
+DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%Y-%m-%d', '%d %b %Y', '%d %B %Y', '%d-%b-%Y', '%d %b %y', '%d-%b-%y')
+# Header names of the columns, the first name found wins
+COLUMN_NAMES = {
+    'date': ('transaction date', 'date'),
+    'description': ('description', 'transaction details', 'details', 'narrative', 'merchant', 'remarks', 'reference'),
+    'debit': ('debit', 'withdrawal'),
+    'amount': ('amount',),
+}
+
+def _cell(row, index):
+    return row[index].strip() if index is not None and index < len(row) else ''
+
+# Column of each field in a header row, None if it isn't the header
+def find_columns(header):
+    cells = [cell.strip().lower() for cell in header]
+    columns = {}
+    for field, names in COLUMN_NAMES.items():
+        for name in names:
+            matches = [index for index, cell in enumerate(cells) if name in cell]
+            if matches:
+                columns[field] = matches[0]
+                break
+    if 'date' in columns and 'description' in columns and ('debit' in columns or 'amount' in columns):
+        return columns
+    return None
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return dt.datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+# Spending in a statement as (date, amount, description). Lines above the header are skipped,
+# so are credits and lines that can't be read, which are counted in stats['skipped'].
+# With a single amount column every amount is taken as spending
+def iter_statement(lines, stats):
+    columns = None
+    for row in csv.reader(lines):
+        if columns is None:
+            columns = find_columns(row)
+            continue
+        if not any(cell.strip() for cell in row):
+            continue
+        date = parse_date(_cell(row, columns['date']))
+        amount = gs.parse_amount(_cell(row, columns.get('debit', columns.get('amount'))))
+        if date is None or not amount:
+            stats['skipped'] += 1
+            continue
+        yield date, abs(amount), ' '.join(_cell(row, columns['description']).split())
+    if columns is None:
+        raise ValueError('No Date, Description and Amount or Debit columns in the statement')
+
+# The rule with the longest keyword found in the description, else the default rule
+def match_rule(description, rules):
+    text = description.lower()
+    best = None
+    for rule in rules:
+        keyword = rule[0]
+        if keyword != DEFAULT_RULE and keyword in text and (best is None or len(keyword) > len(best[0])):
+            best = rule
+    if best is None:
+        best = next((rule for rule in rules if rule[0] == DEFAULT_RULE), None)
+    return best
+
+# Row data of a statement line, None if the rule's category or payment is no longer in the Dropdown
+def to_row_data(amount, description, rule, dropdown, default_payment):
+    _, category, payment = rule
+    payment = gs.match_dropdown(payment or default_payment or '', dropdown['payment'], dropdown['payment_sub'])
+    if payment is None:
+        return None
+    price = f'{amount:.2f}'
+    remarks = description.replace(',', ' ')
+    transport_type = gs.match_option(category, dropdown['transport'])
+    if transport_type:
+        # the description goes in the start column, the end is left empty
+        return [EntryType.TRANSPORT, price, f'{remarks},', transport_type, payment]
+    category = gs.match_dropdown(category, dropdown['others'], dropdown['others_sub'])
+    if category is None:
+        return None
+    return [EntryType.OTHERS, price, remarks, category, payment]
+
+def _key(day, price, remarks):
+    return day, f'{gs.parse_amount(price) or 0:.2f}', remarks.strip().lower()
+
+# Entries already in a month tab counted by (day, amount, remarks), the number of rows used and the
+# block of every day, {day: [first row, last row, transport rows used, other rows used]}.
+# latest is the (day, first row) of the trackers when they point into this tab, its date may not be written
+def existing_entries(sheet_id, month, latest=None):
+    counts = Counter()
+    blocks = {}
+    day = None
+    row_count = 0
+    for dates, transport, other in gs.iter_month_rows(sheet_id, month):
+        row = gs.first_entry_row + row_count
+        row_count += 1
+        date = str(dates[0]).strip() if dates else ''
+        if date.isdigit():
+            day = int(date)
+        elif latest and row == latest[1]:
+            day = latest[0]
+        if day is None:
+            continue
+        if day not in blocks or blocks[day][1] != row - 1:
+            blocks[day] = [row, row, 0, 0]
+        block = blocks[day]
+        block[1] = row
+        if transport and str(transport[0]).strip():
+            counts[_key(day, transport[0], str(transport[1]) if len(transport) > 1 else '')] += 1
+            block[2] = row - block[0] + 1
+        if other and str(other[0]).strip():
+            counts[_key(day, other[0], str(other[1]) if len(other) > 1 else '')] += 1
+            block[3] = row - block[0] + 1
+    return counts, row_count, blocks
+
+# Entries of days in a past month tab, laid out like the bot's own entries: the date in A and the
+# day's SUM in B on the first row, transport and others side by side. A day without a block gets one
+# after the last used row. A day that has one gets its free rows, the last block of the tab grows
+# to fit, the entries that don't fit an earlier block are left out, a second block of the same day
+# would hide the first. Returns the data and the number of entries left out
+def append_days(month, next_row, entries, blocks=None):
+    blocks = blocks or {}
+    data = []
+    left_out = 0
+    by_day = defaultdict(lambda: ([], []))
+    for date, row_data in entries:
+        by_day[date.day][0 if row_data[0] == EntryType.TRANSPORT else 1].append(row_data)
+    for day in sorted(by_day):
+        transport_rows, other_rows = by_day[day]
+        if day in blocks:
+            first_row, last_row, transport_used, other_used = blocks[day]
+            if last_row == next_row - 1:
+                last_row = first_row + max(transport_used + len(transport_rows), other_used + len(other_rows)) - 1
+                data.append({'range': f'{month}!B{first_row}', 'values': [[f'=SUM(C{first_row}:H{last_row})']]})
+                next_row = max(next_row, last_row + 1)
+            else:
+                size = last_row - first_row + 1
+                left_out += max(len(transport_rows) - (size - transport_used), 0) + max(len(other_rows) - (size - other_used), 0)
+                transport_rows = transport_rows[:size - transport_used]
+                other_rows = other_rows[:size - other_used]
+            for rows, used in ((transport_rows, transport_used), (other_rows, other_used)):
+                data.extend(gs.entry_data(month, first_row + used + offset, row_data) for offset, row_data in enumerate(rows))
+            continue
+        first_row = next_row
+        last_row = first_row + max(len(transport_rows), len(other_rows)) - 1
+        data.append({'range': f'{month}!A{first_row}', 'values': [[day]]})
+        data.append({'range': f'{month}!B{first_row}', 'values': [[f'=SUM(C{first_row}:H{last_row})']]})
+        for rows in (transport_rows, other_rows):
+            data.extend(gs.entry_data(month, first_row + offset, row_data) for offset, row_data in enumerate(rows))
+        next_row = last_row + 1
+    return data, left_out
+
+def _month_number(date):
+    return date.year * 12 + date.month
+
+# Import a statement into a sheet, the caller holds the sheet's lock. Entries after the latest
+# day in the sheet are allocated like any other entry, those in earlier months go to their day's
+# block or a new one at the end of their month tab, earlier ones in the latest month can't be placed
+# and are skipped.
+# Returns the counts of what happened and the data of one values.batchUpdate
+def import_statement(sheet_id, lines, rules, current_datetime):
+    stats = Counter()
+    dropdown = gs.get_dropdown(sheet_id)
+    quick_settings = gs.get_quick_add_settings(sheet_id, EntryType.OTHERS)
+    default_payment = quick_settings[0] if quick_settings else None
+    today = current_datetime.date()
+
+    by_month = defaultdict(list)
+    for date, amount, description in iter_statement(lines, stats):
+        # month tabs have no year, a year back would land in this year's tab
+        if date > today or _month_number(today) - _month_number(date) >= 12:
+            stats['out_of_range'] += 1
+            continue
+        rule = match_rule(description, rules)
+        row_data = to_row_data(amount, description, rule, dropdown, default_payment) if rule else None
+        if row_data is None:
+            stats['unmatched'] += 1
+            continue
+        by_month[(date.year, date.month)].append((date, row_data))
+
+    trackers = rt.get_trackers(sheet_id)
+    latest_date = gs.tracker_date(trackers[0], current_datetime)
+    trackers_month = _month_number(latest_date)
+    data, allocated, appended_months = [], [], []
+    for (year, month_number), entries in sorted(by_month.items()):
+        month = dt.date(year, month_number, 1).strftime('%B')
+        latest = (latest_date.day, trackers[3]) if year * 12 + month_number == trackers_month else None
+        counts, row_count, blocks = existing_entries(sheet_id, month, latest)
+        new_entries = []
+        for date, row_data in sorted(entries, key=lambda entry: entry[0]):
+            key = _key(date.day, row_data[1], row_data[2].rstrip(','))
+            if counts[key]:
+                counts[key] -= 1
+                stats['duplicates'] += 1
+            else:
+                new_entries.append((date, row_data))
+        if year * 12 + month_number < trackers_month:
+            left_out = 0
+            if new_entries:
+                month_data, left_out = append_days(month, gs.first_entry_row + row_count, new_entries, blocks)
+                data.extend(month_data)
+                appended_months.append(month)
+                stats['day_full'] += left_out
+            stats['imported'] += len(new_entries) - left_out
+            continue
+        for date, row_data in new_entries:
+            if year * 12 + month_number == trackers_month and date < latest_date:
+                stats['before_latest'] += 1
+            else:
+                allocated.append((dt.datetime.combine(date, dt.time(12), current_datetime.tzinfo), row_data))
+                stats['imported'] += 1
+
+    if allocated:
+        _, allocated_data = rt.allocate_transactions(sheet_id, allocated)
+        data.extend(allocated_data)
+    for month in appended_months:
+        rt.day_index.invalidate((sheet_id, month))
+        sm.summary_cache.invalidate((sheet_id, month, tuple(trackers)))
+    return stats, data
+
+def format_result(stats):
+    msg = f"{stats['imported']} transactions imported."
+    notes = [
+        (stats['duplicates'], 'already in your sheet'),
+        (stats['unmatched'], 'had no matching import rule, add one with /importrule'),
+        (stats['before_latest'], 'are dated before your latest entry this month, add them with /bulkadd'),
+        (stats['day_full'], 'had no free rows left in their day of an earlier month'),
+        (stats['out_of_range'], 'are in the future or more than a year ago'),
+        (stats['skipped'], 'were credits or could not be read'),
+    ]
+    for count, note in notes:
+        if count:
+            msg += f'\n{count} rows {note}.'
+    return msg
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+# Thread-safe LRU cache with per-entry TTL and single-flight loading
+class TTLCache:
+    def __init__(self, maxsize=128, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return _MISSING
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def _store(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    # Drop a key, an in-flight load for it will not be stored
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._loading.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._loading.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    # Return the cached value or call loader once, concurrent misses wait for the same load.
+    # A None result is kept for negative_ttl seconds when given
+    def get_or_load(self, key, loader, ttl=None, negative_ttl=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+                if value is None and negative_ttl is not None:
+                    ttl = negative_ttl
+                self._store(key, value, ttl)
+        future.set_result(value)
+        return value
@@ -0,0 +1,51 @@
+import csv
+import gzip
+import io
+import bot.google_sheet as gs
+
+# CSV export of month tabs, rows are streamed from paged reads into a gzip buffer
+EXPORT_PAGE_ROWS = 1000
+HEADER = ['Month', 'Day', 'Type', 'Price', 'Remarks', 'Category', 'Payment', 'Day Total']
+
+def _cell(row, index):
+    return str(row[index]).strip() if index < len(row) else ''
+
+# CSV rows of the entries in periods [(month, first day, last day)], a day of None is unbounded.
+# Transport entries are [price, start, end, type, payment], others [price, remarks, category, payment]
+def export_rows(sheet_id, periods):
+    yield HEADER
+    for month, first_day, last_day in periods:
+        day = None
+        for dates, transport, other in gs.iter_month_rows(sheet_id, month, EXPORT_PAGE_ROWS):
+            date = _cell(dates, 0)
+            day_total = ''
+            if date.isdigit():
+                day, day_total = int(date), _cell(dates, 1)
+            if last_day is not None and day is not None and day > last_day:
+                break
+            if first_day is not None and (day is None or day < first_day):
+                continue
+            entries = []
+            if _cell(transport, 0):
+                remarks = ', '.join(cell for cell in (_cell(transport, 1), _cell(transport, 2)) if cell)
+                entries.append(['Transport', _cell(transport, 0), remarks, _cell(transport, 3), _cell(transport, 4)])
+            if _cell(other, 0):
+                entries.append(['Others', _cell(other, 0), _cell(other, 1), _cell(other, 2), _cell(other, 3)])
+            for entry in entries:
+                # the day total is given once, on the first entry of the day
+                yield [month, day if day is not None else ''] + entry + [day_total]
+                day_total = ''
+
+# Write rows as gzip compressed CSV into an in-memory file
+def write_csv_gz(rows):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed:
+        with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+            writer = csv.writer(text)
+            for row in rows:
+                writer.writerow(row)
+    buffer.seek(0)
+    return buffer
+
+def build_export(sheet_id, periods):
+    return write_csv_gz(export_rows(sheet_id, periods))
@@ -0,0 +1,328 @@
+import copy
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, unquote, urlsplit
+import httplib2
+
+# In-memory stand-in for the parts of the Google Sheets API the bot uses, for running without
+# credentials. Install it with bot.google_sheet.set_sheets_api(FakeSheetsService()). Requests are
+# made with the real googleapiclient client over a fake HTTP connection, so they go through the
+# same request class and quota layer as against Google, and are answered here
+
+_A1_PATTERN = re.compile(r"^(?:'?(?P<tab>[^'!]+)'?!)?(?P<c1>[A-Z]*)(?P<r1>\d*)(?::(?P<c2>[A-Z]*)(?P<r2>\d*))?$")
+# /v4/spreadsheets/{id}, {id}:batchUpdate, {id}/values:batchGet, {id}/values:batchUpdate and {id}/values/{range}
+_PATH_PATTERN = re.compile(r'^/v4/spreadsheets/(?P<id>[^/:]+)(?::(?P<action>\w+)|/values(?::(?P<values_action>\w+)|/(?P<range>.+)))?$')
+_NUMBER_PATTERN = re.compile(r'^-?\d+(?:\.\d+)?$')
+_SUM_PATTERN = re.compile(r'^=SUM\(([A-Z]+\d+:[A-Z]+\d+)\)$', re.IGNORECASE)
+_MAX = 10 ** 6
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+def column_letters(index):
+    letters = ''
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+# 'Tab!C5:G' -> ('Tab', 5, 3, max row, 7), rows and columns are 1-indexed and inclusive
+def parse_range(range_name):
+    match = _A1_PATTERN.match(range_name)
+    if not match:
+        raise ApiError(400, f'Unable to parse range: {range_name}')
+    tab = match['tab']
+    first_row = int(match['r1']) if match['r1'] else 1
+    first_column = column_index(match['c1']) if match['c1'] else 1
+    if match['c2'] is None and match['r2'] is None:
+        # single cell
+        return tab, first_row, first_column, first_row, first_column
+    last_row = int(match['r2']) if match['r2'] else _MAX
+    last_column = column_index(match['c2']) if match['c2'] else _MAX
+    return tab, first_row, first_column, last_row, last_column
+
+# Error answered with its HTTP status, googleapiclient raises it as an HttpError
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# Text entered with valueInputOption RAW, never read as a number or a formula
+class Text(str):
+    pass
+
+# A value as the sheet keeps it: USER_ENTERED parses numbers and keeps formulas, RAW keeps text as is
+def enter_value(value, input_option):
+    if not isinstance(value, str):
+        return value
+    if input_option == 'RAW':
+        return Text(value)
+    if _NUMBER_PATTERN.match(value.strip()):
+        number = float(value)
+        return int(number) if number.is_integer() and '.' not in value else number
+    return value
+
+def _is_formula(value):
+    return isinstance(value, str) and not isinstance(value, Text) and value.startswith('=')
+
+def _format(value):
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# Connection handed to googleapiclient, every request is answered by the emulator
+class FakeHttp:
+    def __init__(self, service):
+        self.service = service
+        self.timeout = None
+        self.connections = {}
+        self.redirect_codes = set()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        return self.service.handle(method, uri, body)
+
+class FakeSheetsService:
+    def __init__(self, latency=0, error_rate=0, error_status=429, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        # spreadsheet id -> tab -> row -> column -> value, tabs in their order
+        self.spreadsheets_data = {}
+        # spreadsheet id -> tab -> sheetId
+        self.sheet_ids = {}
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._failures = []
+        self._client = None
+        self._lock = threading.Lock()
+
+    # The googleapiclient client answered by this emulator
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.auth.credentials import AnonymousCredentials
+                import bot.google_sheet as gs
+                self._client = gs.build_sheets_api(AnonymousCredentials(), new_http=lambda: FakeHttp(self))
+            return self._client
+
+    def spreadsheets(self):
+        return self.client().spreadsheets()
+
+    # Fail the next count requests with the given HTTP status
+    def fail_next(self, count=1, status=429):
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    # Answer one HTTP request, returns (response, content) as httplib2 does
+    def handle(self, method, uri, body=None):
+        if isinstance(body, bytes):
+            body = body.decode()
+        url = urlsplit(uri)
+        name, handler = self._route(method, url.path, parse_qs(url.query), json.loads(body) if body else {})
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[name] += 1
+            self.bytes_sent += len(uri) + len(body or '')
+            status = self._failures.pop(0) if self._failures else None
+            if status is None and self.error_rate and self.random.random() < self.error_rate:
+                status = self.error_status
+            try:
+                if status is not None:
+                    raise ApiError(status, 'Injected error')
+                status, content = 200, json.dumps(handler())
+            except ApiError as e:
+                status, content = e.status, json.dumps({'error': {'code': e.status, 'message': e.message}})
+            self.bytes_received += len(content)
+        return httplib2.Response({'status': status, 'content-type': 'application/json'}), content.encode()
+
+    def _route(self, method, path, query, body):
+        match = _PATH_PATTERN.match(path)
+        if not match:
+            raise NotImplementedError(f'{method} {path} is not emulated')
+        spreadsheet_id = unquote(match['id'])
+        render_option = query.get('valueRenderOption', ['FORMATTED_VALUE'])[0]
+        input_option = query.get('valueInputOption', [body.get('valueInputOption', 'RAW')])[0]
+        if match['range'] and method == 'GET':
+            return 'values.get', lambda: self.read(spreadsheet_id, unquote(match['range']), render_option)
+        if match['range'] and method == 'PUT':
+            return 'values.update', lambda: self.write(spreadsheet_id, unquote(match['range']), body.get('values', []), input_option)
+        if match['values_action'] == 'batchGet':
+            return 'values.batchGet', lambda: {
+                'spreadsheetId': spreadsheet_id,
+                'valueRanges': [self.read(spreadsheet_id, range_name, render_option) for range_name in query.get('ranges', [])],
+            }
+        if match['values_action'] == 'batchUpdate':
+            return 'values.batchUpdate', lambda: self._write_all(spreadsheet_id, body.get('data', []), input_option)
+        if match['action'] == 'batchUpdate':
+            return 'batchUpdate', lambda: self._apply_all(spreadsheet_id, body.get('requests', []))
+        if not match['action'] and not match['values_action'] and method == 'GET':
+            # the tabs' properties only, fields is ignored
+            return 'get', lambda: {'spreadsheetId': spreadsheet_id, 'sheets': self.tab_properties(spreadsheet_id)}
+        raise NotImplementedError(f'{method} {path} is not emulated')
+
+    def _tab(self, spreadsheet_id, tab):
+        if spreadsheet_id not in self.spreadsheets_data:
+            raise ApiError(404, f'Requested entity was not found: {spreadsheet_id}')
+        tabs = self.spreadsheets_data[spreadsheet_id]
+        if tab not in tabs:
+            raise ApiError(400, f'Unable to parse range: {tab}')
+        return tabs[tab]
+
+    # Value of a cell as read with the render option, formulas are calculated unless FORMULA is asked for
+    def _render(self, tab, value, render_option, depth=0):
+        if _is_formula(value) and render_option != 'FORMULA':
+            value = self._calculate(tab, value, depth)
+        if render_option == 'FORMATTED_VALUE' or isinstance(value, str):
+            return _format(value)
+        return value
+
+    # Only SUM over a range of the same tab is emulated, the one formula the bot writes
+    def _calculate(self, tab, formula, depth):
+        match = _SUM_PATTERN.match(formula)
+        if not match or depth > 10:
+            return '#NAME?'
+        _, first_row, first_column, last_row, last_column = parse_range(match[1])
+        total = 0
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                value = self._render(tab, tab.get(row, {}).get(column), 'UNFORMATTED_VALUE', depth + 1)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    total += value
+        return int(total) if float(total).is_integer() else total
+
+    def read(self, spreadsheet_id, range_name, render_option='FORMATTED_VALUE'):
+        tab_name, first_row, first_column, last_row, last_column = parse_range(range_name)
+        tab = self._tab(spreadsheet_id, tab_name)
+        values = []
+        for row in range(first_row, min(last_row, max(tab, default=0)) + 1):
+            cells = tab.get(row, {})
+            last_used = min(last_column, max((column for column in cells if column >= first_column), default=0))
+            values.append([self._render(tab, cells[column], render_option) if column in cells else ''
+                           for column in range(first_column, last_used + 1)])
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': range_name, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def write(self, spreadsheet_id, range_name, values, input_option='USER_ENTERED'):
+        tab_name, first_row, first_column, _, _ = parse_range(range_name)
+        tab = self._tab(spreadsheet_id, tab_name)
+        for row_offset, row_values in enumerate(values):
+            cells = tab.setdefault(first_row + row_offset, {})
+            for column_offset, value in enumerate(row_values):
+                if value is None:
+                    continue
+                column = first_column + column_offset
+                if value == '':
+                    cells.pop(column, None)
+                else:
+                    cells[column] = enter_value(value, input_option)
+        return {'updatedRange': range_name, 'updatedRows': len(values)}
+
+    # A values.batchUpdate is applied entirely or not at all
+    def _write_all(self, spreadsheet_id, data, input_option):
+        for item in data:
+            self._tab(spreadsheet_id, parse_range(item['range'])[0])
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'responses': [self.write(spreadsheet_id, item['range'], item.get('values', []), input_option) for item in data],
+        }
+
+    # So is a spreadsheets.batchUpdate
+    def _apply_all(self, spreadsheet_id, requests):
+        self._tab_names(spreadsheet_id)
+        saved = copy.deepcopy((self.spreadsheets_data[spreadsheet_id], self.sheet_ids[spreadsheet_id]))
+        try:
+            return {'spreadsheetId': spreadsheet_id, 'replies': [self.apply_request(spreadsheet_id, request) for request in requests]}
+        except Exception:
+            self.spreadsheets_data[spreadsheet_id], self.sheet_ids[spreadsheet_id] = saved
+            raise
+
+    def tab_properties(self, spreadsheet_id):
+        self._tab_names(spreadsheet_id)
+        return [{'properties': {'sheetId': self.sheet_ids[spreadsheet_id][tab], 'title': tab, 'index': index}}
+                for index, tab in enumerate(self.spreadsheets_data[spreadsheet_id])]
+
+    def _tab_names(self, spreadsheet_id):
+        if spreadsheet_id not in self.spreadsheets_data:
+            raise ApiError(404, f'Requested entity was not found: {spreadsheet_id}')
+        return {sheet_id: tab for tab, sheet_id in self.sheet_ids[spreadsheet_id].items()}
+
+    # Apply one spreadsheets.batchUpdate request, grid ranges are 0-indexed and end exclusive
+    def apply_request(self, spreadsheet_id, request):
+        names = self._tab_names(spreadsheet_id)
+        tabs = self.spreadsheets_data[spreadsheet_id]
+        if 'duplicateSheet' in request:
+            options = request['duplicateSheet']
+            title = options['newSheetName']
+            new_id = options.get('newSheetId', max(names, default=0) + 1)
+            if options['sourceSheetId'] not in names or title in tabs or new_id in names:
+                raise ApiError(400, f'Invalid duplicateSheet request: {title}')
+            copied = {row: dict(cells) for row, cells in tabs[names[options['sourceSheetId']]].items()}
+            order = list(tabs.items())
+            order.insert(options.get('insertSheetIndex', len(order)), (title, copied))
+            self.spreadsheets_data[spreadsheet_id] = dict(order)
+            self.sheet_ids[spreadsheet_id][title] = new_id
+            return {'duplicateSheet': {'properties': {'sheetId': new_id, 'title': title}}}
+        if 'updateCells' in request:
+            options = request['updateCells']
+            if options.get('rows') or options['fields'] != 'userEnteredValue':
+                raise NotImplementedError('only clearing values is emulated')
+            grid = options['range']
+            tab = tabs[names[grid['sheetId']]]
+            for row, cells in tab.items():
+                if not grid.get('startRowIndex', 0) < row <= grid.get('endRowIndex', _MAX):
+                    continue
+                for column in list(cells):
+                    if grid.get('startColumnIndex', 0) < column <= grid.get('endColumnIndex', _MAX):
+                        del cells[column]
+            return {}
+        if 'findReplace' in request:
+            options = request['findReplace']
+            grid = options['range']
+            tab = tabs[names[grid['sheetId']]]
+            replaced = 0
+            for row, cells in tab.items():
+                if not grid.get('startRowIndex', 0) < row <= grid.get('endRowIndex', _MAX):
+                    continue
+                for column, value in cells.items():
+                    if isinstance(value, str) and options['find'] in value:
+                        cells[column] = type(value)(value.replace(options['find'], options['replacement']))
+                        replaced += 1
+            return {'findReplace': {'valuesChanged': replaced}}
+        raise NotImplementedError(f'{next(iter(request))} is not emulated')
+
+    # Helpers to set up and check a spreadsheet for a test run, they are not counted as API calls
+    def create_spreadsheet(self, spreadsheet_id, tabs):
+        with self._lock:
+            self.spreadsheets_data[spreadsheet_id] = {tab: {} for tab in tabs}
+            self.sheet_ids[spreadsheet_id] = {tab: index for index, tab in enumerate(tabs)}
+
+    def set_values(self, spreadsheet_id, range_name, values):
+        with self._lock:
+            self.write(spreadsheet_id, range_name, values)
+
+    def get_values(self, spreadsheet_id, range_name, render_option='FORMATTED_VALUE'):
+        with self._lock:
+            return self.read(spreadsheet_id, range_name, render_option).get('values', [])
@@ -1,4 +1,14 @@
+import hashlib
+import os
 from bot.firebase_config import db
+from bot.cache import TTLCache
+
+# telegram_id -> sheet_id cache in front of the Realtime Database
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "3600"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# unknown users are cached for a short time only, they are likely about to link a sheet
+NEGATIVE_CACHE_TTL = 60
+sheet_id_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 # new user setup
 def new_user_setup(telegram_id, sheet_id):
@@ -6,13 +16,112 @@ def new_user_setup(telegram_id, sheet_id):
     ref.update({
         'sheet_id': sheet_id,
     })
+    sheet_id_cache.set(str(telegram_id), sheet_id)
 
 # check if user exists
 def check_if_user_exists(telegram_id):
-    ref = db.reference('/users/' + str(telegram_id))
-    return ref.get() is not None
+    return get_user_sheet_id(telegram_id) is not None
 
 # get user sheet id
 def get_user_sheet_id(telegram_id):
     ref = db.reference('/users/' + str(telegram_id) + '/sheet_id')
-    return ref.get()
\ No newline at end of file
+    return sheet_id_cache.get_or_load(str(telegram_id), ref.get, negative_ttl=NEGATIVE_CACHE_TTL)
+
+# drop a user from the cache, the next lookup reads the database. The listener keeps the cache
+# fresh while it runs, lookups then stay local
+def forget_user(telegram_id):
+    if user_listener is None:
+        sheet_id_cache.invalidate(str(telegram_id))
+
+# apply a change streamed from /users to the cache
+def _on_users_event(event):
+    path = [part for part in event.path.split('/') if part]
+    if not path:
+        # full snapshot on connect, or a patch of several users
+        if event.event_type == 'put':
+            sheet_id_cache.clear()
+        for telegram_id, user in (event.data or {}).items():
+            _cache_user(telegram_id, user)
+    elif len(path) == 1:
+        _cache_user(path[0], event.data)
+    elif path[1] == 'sheet_id':
+        _cache_user(path[0], {'sheet_id': event.data})
+
+def _cache_user(telegram_id, user):
+    sheet_id = user.get('sheet_id') if isinstance(user, dict) else None
+    if sheet_id is None:
+        sheet_id_cache.invalidate(str(telegram_id))
+    else:
+        sheet_id_cache.set(str(telegram_id), sheet_id)
+
+# keep the cache fresh from the database, so lookups made by other instances are seen too
+user_listener = None
+
+def start_user_listener():
+    global user_listener
+    user_listener = db.reference('/users').listen(_on_users_event)
+    return user_listener
+
+# row trackers of a sheet, [day, others row, transport row, first row]
+TRACKER_FIELDS = ['day', 'others_row', 'transport_row', 'first_row']
+
+def _to_trackers(value):
+    if value is None:
+        return None
+    return [int(value[field]) for field in TRACKER_FIELDS]
+
+# get sheet row trackers
+def get_trackers(sheet_id):
+    ref = db.reference('/trackers/' + str(sheet_id))
+    return _to_trackers(ref.get())
+
+# set sheet row trackers
+def set_trackers(sheet_id, trackers):
+    ref = db.reference('/trackers/' + str(sheet_id))
+    ref.set(dict(zip(TRACKER_FIELDS, trackers)))
+
+# atomically replace the row trackers with update_fn(current trackers)
+def update_trackers(sheet_id, update_fn):
+    ref = db.reference('/trackers/' + str(sheet_id))
+    new_value = ref.transaction(lambda value: dict(zip(TRACKER_FIELDS, update_fn(_to_trackers(value)))))
+    return _to_trackers(new_value)
+
+# every sheet with row trackers, only the keys are fetched
+def get_tracked_sheets():
+    return list((db.reference('/trackers').get(shallow=True) or {}).keys())
+
+# bank statement import rules of a user, keyed by a hash of the keyword as keys can't hold every character
+def _rule_ref(telegram_id, keyword=None):
+    path = '/import_rules/' + str(telegram_id)
+    if keyword is not None:
+        path += '/' + hashlib.md5(keyword.encode()).hexdigest()
+    return db.reference(path)
+
+def get_import_rules(telegram_id):
+    rules = _rule_ref(telegram_id).get() or {}
+    return sorted((rule['keyword'], rule['category'], rule.get('payment', '')) for rule in rules.values())
+
+def set_import_rule(telegram_id, keyword, category, payment):
+    _rule_ref(telegram_id, keyword).set({'keyword': keyword, 'category': category, 'payment': payment})
+
+# returns False if there was no such rule
+def delete_import_rule(telegram_id, keyword):
+    ref = _rule_ref(telegram_id, keyword)
+    if ref.get() is None:
+        return False
+    ref.delete()
+    return True
+
+# every import rule as (telegram_id, keyword, category, payment), used when migrating to another store
+def export_import_rules():
+    users = db.reference('/import_rules').get() or {}
+    return [(telegram_id, rule['keyword'], rule['category'], rule.get('payment', ''))
+            for telegram_id, rules in users.items() for rule in rules.values()]
+
+# every user and row tracker, used when migrating to another store
+def export_users():
+    users = db.reference('/users').get() or {}
+    trackers = db.reference('/trackers').get() or {}
+    user_rows = [(telegram_id, user['sheet_id']) for telegram_id, user in users.items() if isinstance(user, dict) and user.get('sheet_id')]
+    tracker_rows = [(sheet_id, *_to_trackers(value)) for sheet_id, value in trackers.items()]
+    return user_rows, tracker_rows
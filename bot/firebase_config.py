@@ -1,11 +1,31 @@
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
 import os
+import threading
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+CREDENTIALS_FILE = "accounts/firebase_account.json"
 
-cred = credentials.Certificate("accounts/firebase_account.json")
-firebase_admin.initialize_app(cred, {
-    'databaseURL': DATABASE_URL
-})
\ No newline at end of file
+# The Firebase app is initialized on first use so importing the bot, or running it on the sqlite
+# backend, doesn't load firebase_admin or read the credentials
+_app = None
+_app_lock = threading.Lock()
+
+def get_app():
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                import firebase_admin
+                from firebase_admin import credentials
+                cred = credentials.Certificate(CREDENTIALS_FILE)
+                _app = firebase_admin.initialize_app(cred, {
+                    'databaseURL': DATABASE_URL
+                })
+    return _app
+
+# Stands in for firebase_admin.db, e.g. db.reference('/users')
+class LazyDatabase:
+    def reference(self, path='/'):
+        from firebase_admin import db as firebase_db
+        return firebase_db.reference(path, app=get_app())
+
+db = LazyDatabase()
@@ -1,100 +1,184 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import os
+import re
+import calendar
+import threading
+import datetime as dt
 from bot.common import EntryType
+from bot.cache import TTLCache
+import bot.sheets_quota as sheets_quota
+import bot.metrics as metrics
 
 # Path to the downloaded JSON key file
 SERVICE_ACCOUNT_FILE = 'accounts/service_account.json'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-sheets_api = build('sheets', 'v4', credentials=creds)
-
-# Dropdown range
-transport_range = "Dropdown!A3:A9"
-others_sub_range = [f"Dropdown!{chr(i)}2:{chr(i)}9" for i in range(ord('B'), ord('K'))]
-others_main_range = "Dropdown!B2:J2"
-payment_sub_range = [f"Dropdown!{chr(i)}12:{chr(i)}19" for i in range(ord('A'), ord('K'))]
-payment_main_range = "Dropdown!A12:J12"
-quick_others_range = 'Tracker!I3:J13'
-income_range = 'Dropdown!L2:L9'
+# Socket timeout (seconds) for a single Sheets HTTP request
+REQUEST_TIMEOUT = float(os.getenv("SHEETS_REQUEST_TIMEOUT", "20"))
+
+# Build the Sheets client from the service account, or the given credentials. The Google client
+# libraries are imported here as they take a while to load, and the API is described by the
+# discovery document bundled with googleapiclient so building it needs no network request.
+# new_http() makes the connection of each thread, e.g. to the Sheets emulator
+def build_sheets_api(creds=None, new_http=None):
+    import httplib2
+    import google_auth_httplib2
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from googleapiclient.http import HttpRequest
+
+    if creds is None:
+        creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+
+    # Every request goes through the quota layer, GET requests count as reads and the rest as writes
+    class QuotaHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            kind = sheets_quota.READ if self.method == 'GET' else sheets_quota.WRITE
+            with metrics.timed('sheets_request', kind=kind):
+                return sheets_quota.execute(lambda: HttpRequest.execute(self, http=http, num_retries=num_retries), kind)
+
+    if new_http is None:
+        new_http = lambda: httplib2.Http(timeout=REQUEST_TIMEOUT)
+
+    # httplib2 is not thread-safe, every executor thread keeps its own connection alive between requests
+    connections = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(connections, 'http'):
+            connections.http = google_auth_httplib2.AuthorizedHttp(creds, http=new_http())
+        return QuotaHttpRequest(connections.http, *args, **kwargs)
+
+    api = build('sheets', 'v4', credentials=creds, requestBuilder=build_request, static_discovery=True, cache_discovery=False)
+    # googleapiclient builds every method of a resource, docstrings included, each time the resource is
+    # asked for, tens of milliseconds per call. The resources are built once and shared between threads,
+    # each call still makes its own request
+    spreadsheets = api.spreadsheets()
+    values = spreadsheets.values()
+    spreadsheets.values = lambda: values
+    api.spreadsheets = lambda: spreadsheets
+    return api
+
+# The client is built on first use so the module can be imported without credentials,
+# once even when the first calls come from several threads
+sheets_api = None
+_sheets_api_lock = threading.Lock()
+
+def get_sheets_api():
+    global sheets_api
+    if sheets_api is None:
+        with _sheets_api_lock:
+            if sheets_api is None:
+                sheets_api = build_sheets_api()
+    return sheets_api
+
+# Replace the client, e.g. with bot.fake_sheets.FakeSheetsService when running offline
+def set_sheets_api(api):
+    global sheets_api
+    sheets_api = api
+
+# Dropdown tab layout: transport types in A3:A9, others categories in B2:J2 with subcategories
+# below each of them, payment modes in A12:J12 with sub payments below, income sources in L2:L9.
+# Quick add settings live in Tracker!G3:J13, both are read together into the dropdown cache
+dropdown_range = 'Dropdown!A1:L19'
+tracker_range = 'Tracker!B3:E3'
+quick_settings_range = 'Tracker!G3:J13'
+DROPDOWN_CACHE_TTL = float(os.getenv("DROPDOWN_CACHE_TTL", "600"))
+DROPDOWN_CACHE_SIZE = int(os.getenv("DROPDOWN_CACHE_SIZE", "256"))
+dropdown_cache = TTLCache(maxsize=DROPDOWN_CACHE_SIZE, ttl=DROPDOWN_CACHE_TTL)
+
+# Entries of a month tab start below the header rows
+first_entry_row = 5
+
+# Get a cell from a list of rows, rows and columns are 1-indexed as in the sheet
+def _cell(values, row, column):
+    if row - 1 < len(values) and column - 1 < len(values[row - 1]):
+        return str(values[row - 1][column - 1]).strip()
+    return ''
+
+# Non empty cells of a column between two rows
+def _column(values, column, first_row, last_row):
+    cells = [_cell(values, row, column) for row in range(first_row, last_row + 1)]
+    return [cell for cell in cells if cell]
+
+# Header of each column and the values under it, same shape as the old per-column batchGet
+def _sub_dropdown(values, header_row, last_row, first_column, last_column):
+    sub_dropdown = {}
+    for column in range(first_column, last_column + 1):
+        header = _cell(values, header_row, column)
+        if header and header not in sub_dropdown:
+            sub_dropdown[header] = [header] + _column(values, column, header_row + 1, last_row)
+    return sub_dropdown
+
+def parse_dropdown(dropdown_values, tracker_values):
+    quick_settings = tracker_values[0] if tracker_values else []
+    return {
+        'transport': _column(dropdown_values, 1, 3, 9),
+        'others': [cell for cell in (_cell(dropdown_values, 2, column) for column in range(2, 11)) if cell],
+        'others_sub': _sub_dropdown(dropdown_values, 2, 9, 2, 10),
+        'payment': [cell for cell in (_cell(dropdown_values, 12, column) for column in range(1, 11)) if cell],
+        'payment_sub': _sub_dropdown(dropdown_values, 12, 19, 1, 10),
+        'income': _column(dropdown_values, 12, 2, 9),
+        'quick_settings': quick_settings if quick_settings else None,
+        'quick_others': [tuple(row[2:4]) for row in tracker_values if row[2:4]],
+    }
 
-def get_main_dropdown_value(sheet_id, entry_type):
-    range = []
-    if entry_type == EntryType.TRANSPORT:
-        range = transport_range
-    elif entry_type == EntryType.OTHERS:
-        range = others_main_range
-    else:
-        range = payment_main_range
-    # Make the request
-    results = sheets_api.spreadsheets().values().get(
+# Read the Dropdown tab and quick add settings in one request
+def load_dropdown(sheet_id):
+    results = get_sheets_api().spreadsheets().values().batchGet(
         spreadsheetId=sheet_id,
-        range=range).execute()
+        ranges=[dropdown_range, quick_settings_range]).execute()
+    value_ranges = results.get('valueRanges', [])
+    dropdown_values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+    tracker_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+    return parse_dropdown(dropdown_values, tracker_values)
 
-    # Get the values from the result
-    values = results.get('values', [])
+def get_dropdown(sheet_id):
+    return dropdown_cache.get_or_load(sheet_id, lambda: load_dropdown(sheet_id))
 
-    if entry_type == EntryType.TRANSPORT:
-        results_list = []
-        for sublist in values:
-            for item in sublist:
-                results_list.append(item)
-        return results_list
+# Forget the cached Dropdown of a sheet, e.g. after the user edits it
+def invalidate_dropdown(sheet_id):
+    dropdown_cache.invalidate(sheet_id)
 
-    return values[0]
+def get_main_dropdown_value(sheet_id, entry_type):
+    dropdown = get_dropdown(sheet_id)
+    if entry_type == EntryType.TRANSPORT:
+        return list(dropdown['transport'])
+    elif entry_type == EntryType.OTHERS:
+        return list(dropdown['others'])
+    return list(dropdown['payment'])
 
 def get_sub_dropdown_value(sheet_id, main_value, entry_type):
-    range = []
+    dropdown = get_dropdown(sheet_id)
     if entry_type == EntryType.OTHERS:
-        range = others_sub_range
-    else:
-        range = payment_sub_range
-    # Make the request
-    results = sheets_api.spreadsheets().values().batchGet(
-        spreadsheetId=sheet_id,
-        ranges=range).execute()
-
-    # Get the values from the result
-    value_ranges = results.get('valueRanges', [])
-    
-    dropdown = []
-    for value in value_ranges:
-        if value.get('values', []):
-            if main_value == value.get('values', [])[0][0]:
-                dropdown.append(value.get('values', []))
-                pass
-
-    flat_list = [item for sublist in dropdown[0] for item in sublist]
-    return flat_list
-
-def update_prev_day(sheet_id, month, first_row):
-    last_row = get_new_row(sheet_id, month)
-    # Write the message to the Google Sheet
-    body = {'values': [[f'=SUM(C{first_row}:H{last_row})']]}
-    range_name = f'{month}!B{first_row}'
-    sheets_api.spreadsheets().values().update(
-        spreadsheetId=sheet_id,
-        range=range_name,
-        valueInputOption='USER_ENTERED',
-        body=body).execute()
-
-def get_new_row(sheet_id, month):
-    result = sheets_api.spreadsheets().values().get(
-            spreadsheetId=sheet_id,
-            range=f'{month}!A:K').execute()
-    values = result.get('values', [])
-    return len(values)
-
-def create_date(sheet_id, day, month, first_row):
-    # Update date in column A
-    body = {'values': [[day]]}
-    range_name = f'{month}!A{first_row}'
-    sheets_api.spreadsheets().values().update(
-    spreadsheetId=sheet_id,
-    range=range_name,
-    valueInputOption='USER_ENTERED',
-    body=body).execute()
+        return list(dropdown['others_sub'][main_value])
+    return list(dropdown['payment_sub'][main_value])
+
+# Dropdown value matching text regardless of case, None if there is none
+def match_option(text, options):
+    for option in options:
+        if option.lower() == text.lower():
+            return option
+    return None
 
-def create_entry(sheet_id, month, row_tracker, row_data):
+# Check 'main' or 'main - sub' against a dropdown and its sub dropdowns, returns the value as the sheet stores it
+def match_dropdown(text, main_values, sub_values):
+    main, _, sub = [part.strip() for part in text.partition(' - ')]
+    main = match_option(main, main_values)
+    if main is None:
+        return None
+    subs = sub_values.get(main, [main])[1:]
+    if not subs:
+        return None if sub else main
+    sub = match_option(sub, subs)
+    return f'{main} - {sub}' if sub else None
+
+# Amount in a cell such as 12.5 or $1,234.50, None if it isn't one
+def parse_amount(value):
+    try:
+        return float(re.sub(r'[^\d.\-]', '', str(value)))
+    except ValueError:
+        return None
+
+# Range and values of an entry row, transport goes to C:G and others to H:K
+def entry_data(month, row_tracker, row_data):
     entry_type = row_data[0]
     price = row_data[1].strip()
     remarks = row_data[2].strip()
@@ -110,75 +194,121 @@ def create_entry(sheet_id, month, row_tracker, row_data):
         sheet_column_end = 'G'
         data = [price] + remarks_list + [category, payment]
 
-    # Write the message to the Google Sheet
-    body = {'values': [data]}
     range_name = f'{month}!{sheet_column_start}{row_tracker}:{sheet_column_end}{row_tracker}'
-    sheets_api.spreadsheets().values().update(
+    return {'range': range_name, 'values': [data]}
+
+def create_entry(sheet_id, month, row_tracker, row_data):
+    batch_update(sheet_id, [entry_data(month, row_tracker, row_data)])
+
+# The day tracker holds the date of the sheet's latest day as yyyymmdd. Trackers from before held the
+# day of the month only, that day is in current_datetime's month, or the month before when it is ahead
+def tracker_date(day_tracker, current_datetime):
+    if day_tracker > 31:
+        return dt.date(day_tracker // 10000, day_tracker // 100 % 100, day_tracker % 100)
+    date = current_datetime.date()
+    if day_tracker > date.day:
+        date -= dt.timedelta(days=date.day)
+    return date.replace(day=min(day_tracker, calendar.monthrange(date.year, date.month)[1]))
+
+def date_tracker(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+# Close the day of the trackers [day, others row, transport row, first row] and start current_datetime's day:
+# the SUM formula of the closed day and the date of the new one. Returns the data and the new trackers
+def plan_rollover(trackers, current_datetime):
+    day_tracker, other_row_tracker, transport_row_tracker, first_row = trackers
+    latest = tracker_date(day_tracker, current_datetime)
+    day = current_datetime.day
+    month = current_datetime.strftime('%B')
+    data = []
+
+    # the latest day may be months back when the sheet was left idle
+    new_month = (latest.year, latest.month) != (current_datetime.year, current_datetime.month)
+    # sum of the previous day, the last row used is known from the trackers
+    last_row = max(other_row_tracker, transport_row_tracker, first_row)
+    data.append({'range': f'{latest:%B}!B{first_row}', 'values': [[f'=SUM(C{first_row}:H{last_row})']]})
+    # a new month starts from the top of its own tab
+    new_row = 5 if new_month else last_row
+    first_row = new_row + 1
+    # enter date into cell
+    data.append({'range': f'{month}!A{first_row}', 'values': [[day]]})
+    return data, [date_tracker(current_datetime), new_row, new_row, first_row]
+
+# Work out every cell a transaction writes from the current trackers [day, others row, transport row, first row].
+# Returns the data for one values.batchUpdate (date cell, SUM formula, entry row and trackers) and the new trackers
+def plan_transaction(trackers, current_datetime, row_data):
+    month = current_datetime.strftime('%B')
+    data = []
+
+    # start new date if date elapsed, usually done ahead by the midnight rollover
+    if tracker_date(trackers[0], current_datetime) != current_datetime.date():
+        data, trackers = plan_rollover(trackers, current_datetime)
+    day_tracker, other_row_tracker, transport_row_tracker, first_row = trackers
+
+    # update row + 1
+    entry_type = row_data[0]
+    if entry_type == EntryType.TRANSPORT:
+        transport_row_tracker += 1
+        data.append(entry_data(month, transport_row_tracker, row_data))
+    else:
+        other_row_tracker += 1
+        data.append(entry_data(month, other_row_tracker, row_data))
+
+    new_trackers = [day_tracker, other_row_tracker, transport_row_tracker, first_row]
+    data.append(trackers_data(new_trackers))
+    return data, new_trackers
+
+# Plan several transactions [(datetime, row data)] as one write, their rows are allocated one after the other
+def plan_transactions(trackers, entries):
+    data = []
+    for current_datetime, row_data in entries:
+        row_writes, trackers = plan_transaction(trackers, current_datetime, row_data)
+        # the Tracker mirror is written once, with the final trackers
+        data.extend(item for item in row_writes if item['range'] != tracker_range)
+    data.append(trackers_data(trackers))
+    return data, trackers
+
+# Write several ranges in one request
+def batch_update(sheet_id, data):
+    body = {'valueInputOption': 'USER_ENTERED', 'data': data}
+    get_sheets_api().spreadsheets().values().batchUpdate(
         spreadsheetId=sheet_id,
-        range=range_name,
-        valueInputOption='USER_ENTERED',
         body=body).execute()
-    
-def get_trackers(sheet_id):
-    result = sheets_api.spreadsheets().values().get(
-            spreadsheetId=sheet_id,
-            range=f'Tracker!B3:E3').execute()
-    values = result.get('values', [])
-    return values[0]
 
-def update_rows(sheet_id, day, new_row, first_row):
-    values = [[day] + [new_row] * 2 + [first_row]]  
-    range_name = 'Tracker!B3:E3'
-    body = {'values': values}
-    request = sheets_api.spreadsheets().values().update(
+# Properties {title: {sheetId, title, index}} of every tab of a spreadsheet
+def get_tabs(sheet_id):
+    result = get_sheets_api().spreadsheets().get(
         spreadsheetId=sheet_id,
-        range=range_name,
-        valueInputOption='USER_ENTERED',
-        body=body
-    )
-    request.execute()
+        fields='sheets.properties(sheetId,title,index)').execute()
+    return {sheet['properties']['title']: sheet['properties'] for sheet in result.get('sheets', [])}
 
-def row_incremental(sheet_id, entry_type):
-    range_name = 'Tracker!B3:E3'
-    response = sheets_api.spreadsheets().values().get(
+# Apply several spreadsheet requests, e.g. duplicateSheet, in one request
+def update_spreadsheet(sheet_id, requests):
+    get_sheets_api().spreadsheets().batchUpdate(
         spreadsheetId=sheet_id,
-        range=range_name,
-        majorDimension='ROWS'
-    ).execute()
+        body={'requests': requests}).execute()
 
-    values = response.get('values', [])
-    if values:
-        row_values = values[0]
-        if entry_type == EntryType.OTHERS:
-            row_values[1] = str(int(row_values[1]) + 1)  # Increment others count
-        elif entry_type == EntryType.TRANSPORT:
-            row_values[2] = str(int(row_values[2]) + 1)  # Increment transport count
-
-        body = {'values': [row_values]}
-        sheets_api.spreadsheets().values().update(
+def get_trackers(sheet_id):
+    result = get_sheets_api().spreadsheets().values().get(
             spreadsheetId=sheet_id,
-            range=range_name,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
+            range=tracker_range).execute()
+    values = result.get('values', [])
+    return [int(tracker) for tracker in values[0]]
 
-def get_quick_add_settings(sheet_id, entry_type):
-    range_name = 'Tracker!G3:J3'  
-    response = sheets_api.spreadsheets().values().get(
-        spreadsheetId=sheet_id,
-        range=range_name,
-        majorDimension='ROWS'
-    ).execute()
+# Range and values of the row trackers [day, others row, transport row, first row]
+def trackers_data(trackers):
+    return {'range': tracker_range, 'values': [list(trackers)]}
 
-    values = response.get('values', [])
+def get_quick_add_settings(sheet_id, entry_type):
+    values = get_dropdown(sheet_id)['quick_settings']
     if values:
         if entry_type == EntryType.TRANSPORT:
-            transport_payment = values[0][0] if len(values[0]) > 0 else None
-            transport_type = values[0][1] if len(values[0]) > 1 else None
+            transport_payment = values[0] if len(values) > 0 else None
+            transport_type = values[1] if len(values) > 1 else None
             return transport_payment, transport_type
         else:
-            others_payment = values[0][2] if len(values[0]) > 2 else None
-            others_type = values[0][3] if len(values[0]) > 3 else None
+            others_payment = values[2] if len(values) > 2 else None
+            others_type = values[3] if len(values) > 3 else None
             return others_payment, others_type
 
     return None
@@ -187,7 +317,7 @@ def update_quick_add_settings(sheet_id, entry_type, payment, type):
     if entry_type == EntryType.TRANSPORT:
         range_name = 'Tracker!G3:H3'
     else:
-        last_row = sheets_api.spreadsheets().values().get(
+        last_row = get_sheets_api().spreadsheets().values().get(
         spreadsheetId=sheet_id,
         range='Tracker!I:J',
         ).execute().get('values', [])
@@ -197,54 +327,77 @@ def update_quick_add_settings(sheet_id, entry_type, payment, type):
     body = {
         'values': [new_row]
     }
-    sheets_api.spreadsheets().values().update(
+    get_sheets_api().spreadsheets().values().update(
     spreadsheetId=sheet_id,
     range=range_name,
     valueInputOption='USER_ENTERED',
     body=body).execute()
+    invalidate_dropdown(sheet_id)
 
+# quick add others settings [(payment, category)]
 def get_quick_add_others(sheet_id):
-    range_name = quick_others_range
-    response = sheets_api.spreadsheets().values().get(
-        spreadsheetId=sheet_id,
-        range=range_name
-    ).execute()
-
-    values = response.get('values', [])
-    others_list = []
-    for other in values:
-        merged_str = ', '.join(other)
-        others_list.append(merged_str)
-    return others_list
+    return list(get_dropdown(sheet_id)['quick_others'])
 
-def retrieve_transaction(sheet_id, month, date):
-    result = sheets_api.spreadsheets().values().get(
+# First row of every day in a month tab -> {day: (first row, last row)}, from the dates in column A.
+# The last day has no last row as it runs to the end of the tab
+def get_day_rows(sheet_id, month):
+    result = get_sheets_api().spreadsheets().values().get(
             spreadsheetId=sheet_id,
-            range=f'{month}!A:A').execute()
-    values = result.get('values', [])
-    flat_list = [item for sublist in values for item in sublist or ['']]
-
-    first_row = flat_list.index(date)
-    first_row += 1
-    last_row = flat_list.index(str(int(date) + 1)) if str(int(date) + 1) in flat_list else first_row + 10    
-    result = sheets_api.spreadsheets().values().batchGet(
+            range=f'{month}!A{first_entry_row}:A').execute()
+    starts = []
+    for offset, row in enumerate(result.get('values', [])):
+        if row and str(row[0]).strip().isdigit():
+            starts.append((int(row[0]), first_entry_row + offset))
+    day_rows = {}
+    for index, (day, first_row) in enumerate(starts):
+        last_row = starts[index + 1][1] - 1 if index + 1 < len(starts) else None
+        day_rows[day] = (first_row, last_row)
+    return day_rows
+
+# Total spend, transport and other entries of the day in rows first_row to last_row, in one request
+def retrieve_transaction(sheet_id, month, first_row, last_row=None):
+    last_row = last_row or ''
+    result = get_sheets_api().spreadsheets().values().batchGet(
     spreadsheetId=sheet_id,
     ranges=[f'{month}!B{first_row}', f'{month}!C{first_row}:G{last_row}', f'{month}!H{first_row}:K{last_row}']).execute()
     value_ranges = result.get('valueRanges', [])
     total_spend = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
-    transport_values = value_ranges[1].get('values', []) if len(value_ranges) > 0 else []
-    other_values = value_ranges[2].get('values', []) if len(value_ranges) > 1 else []
+    transport_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+    other_values = value_ranges[2].get('values', []) if len(value_ranges) > 2 else []
 
     return total_spend, transport_values, other_values
 
-def get_work_place(sheet_id):
-    result = sheets_api.spreadsheets().values().get(
+# Dates, transport and other entries of a month tab in one request, every list starts at the first entry row
+def get_month_entries(sheet_id, month):
+    result = get_sheets_api().spreadsheets().values().batchGet(
+        spreadsheetId=sheet_id,
+        ranges=[f'{month}!A{first_entry_row}:A', f'{month}!C{first_entry_row}:G', f'{month}!H{first_entry_row}:K'],
+        valueRenderOption='UNFORMATTED_VALUE').execute()
+    value_ranges = result.get('valueRanges', [])
+    dates, transport_values, other_values = [value_range.get('values', []) for value_range in value_ranges]
+    return dates, transport_values, other_values
+
+# Rows of a month tab as (date and day total, transport entry, other entry), read page_size rows
+# per batchGet until a page comes back short, the API leaves out empty rows at the end
+def iter_month_rows(sheet_id, month, page_size=1000):
+    first_row = first_entry_row
+    while True:
+        last_row = first_row + page_size - 1
+        result = get_sheets_api().spreadsheets().values().batchGet(
             spreadsheetId=sheet_id,
-            range=income_range).execute()
-    values = result.get('values', [])
-    flattened_list = [item for sublist in values for item in sublist]
+            ranges=[f'{month}!A{first_row}:B{last_row}', f'{month}!C{first_row}:G{last_row}', f'{month}!H{first_row}:K{last_row}']).execute()
+        dates, transport_values, other_values = [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+        row_count = max(len(dates), len(transport_values), len(other_values))
+        for index in range(row_count):
+            yield (dates[index] if index < len(dates) else [],
+                   transport_values[index] if index < len(transport_values) else [],
+                   other_values[index] if index < len(other_values) else [])
+        if row_count < page_size:
+            return
+        first_row = last_row + 1
 
-    return flattened_list
+def get_work_place(sheet_id):
+    return list(get_dropdown(sheet_id)['income'])
 
 def update_income(sheet_id, month, row_data):
     data_mo = row_data[:3] 
@@ -252,7 +405,7 @@ def update_income(sheet_id, month, row_data):
     body_mo = {'values': [data_mo]}
     body_r = {'values': [data_r]}
 
-    result = sheets_api.spreadsheets().values().get(
+    result = get_sheets_api().spreadsheets().values().get(
             spreadsheetId=sheet_id,
             range=f'{month}!M5:M10').execute()
     values = result.get('values', [])
@@ -262,7 +415,7 @@ def update_income(sheet_id, month, row_data):
 
     range_name_mo = f'{month}!M{last_row}:O{last_row}'
     range_name_r = f'{month}!R{last_row}:R{last_row}'
-    sheets_api.spreadsheets().values().update(
+    get_sheets_api().spreadsheets().values().update(
         spreadsheetId=sheet_id,
         range=range_name_mo,
         valueInputOption='USER_ENTERED',
@@ -270,7 +423,7 @@ def update_income(sheet_id, month, row_data):
     ).execute()
 
     body_r = {'values': [data_r]}
-    sheets_api.spreadsheets().values().update(
+    get_sheets_api().spreadsheets().values().update(
         spreadsheetId=sheet_id,
         range=range_name_r,
         valueInputOption='USER_ENTERED',
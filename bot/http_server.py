@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace
+import bot.logger as lg
+
+logger = lg.setup_logger()
+
+# Small asyncio HTTP/1.1 server for the webhook, health and metrics endpoints, one request per connection
+MAX_BODY = 1 << 20
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# A request that can't be read, answered with its status
+class RequestError(Exception):
+    def __init__(self, status):
+        super().__init__(REASONS[status])
+        self.status = status
+
+class HttpServer:
+    # routes maps a path to an async handler(request) returning (status, body, content type)
+    def __init__(self, routes, host='0.0.0.0', port=8080):
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port 0 picks a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    # Wait until no request is being handled, the server keeps accepting new ones
+    async def wait_idle(self):
+        await self._idle.wait()
+
+    # Stop accepting connections and wait for requests being handled
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        await self._idle.wait()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        if not request_line:
+            return None
+        parts = request_line.split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise RequestError(400)
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise RequestError(400)
+        length = int(length)
+        if length > MAX_BODY:
+            raise RequestError(413)
+        body = await reader.readexactly(length) if length else b''
+        return SimpleNamespace(method=method, path=target.split('?', 1)[0], headers=headers, body=body)
+
+    async def _handle(self, reader, writer):
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), 30)
+            except RequestError as e:
+                request, response = None, (e.status, b'', 'text/plain')
+            else:
+                response = await self._dispatch(request) if request else None
+            if response:
+                await self._write_response(writer, *response)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    async def _dispatch(self, request):
+        handler = self.routes.get(request.path)
+        if handler is None:
+            return 404, b'', 'text/plain'
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f'function _dispatch:{request.path}:{e}')
+            return 500, b'', 'text/plain'
+
+    async def _write_response(self, writer, status, body, content_type):
+        if isinstance(body, str):
+            body = body.encode()
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
@@ -0,0 +1,280 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import bot.async_google_sheet as ags
+import bot.google_sheet as gs
+import bot.sheets_quota as sheets_quota
+import bot.logger as lg
+
+# Durable write-behind journal of sheet writes, entries are acknowledged once they are on disk
+# and a background flusher sends them to Google Sheets in one batchUpdate per sheet
+JOURNAL_DB = os.getenv("JOURNAL_DB", "journal.db")
+# Seconds between flushes when nothing new is appended
+FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "2"))
+# Failed writes are retried with exponential backoff up to this many times, then kept as dead
+# letters and the user is told. Writes the API refuses are dead letters at once
+MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "50"))
+MAX_BACKOFF = 300
+# Entries sent per sheet in one batchUpdate
+FLUSH_BATCH_SIZE = 200
+# Sheets flushed at the same time
+FLUSH_CONCURRENCY = int(os.getenv("JOURNAL_FLUSH_CONCURRENCY", "4"))
+# Flushed entries are kept this long for idempotency checks
+RETENTION = 7 * 24 * 3600
+
+logger = lg.setup_logger()
+
+_conn = None
+_conn_lock = threading.Lock()
+_wakeup = None
+# async notify(chat_id, error) called for entries that became dead letters
+_notify = None
+
+def _open(path):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # the user is told the entry is saved once it is in the journal, so sync every commit
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute('''CREATE TABLE IF NOT EXISTS journal(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key VARCHAR(255) UNIQUE,
+        sheet_id VARCHAR(255) NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        flushed_at REAL,
+        chat_id INTEGER,
+        dead_at REAL,
+        error TEXT);''')
+    # journals created before dead letters were kept
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(journal);")}
+    for column, column_type in (('chat_id', 'INTEGER'), ('dead_at', 'REAL'), ('error', 'TEXT')):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE journal ADD COLUMN {column} {column_type};")
+    conn.execute("CREATE INDEX IF NOT EXISTS journal_pending ON journal(flushed_at, next_attempt_at);")
+    return conn
+
+def _connect():
+    global _conn
+    if _conn is None:
+        _conn = _open(JOURNAL_DB)
+    return _conn
+
+# append the data of one values.batchUpdate, returns False if the key was already journaled.
+# chat_id is told if the entry can't be written
+def append(sheet_id, data, idempotency_key=None, chat_id=None):
+    with _conn_lock:
+        cursor = _connect().execute(
+            "INSERT OR IGNORE INTO journal(idempotency_key, sheet_id, data, created_at, chat_id) VALUES (?, ?, ?, ?, ?);",
+            (idempotency_key, sheet_id, json.dumps(data), time.time(), chat_id))
+        return cursor.rowcount == 1
+
+# entries waiting to be written, oldest first. A sheet backing off is skipped entirely
+# so its entries are always written in order
+def pending(limit=1000):
+    now = time.time()
+    with _conn_lock:
+        rows = _connect().execute(
+            """SELECT id, sheet_id, data FROM journal WHERE flushed_at IS NULL AND dead_at IS NULL
+            AND sheet_id NOT IN (SELECT sheet_id FROM journal WHERE flushed_at IS NULL AND dead_at IS NULL AND next_attempt_at > ?)
+            ORDER BY id LIMIT ?;""",
+            (now, limit)).fetchall()
+    return [(entry_id, sheet_id, json.loads(data)) for entry_id, sheet_id, data in rows]
+
+# check if a sheet still has entries that are not written yet
+def has_pending(sheet_id):
+    with _conn_lock:
+        row = _connect().execute(
+            "SELECT 1 FROM journal WHERE sheet_id = ? AND flushed_at IS NULL AND dead_at IS NULL LIMIT 1;",
+            (sheet_id,)).fetchone()
+    return row is not None
+
+def mark_flushed(ids):
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.executemany("UPDATE journal SET flushed_at = ? WHERE id = ?;", [(now, entry_id) for entry_id in ids])
+        conn.execute("DELETE FROM journal WHERE flushed_at < ?;", (now - RETENTION,))
+
+# back off the entries, those out of attempts become dead letters. Returns their chat ids
+def mark_failed(ids, error=None):
+    now = time.time()
+    dead = []
+    with _conn_lock:
+        conn = _connect()
+        for entry_id in ids:
+            attempts = conn.execute("SELECT attempts FROM journal WHERE id = ?;", (entry_id,)).fetchone()[0] + 1
+            delay = min(MAX_BACKOFF, 2 ** attempts)
+            conn.execute("UPDATE journal SET attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?;", (attempts, now + delay, error, entry_id))
+            if attempts >= MAX_ATTEMPTS:
+                dead.append(entry_id)
+    return mark_dead(dead, error)
+
+# keep entries that can't be written aside, they no longer hold back the sheet. Returns their chat ids
+def mark_dead(ids, error=None):
+    if not ids:
+        return []
+    now = time.time()
+    with _conn_lock:
+        conn = _connect()
+        conn.executemany("UPDATE journal SET dead_at = ?, error = ? WHERE id = ?;", [(now, error, entry_id) for entry_id in ids])
+        rows = conn.execute(f"SELECT DISTINCT chat_id FROM journal WHERE id IN ({','.join('?' * len(ids))}) AND chat_id IS NOT NULL;", ids).fetchall()
+    return [chat_id for chat_id, in rows]
+
+# entries that couldn't be written, of one sheet or of every sheet
+def dead_letters(sheet_id=None):
+    with _conn_lock:
+        rows = _connect().execute(
+            "SELECT id, sheet_id, chat_id, data, error, created_at FROM journal WHERE dead_at IS NOT NULL AND (? IS NULL OR sheet_id = ?) ORDER BY id;",
+            (sheet_id, sheet_id)).fetchall()
+    return [(entry_id, sheet_id, chat_id, json.loads(data), error, created_at) for entry_id, sheet_id, chat_id, data, error, created_at in rows]
+
+# The data of an entry written out of order, its Tracker mirror is dropped as it may be older than
+# the entries written since and would move the mirror back
+def _without_mirror(data):
+    return json.dumps([item for item in json.loads(data) if item['range'] != gs.tracker_range])
+
+# write the dead letters of a sheet again, e.g. once the user has restored a deleted tab. Returns how many
+def requeue_dead(sheet_id):
+    with _conn_lock:
+        conn = _connect()
+        rows = conn.execute("SELECT id, data FROM journal WHERE sheet_id = ? AND dead_at IS NOT NULL;", (sheet_id,)).fetchall()
+        conn.executemany("UPDATE journal SET data = ?, dead_at = NULL, attempts = 0, next_attempt_at = 0 WHERE id = ?;",
+                         [(_without_mirror(data), entry_id) for entry_id, data in rows])
+        return len(rows)
+
+# Journal file of a worker of the multi-worker mode
+def worker_path(name):
+    root, extension = os.path.splitext(JOURNAL_DB)
+    return f'{root}.{name}{extension or ".db"}'
+
+# Move the entries not yet written from the journal file at path to the one at target. Returns how many
+def adopt(path, target):
+    source, destination = _open(path), _open(target)
+    try:
+        rows = source.execute(
+            "SELECT idempotency_key, sheet_id, data, created_at, chat_id, dead_at, error FROM journal WHERE flushed_at IS NULL ORDER BY id;").fetchall()
+        if rows:
+            with destination:
+                destination.execute("BEGIN")
+                destination.executemany(
+                    "INSERT OR IGNORE INTO journal(idempotency_key, sheet_id, data, created_at, chat_id, dead_at, error) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                    [(key, sheet_id, _without_mirror(data), *rest) for key, sheet_id, data, *rest in rows])
+            source.execute("DELETE FROM journal WHERE flushed_at IS NULL;")
+        return len(rows)
+    finally:
+        source.close()
+        destination.close()
+
+# Entries journaled by processes that no longer run, e.g. after BOT_WORKERS changed, are moved to a journal
+# that is flushed: worker-0's of count workers, or the single process's. Run before the workers start.
+# Returns how many entries were moved
+def adopt_orphans(count=1):
+    root, extension = os.path.splitext(JOURNAL_DB)
+    paths = glob.glob(f'{glob.escape(root)}.worker-*{extension or ".db"}') + [JOURNAL_DB]
+    live = {worker_path(f'worker-{index}') for index in range(count)} if count > 1 else {JOURNAL_DB}
+    target = worker_path('worker-0') if count > 1 else JOURNAL_DB
+    moved = 0
+    for path in paths:
+        if path not in live and os.path.exists(path):
+            moved += adopt(path, target)
+    if moved:
+        logger.warning(f'Moved {moved} unwritten journal entries to {target}')
+    return moved
+
+# Merge the data of several entries, a later write to the same range wins
+def merge_data(batches):
+    merged = {}
+    for data in batches:
+        for item in data:
+            merged.pop(item['range'], None)
+            merged[item['range']] = item
+    return list(merged.values())
+
+# Flush without waiting for the next interval
+def wake():
+    if _wakeup is not None:
+        _wakeup.set()
+
+# Journal a write and wake the flusher
+async def record(sheet_id, data, idempotency_key=None, chat_id=None):
+    appended = await ags.run(append, sheet_id, data, idempotency_key, chat_id, timeout=None)
+    wake()
+    return appended
+
+async def _notify_dead(chat_ids, error):
+    if _notify is None:
+        return
+    for chat_id in chat_ids:
+        try:
+            await _notify(chat_id, error)
+        except Exception as e:
+            logger.error(f'function _notify_dead:{chat_id}:{e}')
+
+async def flush_sheet(sheet_id, entries):
+    ids = [entry_id for entry_id, _ in entries]
+    try:
+        await ags.batch_update(sheet_id, merge_data([data for _, data in entries]))
+    except Exception as e:
+        refused = sheets_quota.is_client_error(e)
+        if refused and len(entries) > 1:
+            # one refused entry fails the whole batch, write them one by one to find it
+            for entry in entries:
+                await flush_sheet(sheet_id, [entry])
+            return
+        logger.error(f'function flush_sheet:{sheet_id}:{e}')
+        dead = await ags.run(mark_dead if refused else mark_failed, ids, str(e), timeout=None)
+        await _notify_dead(dead, str(e))
+        return
+    await ags.run(mark_flushed, ids, timeout=None)
+
+async def _flush_sheet_bounded(sheet_id, entries, semaphore):
+    async with semaphore:
+        await flush_sheet(sheet_id, entries)
+
+# Write every pending entry, each sheet in one batchUpdate, at most FLUSH_CONCURRENCY sheets at a time
+async def flush_pending():
+    entries_by_sheet = {}
+    for entry_id, sheet_id, data in await ags.run(pending):
+        entries = entries_by_sheet.setdefault(sheet_id, [])
+        if len(entries) < FLUSH_BATCH_SIZE:
+            entries.append((entry_id, data))
+    semaphore = asyncio.Semaphore(FLUSH_CONCURRENCY)
+    await asyncio.gather(*(_flush_sheet_bounded(sheet_id, entries, semaphore) for sheet_id, entries in entries_by_sheet.items()))
+
+# Wait until every entry of a sheet is written, False if some are still pending after timeout seconds
+async def wait_flushed(sheet_id, timeout=10):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while await ags.run(has_pending, sheet_id):
+        if loop.time() >= deadline:
+            return False
+        wake()
+        await asyncio.sleep(0.2)
+    return True
+
+# Background flusher, the first pass replays whatever was left unflushed by the last run.
+# notify(chat_id, error) tells a user one of their entries couldn't be written
+async def run_flusher(notify=None):
+    global _wakeup, _notify
+    _wakeup = asyncio.Event()
+    _notify = notify
+    # interactive reads are served before journal writes
+    sheets_quota.priority.set(sheets_quota.BACKGROUND)
+    while True:
+        try:
+            await flush_pending()
+        except Exception as e:
+            logger.error(f'function run_flusher:{e}')
+        try:
+            await asyncio.wait_for(_wakeup.wait(), FLUSH_INTERVAL)
+            # let entries arriving together go out in the same batch
+            await asyncio.sleep(0.2)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
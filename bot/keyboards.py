@@ -0,0 +1,96 @@
+import hashlib
+import os
+import re
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from bot.cache import TTLCache
+
+# Inline keyboards of option lists. A list is registered under a short id derived from its options,
+# so the same Dropdown values always get the same id, and each button carries '{list id}:{index}'
+# as callback data instead of its label, which could be over Telegram's 64 bytes.
+# Built markups are cached per list and page, editing the Dropdown makes a new list id
+KEYBOARD_CACHE_TTL = float(os.getenv("KEYBOARD_CACHE_TTL", "86400"))
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "10000"))
+# Options per page, footer buttons such as << Back are on every page
+PAGE_SIZE = 8
+PREVIOUS_PAGE = '‹ Prev'
+NEXT_PAGE = 'Next ›'
+DATA_PATTERN = re.compile(r'^([0-9a-f]{10}):(p?)(\d+)$')
+
+# list id -> (options, footer)
+option_lists = TTLCache(maxsize=KEYBOARD_CACHE_SIZE, ttl=KEYBOARD_CACHE_TTL)
+# Keeps the lists across restarts, with save_keyboard(list id, options, footer) and async load_keyboard(list id),
+# set to the application's persistence so keyboards sent in a persisted conversation still answer
+store = None
+# Lists saved to the store within the hour, a list in use is saved again so the store keeps it
+KEYBOARD_RESAVE_INTERVAL = 3600
+saved_lists = TTLCache(maxsize=KEYBOARD_CACHE_SIZE, ttl=KEYBOARD_RESAVE_INTERVAL)
+# (list id, page) -> InlineKeyboardMarkup
+markup_cache = TTLCache(maxsize=KEYBOARD_CACHE_SIZE, ttl=KEYBOARD_CACHE_TTL)
+
+def list_id(options, footer=()):
+    text = '\x1f'.join(options) + '\x1e' + '\x1f'.join(footer)
+    return hashlib.blake2b(text.encode(), digest_size=5).hexdigest()
+
+def _build(key, options, footer, page):
+    pages = max(1, -(-len(options) // PAGE_SIZE))
+    first = page * PAGE_SIZE
+    rows = [[InlineKeyboardButton(option, callback_data=f'{key}:{index}')]
+            for index, option in enumerate(options[first:first + PAGE_SIZE], first)]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(PREVIOUS_PAGE, callback_data=f'{key}:p{page - 1}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton(NEXT_PAGE, callback_data=f'{key}:p{page + 1}'))
+    if navigation:
+        rows.append(navigation)
+    rows.extend([InlineKeyboardButton(label, callback_data=f'{key}:{index}')]
+                for index, label in enumerate(footer, len(options)))
+    return InlineKeyboardMarkup(rows)
+
+# Keyboard of a page of options, one button per row
+def markup(options, footer=(), page=0):
+    options, footer = tuple(options), tuple(footer)
+    key = list_id(options, footer)
+    if store is not None and saved_lists.get(key) is None:
+        store.save_keyboard(key, options, footer)
+        saved_lists.set(key, True)
+    option_lists.set(key, (options, footer))
+    return markup_cache.get_or_load((key, page), lambda: _build(key, options, footer, page))
+
+# Another page of the keyboard a page button belongs to
+def page_markup(key, page):
+    registered = option_lists.get(key)
+    if registered is None:
+        return None
+    options, footer = registered
+    return markup_cache.get_or_load((key, page), lambda: _build(key, options, footer, page))
+
+# Load the list callback data belongs to from the store when it is not registered, e.g. after a restart
+async def restore(data):
+    match = DATA_PATTERN.match(data or '')
+    if match is None or store is None or option_lists.get(match[1]) is not None:
+        return
+    registered = await store.load_keyboard(match[1])
+    if registered is not None:
+        option_lists.set(match[1], registered)
+
+def is_keyboard_data(data):
+    return DATA_PATTERN.match(data or '') is not None
+
+# Resolve callback data to ('option', label) or ('page', (list id, page)), None if the keyboard is
+# no longer registered nor in the store
+def resolve(data):
+    match = DATA_PATTERN.match(data or '')
+    if match is None:
+        return None
+    key, is_page, number = match[1], match[2], int(match[3])
+    if is_page:
+        return 'page', (key, number)
+    registered = option_lists.get(key)
+    if registered is None:
+        return None
+    options, footer = registered
+    labels = options + footer
+    if number >= len(labels):
+        return None
+    return 'option', labels[number]
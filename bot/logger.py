@@ -1,20 +1,122 @@
+import atexit
+import contextvars
+import copy
+import datetime as dt
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import bot.metrics as metrics
 
-def setup_logger():
-    # Create a logger instance
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.WARNING)
+# Records are put on a bounded queue and written by a background thread, so logging never does disk
+# I/O on the caller's thread. When the queue is full records are dropped and counted instead of waiting
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Rotate when the file reaches LOG_MAX_BYTES, or on LOG_ROTATE_WHEN (e.g. midnight) when it is set
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+CONTEXT_FIELDS = ('correlation_id', 'update_id', 'user_id', 'sheet_id')
+
+# Fields added to every record logged in the current context, set per Telegram update and
+# carried into the Sheets and storage executors with the rest of the context
+log_context = contextvars.ContextVar('log_context', default={})
+
+def bind(**fields):
+    log_context.set({**log_context.get(), **fields})
+
+# One JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+# Adds the context fields to the record on the caller's thread and drops it if the queue is full.
+# The message is merged with its arguments before queuing, formatting is left to the writer thread
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for field, value in log_context.get().items():
+            setattr(record, field, value)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log_records_dropped_total')
 
-    # Create a file handler
-    file_handler = logging.FileHandler('app.log', mode='a')
-    file_handler.setLevel(logging.WARNING)
+queue_handler = ContextQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+listener = None
 
-    # Create a formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+def build_file_handler(path):
+    if LOG_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    handler.setFormatter(JsonFormatter())
+    return handler
 
-    # Set the formatter for the handlers
-    file_handler.setFormatter(formatter)
+# Start the writer thread, records queued before it starts are written then
+def start_listener(path=LOG_FILE):
+    global listener
+    stop_listener()
+    listener = logging.handlers.QueueListener(queue_handler.queue, build_file_handler(path), respect_handler_level=True)
+    listener.start()
+
+# Write what is queued and close the file
+def stop_listener():
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+# The writer thread doesn't survive a fork, a forked process gets a new queue and writer
+def _after_fork():
+    global listener
+    was_listening = listener is not None
+    listener = None
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    if was_listening:
+        start_listener()
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(stop_listener)
+
+def setup_logger():
+    # Create a logger instance
+    logger = logging.getLogger(__name__)
+    logger.setLevel(LOG_LEVEL)
+    # Shared by several modules, only attach the handlers once
+    if logger.handlers:
+        return logger
 
-    # Add the handlers to the logger
-    logger.addHandler(file_handler)
-    return logger
\ No newline at end of file
+    logger.addHandler(queue_handler)
+    # Count errors in the metrics
+    logger.addHandler(metrics.ErrorCountHandler())
+    if listener is None:
+        start_listener()
+    return logger
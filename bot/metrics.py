@@ -0,0 +1,188 @@
+import bisect
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+import bot.sheets_quota as sheets_quota
+
+# In-process metrics served in the Prometheus text format: latency histograms, error counters and
+# in-flight gauges of the Telegram handlers, Google Sheets calls and storage calls
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PATH = '/metrics'
+# Port of a standalone metrics server, in webhook mode /metrics is also served next to the webhook
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PREFIX = 'telebot'
+
+HELP = {
+    'handler_seconds': 'Time spent in a Telegram handler',
+    'handler_in_flight': 'Telegram handlers running',
+    'handler_exceptions_total': 'Exceptions raised out of a Telegram handler',
+    'sheets_call_seconds': 'Time spent in a Google Sheets function on the sheets executor',
+    'sheets_call_in_flight': 'Google Sheets functions running',
+    'sheets_call_exceptions_total': 'Exceptions raised by a Google Sheets function',
+    'sheets_request_seconds': 'Time of a single Google Sheets HTTP request, quota waits and retries included',
+    'sheets_request_in_flight': 'Google Sheets HTTP requests running',
+    'sheets_request_exceptions_total': 'Google Sheets HTTP requests that failed after their retries',
+    'storage_call_seconds': 'Time spent in a storage backend call',
+    'storage_call_in_flight': 'Storage backend calls running',
+    'storage_call_exceptions_total': 'Exceptions raised by a storage backend call',
+    'errors_logged_total': 'Errors logged, by the function that logged them',
+    'log_records_dropped_total': 'Log records dropped because the log queue was full',
+    'sheets_quota_total': 'Google Sheets quota events by request kind',
+    'job_sheets_total': 'Sheets a scheduled job went through, and those it changed',
+}
+
+_lock = threading.Lock()
+# (name, labels) -> [bucket counts..., +Inf count, sum]
+_histograms = {}
+_counters = defaultdict(int)
+_gauges = defaultdict(int)
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _histogram(key):
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+    return histogram
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        histogram = _histogram(key)
+        histogram[index] += 1
+        histogram[-1] += seconds
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+
+# Times a block into the {name}_seconds histogram, counts it in {name}_in_flight while it runs
+# and in {name}_exceptions_total when it raises. Kept to two lock acquisitions per block
+class timed:
+    __slots__ = ('histogram', 'gauge', 'exceptions', 'start')
+
+    def __init__(self, name, **labels):
+        labels = tuple(sorted(labels.items()))
+        self.histogram = (f'{name}_seconds', labels)
+        self.gauge = (f'{name}_in_flight', labels)
+        self.exceptions = (f'{name}_exceptions_total', labels)
+
+    def __enter__(self):
+        if METRICS_ENABLED:
+            with _lock:
+                _gauges[self.gauge] += 1
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if not METRICS_ENABLED:
+            return
+        seconds = time.perf_counter() - self.start
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with _lock:
+            _gauges[self.gauge] -= 1
+            histogram = _histogram(self.histogram)
+            histogram[index] += 1
+            histogram[-1] += seconds
+            if exc_type is not None:
+                _counters[self.exceptions] += 1
+
+# Wrap a function, sync or async, in timed(name, function=its name, **labels)
+def instrument(func, name, **labels):
+    labels.setdefault('function', func.__name__)
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return func(*args, **kwargs)
+    return wrapper
+
+# Time the callback of every handler of an application, conversation states included
+def instrument_handlers(application):
+    def wrap(handler):
+        if hasattr(handler, 'entry_points'):
+            for child in handler.entry_points + handler.fallbacks:
+                wrap(child)
+            for handlers in handler.states.values():
+                for child in handlers:
+                    wrap(child)
+        elif hasattr(handler, 'callback') and not hasattr(handler.callback, '__wrapped__'):
+            handler.callback = instrument(handler.callback, 'handler', function=handler.callback.__name__)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+# Counts errors logged through a logger by the function that logged them
+class ErrorCountHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record):
+        inc('errors_logged_total', function=record.funcName)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    text = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')) for name, value in labels)
+    return '{' + text + '}'
+
+def _help(lines, name, metric_type):
+    lines.append(f'# HELP {PREFIX}_{name} {HELP.get(name, name)}')
+    lines.append(f'# TYPE {PREFIX}_{name} {metric_type}')
+
+# Every metric in the Prometheus text exposition format
+def render():
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    with sheets_quota._stats_lock:
+        quota_stats = dict(sheets_quota.stats)
+    for stat, count in quota_stats.items():
+        kind, event = stat.split('_', 1)
+        counters[_key('sheets_quota_total', {'kind': kind, 'event': event})] = count
+
+    lines = []
+    seen = set()
+    for (name, labels), values in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            _help(lines, name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values):
+            cumulative += count
+            lines.append(f'{PREFIX}_{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{PREFIX}_{name}_sum{_labels(labels)} {values[-1]}')
+        lines.append(f'{PREFIX}_{name}_count{_labels(labels)} {cumulative}')
+    for metrics, metric_type in ((counters, 'counter'), (gauges, 'gauge')):
+        for (name, labels), value in sorted(metrics.items()):
+            if name not in seen:
+                seen.add(name)
+                _help(lines, name, metric_type)
+            lines.append(f'{PREFIX}_{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+# Route of the embedded HTTP server
+async def serve_metrics(request):
+    if request.method != 'GET':
+        return 405, b'', 'text/plain'
+    return 200, render().encode(), 'text/plain; version=0.0.4'
+
+def routes():
+    return {METRICS_PATH: serve_metrics} if METRICS_ENABLED else {}
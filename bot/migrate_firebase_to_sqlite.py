@@ -0,0 +1,15 @@
+import bot.firebase as firebase
+import bot.sql_db as sql_db
+
+# Copy every user, row tracker and import rule from Firebase into SQLite
+# Usage: python -m bot.migrate_firebase_to_sqlite
+def migrate():
+    users, trackers = firebase.export_users()
+    sql_db.import_users(users, trackers)
+    rules = firebase.export_import_rules()
+    sql_db.import_rules(rules)
+    return len(users), len(trackers), len(rules)
+
+if __name__ == '__main__':
+    user_count, tracker_count, rule_count = migrate()
+    print(f'Migrated {user_count} users, {tracker_count} row trackers and {rule_count} import rules to {sql_db.SQLITE_DB}')
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from telegram.ext import BasePersistence, PersistenceInput
+import bot.logger as lg
+
+# Conversation states and user_data kept in SQLite so a restart resumes conversations where they were,
+# with the option lists of the inline keyboards they were sent (bot.keyboards)
+PERSISTENCE_DB = os.getenv("PERSISTENCE_DB", "persistence.db")
+# Seconds between writes of changed state, changes in between are coalesced into one transaction
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "10"))
+# Conversations idle for longer are not resumed
+CONVERSATION_MAX_AGE = 24 * 3600
+
+logger = lg.setup_logger()
+
+class SQLitePersistence(BasePersistence):
+    # bot_data holds background tasks and is rebuilt on start, chat and callback data are unused
+    # path defaults to PERSISTENCE_DB, read when the persistence is built as each worker sets its own
+    def __init__(self, path=None, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.path = path or PERSISTENCE_DB
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        # changes waiting to be written, None deletes the row
+        self._user_changes = {}
+        self._conversation_changes = {}
+        self._keyboard_changes = {}
+        # users whose user_data was read from the database since start
+        self._loaded_users = set()
+        self._flush_task = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_data(
+                user_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL);''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS conversations(
+                name VARCHAR(255) NOT NULL,
+                key TEXT NOT NULL,
+                state BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY(name, key));''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS keyboards(
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL);''')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _load_conversations(self, name):
+        with self._conn_lock:
+            rows = self._connect().execute("SELECT key, state FROM conversations WHERE name = ? AND updated_at > ?;",
+                                           (name, time.time() - CONVERSATION_MAX_AGE)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def _load_user_data(self, user_id):
+        with self._conn_lock:
+            row = self._connect().execute("SELECT data FROM user_data WHERE user_id = ?;", (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _load_keyboard(self, key):
+        with self._conn_lock:
+            row = self._connect().execute("SELECT data FROM keyboards WHERE key = ?;", (key,)).fetchone()
+        return tuple(tuple(labels) for labels in json.loads(row[0])) if row else None
+
+    def _write(self, user_changes, conversation_changes, keyboard_changes):
+        now = time.time()
+        with self._conn_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO user_data(user_id, data) VALUES (?, ?);",
+                                 [(user_id, pickle.dumps(data)) for user_id, data in user_changes.items() if data is not None])
+                conn.executemany("DELETE FROM user_data WHERE user_id = ?;",
+                                 [(user_id,) for user_id, data in user_changes.items() if data is None])
+                conn.executemany("INSERT OR REPLACE INTO conversations(name, key, state, updated_at) VALUES (?, ?, ?, ?);",
+                                 [(name, key, pickle.dumps(state), now) for (name, key), state in conversation_changes.items() if state is not None])
+                conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?;",
+                                 [(name, key) for (name, key), state in conversation_changes.items() if state is None])
+                if keyboard_changes:
+                    conn.executemany("INSERT OR REPLACE INTO keyboards(key, data, updated_at) VALUES (?, ?, ?);",
+                                     [(key, json.dumps(lists), now) for key, lists in keyboard_changes.items()])
+                    # lists in use are saved again every hour, the others outlive their conversations by no more than a day
+                    conn.execute("DELETE FROM keyboards WHERE updated_at < ?;", (now - CONVERSATION_MAX_AGE,))
+
+    # write every queued change in one transaction
+    async def _flush_changes(self):
+        user_changes, self._user_changes = self._user_changes, {}
+        conversation_changes, self._conversation_changes = self._conversation_changes, {}
+        keyboard_changes, self._keyboard_changes = self._keyboard_changes, {}
+        if user_changes or conversation_changes or keyboard_changes:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, user_changes, conversation_changes, keyboard_changes)
+
+    # The application calls the update methods for everything changed since the last interval
+    # together, the changes are written once they have all been queued
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        try:
+            await self._flush_changes()
+        except Exception as e:
+            logger.error(f'function _flush_soon:{e}')
+
+    # Only active conversations are read on start, user_data is read per user on their next update
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        if user_data or user_id in self._user_changes:
+            return
+        stored = await asyncio.get_running_loop().run_in_executor(None, self._load_user_data, user_id)
+        if stored:
+            user_data.update(stored)
+
+    async def update_user_data(self, user_id, data):
+        self._loaded_users.add(user_id)
+        self._user_changes[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.add(user_id)
+        self._user_changes[user_id] = None
+        self._schedule_flush()
+
+    async def get_conversations(self, name):
+        return await asyncio.get_running_loop().run_in_executor(None, self._load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversation_changes[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    # (options, footer) of a keyboard's list id, written with the other changes
+    def save_keyboard(self, key, options, footer):
+        self._keyboard_changes[key] = (options, footer)
+        self._schedule_flush()
+
+    async def load_keyboard(self, key):
+        if key in self._keyboard_changes:
+            return self._keyboard_changes[key]
+        return await asyncio.get_running_loop().run_in_executor(None, self._load_keyboard, key)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_changes()
+        with self._conn_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # not stored
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
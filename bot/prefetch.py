@@ -0,0 +1,39 @@
+import asyncio
+import bot.async_google_sheet as ags
+import bot.row_tracker as rt
+import bot.logger as lg
+
+# What an entry needs is loaded when its conversation starts, while the user is still typing: the
+# Dropdown tab, which holds the categories, subcategories, payments and quick add settings, and the
+# row trackers. Both loads are single-flight, a step needing them before they finish waits for the
+# same read instead of starting another
+
+logger = lg.setup_logger()
+
+# sheet_id -> running prefetch, the reference also keeps the task from being garbage collected
+tasks = {}
+
+async def _prefetch(sheet_id):
+    try:
+        await asyncio.gather(ags.get_dropdown(sheet_id), ags.run(rt.ensure_trackers, sheet_id, timeout=None))
+    except Exception as e:
+        # the step needing the data reads it again and reports the error to the user
+        logger.error(f'function prefetch:{sheet_id}:{e}')
+
+def _done(sheet_id, task):
+    if tasks.get(sheet_id) is task:
+        del tasks[sheet_id]
+
+# Start loading the data of a sheet in the background, unless it is already being loaded
+def start(sheet_id):
+    if not sheet_id or sheet_id in tasks:
+        return
+    task = asyncio.create_task(_prefetch(sheet_id))
+    tasks[sheet_id] = task
+    task.add_done_callback(lambda task: _done(sheet_id, task))
+
+# Wait for the prefetch of a sheet if one is running, cancelling the waiter doesn't cancel it
+async def wait(sheet_id):
+    task = tasks.get(sheet_id)
+    if task is not None:
+        await asyncio.shield(task)
@@ -0,0 +1,87 @@
+import asyncio
+import datetime as dt
+import os
+import bot.async_google_sheet as ags
+import bot.google_sheet as gs
+import bot.row_tracker as rt
+import bot.sheets_quota as sheets_quota
+import bot.logger as lg
+
+# Month tabs are created a few days before their month starts, so the first entry of a month never
+# finds its tab missing. A tab is copied from the sheet's Template tab when it has one, else from the
+# latest month tab with the entries cleared, in one spreadsheets.batchUpdate per sheet
+MONTH_TEMPLATE_TAB = os.getenv("MONTH_TEMPLATE_TAB", "Template")
+MONTH_PROVISION_DAYS = int(os.getenv("MONTH_PROVISION_DAYS", "3"))
+PROVISION_CONCURRENCY = int(os.getenv("PROVISION_CONCURRENCY", "8"))
+MONTHS = [dt.date(2000, month, 1).strftime('%B') for month in range(1, 13)]
+# Cells the bot writes in a month tab as (first column, end column, end row), 0-indexed with the end
+# excluded: the day blocks in A:K from the first entry row down, the income rows of M:O and R
+ENTRY_CELLS = [(0, 11, None), (12, 15, 10), (17, 18, 10)]
+
+logger = lg.setup_logger()
+
+# Month whose tab is due, None when the next month is more than MONTH_PROVISION_DAYS away
+def due_month(current_datetime):
+    next_month = (current_datetime.replace(day=1) + dt.timedelta(days=32)).replace(day=1)
+    if (next_month.date() - current_datetime.date()).days > MONTH_PROVISION_DAYS:
+        return None
+    return next_month.strftime('%B')
+
+# Requests creating the tab of month from the tabs {title: properties} of a sheet, None if it exists
+def plan_month_tab(tabs, month):
+    if month in tabs:
+        return None
+    index = MONTHS.index(month)
+    source = tabs.get(MONTH_TEMPLATE_TAB)
+    copied_month = None
+    if source is None:
+        copied_month = next((MONTHS[index - offset] for offset in range(1, 12) if MONTHS[index - offset] in tabs), None)
+        if copied_month is None:
+            raise ValueError(f'No {MONTH_TEMPLATE_TAB} or month tab to create {month} from')
+        source = tabs[copied_month]
+
+    new_id = max(properties['sheetId'] for properties in tabs.values()) + 1
+    # right after the month before it
+    previous = tabs.get(MONTHS[index - 1])
+    requests = [{'duplicateSheet': {
+        'sourceSheetId': source['sheetId'],
+        'insertSheetIndex': previous['index'] + 1 if previous else len(tabs),
+        'newSheetId': new_id,
+        'newSheetName': month,
+    }}]
+    if copied_month:
+        for first_column, end_column, end_row in ENTRY_CELLS:
+            grid = {'sheetId': new_id, 'startRowIndex': gs.first_entry_row - 1,
+                    'startColumnIndex': first_column, 'endColumnIndex': end_column}
+            if end_row:
+                grid['endRowIndex'] = end_row
+            requests.append({'updateCells': {'range': grid, 'fields': 'userEnteredValue'}})
+        # the month's name in the header rows
+        requests.append({'findReplace': {'find': copied_month, 'replacement': month,
+                                         'range': {'sheetId': new_id, 'endRowIndex': gs.first_entry_row - 1}}})
+    return requests
+
+# Create the tab of month in a sheet if it is missing, returns True if it was created
+def provision_month_tab(sheet_id, month):
+    requests = plan_month_tab(gs.get_tabs(sheet_id), month)
+    if not requests:
+        return False
+    gs.update_spreadsheet(sheet_id, requests)
+    rt.day_index.invalidate((sheet_id, month))
+    return True
+
+async def provision_sheet(sheet_id, month, semaphore):
+    async with semaphore:
+        try:
+            return await ags.run(provision_month_tab, sheet_id, month)
+        except Exception as e:
+            logger.error(f'function provision_sheet:{sheet_id}:{e}')
+            return False
+
+# Create the tab of the coming month in every sheet, at most PROVISION_CONCURRENCY at a time at
+# background priority. Returns the number of tabs created
+async def run_provisioning(sheet_ids, month):
+    semaphore = asyncio.Semaphore(PROVISION_CONCURRENCY)
+    with sheets_quota.background():
+        results = await asyncio.gather(*(provision_sheet(sheet_id, month, semaphore) for sheet_id in sheet_ids))
+    return sum(results)
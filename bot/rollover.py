@@ -0,0 +1,36 @@
+import asyncio
+import os
+import bot.async_google_sheet as ags
+import bot.journal as journal
+import bot.row_tracker as rt
+import bot.sheets_quota as sheets_quota
+import bot.logger as lg
+from bot.sheet_lock import sheet_lock
+
+# Day rollover run at local midnight for every sheet: the previous day gets its SUM and the new day
+# its date before anyone logs an entry. The writes go through the journal at background priority,
+# so they are batched per sheet and wait for the Sheets quota behind interactive requests
+ROLLOVER_CONCURRENCY = int(os.getenv("ROLLOVER_CONCURRENCY", "8"))
+
+logger = lg.setup_logger()
+
+async def roll_over_sheet(sheet_id, current_datetime, semaphore):
+    async with semaphore:
+        try:
+            async with sheet_lock(sheet_id):
+                data = await ags.run(rt.roll_over_day, sheet_id, current_datetime, timeout=None)
+                if not data:
+                    return False
+                await journal.record(sheet_id, data, f'{sheet_id}:rollover:{current_datetime:%Y-%m-%d}')
+            return True
+        except Exception as e:
+            logger.error(f'function roll_over_sheet:{sheet_id}:{e}')
+            return False
+
+# Roll every sheet over to current_datetime's day, at most ROLLOVER_CONCURRENCY at a time.
+# Returns the number of sheets rolled over
+async def run_rollover(sheet_ids, current_datetime):
+    semaphore = asyncio.Semaphore(ROLLOVER_CONCURRENCY)
+    with sheets_quota.background():
+        results = await asyncio.gather(*(roll_over_sheet(sheet_id, current_datetime, semaphore) for sheet_id in sheet_ids))
+    return sum(results)
@@ -0,0 +1,138 @@
+import os
+import datetime as dt
+import bot.storage as db
+import bot.google_sheet as gs
+from bot.cache import TTLCache
+
+# Row trackers [day, others row, transport row, first row] are kept in the bot's store, the day as the
+# yyyymmdd date of the sheet's latest day (see gs.tracker_date).
+# The Tracker tab of the sheet is a mirror, written in the same batchUpdate as every entry.
+
+# (sheet_id, month) -> {day: (first row, last row)} of the days in a month tab, the latest
+# day has no last row yet. Kept up to date as entries are logged, rebuilt from column A when cold
+DAY_INDEX_TTL = float(os.getenv("DAY_INDEX_TTL", "3600"))
+DAY_INDEX_SIZE = int(os.getenv("DAY_INDEX_SIZE", "10000"))
+day_index = TTLCache(maxsize=DAY_INDEX_SIZE, ttl=DAY_INDEX_TTL)
+# Sheets whose trackers are known to be in the store, an entry then allocates its rows without reading them first
+known_trackers = TTLCache(maxsize=DAY_INDEX_SIZE, ttl=DAY_INDEX_TTL)
+
+# Whether trackers are behind others: an earlier day, or a row before theirs on the same day
+def trackers_behind(trackers, others):
+    now = dt.datetime.now()
+    date, other_date = gs.tracker_date(trackers[0], now), gs.tracker_date(others[0], now)
+    if date != other_date:
+        return date < other_date
+    return any(row < other_row for row, other_row in zip(trackers[1:], others[1:]))
+
+# Reload the trackers from the sheet into the store, e.g. after the user edits the Tracker tab.
+# The store stays the authority: a Tracker tab behind it, e.g. written out of order by another
+# worker, would hand out rows already used, it is only taken with force.
+# Returns the trackers in the store and whether they are the sheet's
+def reconcile_trackers(sheet_id, force=False):
+    sheet_trackers = gs.get_trackers(sheet_id)
+
+    def apply(trackers):
+        if trackers is not None and not force and trackers_behind(sheet_trackers, trackers):
+            return trackers
+        return sheet_trackers
+
+    trackers = db.update_trackers(sheet_id, apply)
+    return trackers, list(trackers) == list(sheet_trackers)
+
+def get_trackers(sheet_id):
+    trackers = db.get_trackers(sheet_id)
+    if trackers is None:
+        trackers, _ = reconcile_trackers(sheet_id)
+    return trackers
+
+# Make sure the trackers of a sheet are in the store, reloading them from the sheet when they are missing
+def ensure_trackers(sheet_id):
+    known_trackers.get_or_load(sheet_id, lambda: True if get_trackers(sheet_id) else None, negative_ttl=0)
+
+# Set the trackers in the store and the sheet
+def set_trackers(sheet_id, trackers):
+    db.set_trackers(sheet_id, trackers)
+    gs.batch_update(sheet_id, [gs.trackers_data(trackers)])
+
+# Allocate the rows of a transaction atomically in the store.
+# Returns the trackers before the transaction and the data to write to the sheet
+def allocate_transaction(sheet_id, current_datetime, row_data):
+    return allocate_transactions(sheet_id, [(current_datetime, row_data)])
+
+# Allocate a block of rows for several transactions [(datetime, row data)] in one update of the store
+def allocate_transactions(sheet_id, entries):
+    ensure_trackers(sheet_id)
+    plan = {}
+
+    def apply(trackers):
+        if trackers is None:
+            raise ValueError(f'No row trackers for sheet {sheet_id}')
+        plan['trackers'] = trackers
+        plan['data'], new_trackers = gs.plan_transactions(trackers, entries)
+        return new_trackers
+
+    new_trackers = db.update_trackers(sheet_id, apply)
+    days = {current_datetime.date() for current_datetime, _ in entries}
+    if len(days) > 1:
+        # several days were started, the index of their months is rebuilt on next use
+        for date in days:
+            day_index.invalidate((sheet_id, date.strftime('%B')))
+    elif new_trackers[0] != plan['trackers'][0]:
+        _index_new_day(sheet_id, entries[-1][0].strftime('%B'), entries[-1][0].day, new_trackers[3])
+    return plan['trackers'], plan['data']
+
+# Start current_datetime's day ahead of the first entry. Sheets already on that day are skipped, so
+# are sheets whose day has no entries, they stay on it until their next entry. Returns the data to
+# write to the sheet, None if there is nothing to do
+def roll_over_day(sheet_id, current_datetime):
+    plan = {'data': None}
+
+    def apply(trackers):
+        if trackers is None:
+            raise ValueError(f'No row trackers for sheet {sheet_id}')
+        day, other_row, transport_row, first_row = trackers
+        if gs.tracker_date(day, current_datetime) == current_datetime.date() or (other_row < first_row and transport_row < first_row):
+            return trackers
+        plan['data'], new_trackers = gs.plan_rollover(trackers, current_datetime)
+        plan['data'].append(gs.trackers_data(new_trackers))
+        return new_trackers
+
+    new_trackers = db.update_trackers(sheet_id, apply)
+    if plan['data']:
+        _index_new_day(sheet_id, current_datetime.strftime('%B'), current_datetime.day, new_trackers[3])
+    return plan['data']
+
+# Month tab the trackers point into, the month of the sheet's latest day
+def trackers_month(trackers, current_datetime):
+    return gs.tracker_date(trackers[0], current_datetime).strftime('%B')
+
+# Add a day starting at first_row, the day before it ends on the row above
+def _add_day(day_rows, day, first_row):
+    day_rows = dict(day_rows)
+    for other_day, (other_first, other_last) in list(day_rows.items()):
+        if other_last is None and other_first < first_row:
+            day_rows[other_day] = (other_first, first_row - 1)
+    day_rows[day] = (first_row, None)
+    return day_rows
+
+def _index_new_day(sheet_id, month, day, first_row):
+    key = (sheet_id, month)
+    day_rows = day_index.get(key)
+    if day_rows is None:
+        # a rebuild in progress may have read the sheet before this day
+        day_index.invalidate(key)
+    else:
+        day_index.set(key, _add_day(day_rows, day, first_row))
+
+# The date of the latest day may still be waiting in the journal, the trackers always know it
+def _load_day_rows(sheet_id, month, current_datetime):
+    day_rows = gs.get_day_rows(sheet_id, month)
+    trackers = get_trackers(sheet_id)
+    day, first_row = gs.tracker_date(trackers[0], current_datetime).day, trackers[3]
+    if trackers_month(trackers, current_datetime) == month and day_rows.get(day, (None,))[0] != first_row:
+        day_rows = _add_day(day_rows, day, first_row)
+    return day_rows
+
+# Rows of every day of a month tab
+def get_day_rows(sheet_id, month, current_datetime):
+    return day_index.get_or_load((sheet_id, month), lambda: _load_day_rows(sheet_id, month, current_datetime))
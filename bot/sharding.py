@@ -0,0 +1,224 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import signal
+import time
+from telegram import Bot, Update
+import bot.journal as journal
+import bot.persistence as persistence
+import bot.webhook as webhook
+import bot.metrics as metrics
+import bot.logger as lg
+
+# Multi-worker mode: a router process receives updates and hands each one to the worker process
+# that owns the sender, picked by consistent hashing on the Telegram user id. A worker keeps the
+# conversation state and caches of its users, so one user's updates always go to the same worker.
+# Virtual nodes per worker, more spread users more evenly
+RING_REPLICAS = 128
+# Seconds a worker gets to finish its queued updates on shutdown
+WORKER_STOP_TIMEOUT = 30
+# Seconds between checks that every worker is alive, a worker that keeps dying is restarted at most
+# once per WORKER_RESTART_DELAY seconds
+WORKER_CHECK_INTERVAL = 1
+WORKER_RESTART_DELAY = 5
+
+logger = lg.setup_logger()
+
+# Name of this process' worker, None outside of worker processes
+worker_name = None
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+# Consistent hash ring, adding or removing a node only moves the keys of that node
+class HashRing:
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f'{node}#{replica}')
+            if point in self._owners:
+                continue
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f'{node}#{replica}')
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.pop(bisect.bisect_left(self._points, point))
+
+    def nodes(self):
+        return set(self._owners.values())
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError('No nodes in the hash ring')
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
+
+# Sender of an update in its JSON form, updates without one (e.g. channel posts) are keyed by chat
+def user_id_of(data):
+    for value in data.values():
+        if isinstance(value, dict):
+            if 'from' in value:
+                return value['from']['id']
+            if 'user' in value:
+                return value['user']['id']
+            if 'chat' in value:
+                return value['chat']['id']
+    return data.get('update_id', 0)
+
+# Worker processes fed through one queue each
+class WorkerPool:
+    # target(name, inbox) is run in each worker process
+    def __init__(self, target, count=0):
+        self.target = target
+        self.ring = HashRing()
+        self.workers = {}
+        self.started_at = {}
+        self._next_index = 0
+        for _ in range(count):
+            self.add_worker()
+
+    def _start(self, name, inbox):
+        process = multiprocessing.Process(target=self.target, args=(name, inbox), name=name, daemon=True)
+        process.start()
+        self.workers[name] = (process, inbox)
+        self.started_at[name] = time.monotonic()
+
+    def add_worker(self):
+        name = f'worker-{self._next_index}'
+        self._next_index += 1
+        self._start(name, multiprocessing.Queue())
+        self.ring.add(name)
+        return name
+
+    # Start workers that died again under the same name and inbox, so their users stay on them and
+    # the updates queued meanwhile are served. The updates a worker was handling when it died are lost.
+    # Returns the names of the workers restarted
+    def restart_dead(self):
+        restarted = []
+        for name, (process, inbox) in list(self.workers.items()):
+            if process.is_alive() or time.monotonic() - self.started_at[name] < WORKER_RESTART_DELAY:
+                continue
+            logger.error(f'function restart_dead:{name} exited with code {process.exitcode}, restarting it')
+            process.join()
+            self._start(name, inbox)
+            restarted.append(name)
+        return restarted
+
+    # The worker's users move to the other workers, it finishes what is already queued
+    def remove_worker(self, name):
+        self.ring.remove(name)
+        process, inbox = self.workers.pop(name)
+        self.started_at.pop(name, None)
+        inbox.put(None)
+        process.join(WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+
+    def dispatch(self, data):
+        name = self.ring.node_for(user_id_of(data))
+        self.workers[name][1].put(data)
+
+    def close(self):
+        for name in list(self.workers):
+            self.remove_worker(name)
+
+# Entry point of a bot worker: an application without an updater, fed by the router
+def run_worker(name, inbox):
+    global worker_name
+    worker_name = name
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # each worker flushes its own journal, the writes of one user keep their order. Users sharing a
+    # sheet may be on different workers, their writes then reach the sheet in either order
+    journal.JOURNAL_DB = journal.worker_path(name)
+    # and keeps the conversations of its users in its own file, workers never load each other's
+    root, extension = os.path.splitext(persistence.PERSISTENCE_DB)
+    persistence.PERSISTENCE_DB = f'{root}.{name}{extension or ".db"}'
+    # and rotates its own log file
+    root, extension = os.path.splitext(lg.LOG_FILE)
+    lg.start_listener(f'{root}.{name}{extension or ".log"}')
+    # and serves its own metrics on the port after the previous worker's
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += 1 + int(name.rsplit('-', 1)[1])
+    from bot.telegram_bot import build_application
+    asyncio.run(_serve_inbox(build_application(), inbox))
+
+async def _serve_inbox(application, inbox):
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Restart dead workers until cancelled
+async def _supervise(pool):
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        try:
+            pool.restart_dead()
+        except Exception as e:
+            logger.error(f'function _supervise:{e}')
+
+# Long-poll getUpdates in the router until stop is set
+async def _poll_updates(bot, dispatch, stop):
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except Exception as e:
+            logger.error(f'function _poll_updates:{e}')
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+# Run the router with count workers, over the webhook server or long polling
+async def run_router(token, count, mode='polling'):
+    # the journals of workers from a larger pool or of the single process are flushed by worker-0
+    journal.adopt_orphans(count)
+    pool = WorkerPool(run_worker, count)
+    supervisor = asyncio.create_task(_supervise(pool))
+    print(f"Routing updates to {count} workers")
+    async with Bot(token) as bot:
+        try:
+            if mode == 'webhook':
+                async def enqueue(data):
+                    pool.dispatch(data)
+                await webhook.serve(enqueue, bot)
+            else:
+                await bot.delete_webhook()
+                stop = asyncio.Event()
+                loop = asyncio.get_running_loop()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.add_signal_handler(sig, stop.set)
+                poller = asyncio.create_task(_poll_updates(bot, pool.dispatch, stop))
+                await stop.wait()
+                poller.cancel()
+        finally:
+            supervisor.cancel()
+            await asyncio.get_running_loop().run_in_executor(None, pool.close)
@@ -0,0 +1,13 @@
+import asyncio
+import weakref
+
+# One lock per sheet, dropped once no coroutine holds or waits on it
+_locks = weakref.WeakValueDictionary()
+
+# Serializes row allocation and entry writes of a sheet, different sheets still run in parallel
+def sheet_lock(sheet_id):
+    lock = _locks.get(sheet_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[sheet_id] = lock
+    return lock
@@ -0,0 +1,111 @@
+import contextlib
+import contextvars
+import os
+import random
+import socket
+import threading
+import time
+from collections import Counter
+
+# Google Sheets allows a number of read and write requests per minute, requests wait for a
+# token of their kind and are retried with exponential backoff and jitter on 429 and 5xx
+READ_QUOTA = int(os.getenv("SHEETS_READ_QUOTA", "60"))
+WRITE_QUOTA = int(os.getenv("SHEETS_WRITE_QUOTA", "60"))
+MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+BASE_BACKOFF = 1
+MAX_BACKOFF = 32
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+READ = 'read'
+WRITE = 'write'
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Priority of the Sheets calls made in the current context, background work sets BACKGROUND
+priority = contextvars.ContextVar('sheets_priority', default=INTERACTIVE)
+
+# Time (monotonic) after which no retry is started, set by callers that give up at a deadline
+deadline = contextvars.ContextVar('sheets_deadline', default=None)
+
+# Counters of requests, throttled requests (waited for a token), retries and failures by kind
+stats = Counter()
+_stats_lock = threading.Lock()
+
+def _count(name, kind):
+    with _stats_lock:
+        stats[f'{kind}_{name}'] += 1
+
+# Token bucket where interactive callers are always served before background ones
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60
+        self.capacity = max(1, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.waiting = [0, 0]
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Take a token, returns True if the caller had to wait for it
+    def acquire(self, level=INTERACTIVE):
+        with self._condition:
+            self.waiting[level] += 1
+            throttled = False
+            try:
+                while True:
+                    self._refill()
+                    ahead = level == BACKGROUND and self.waiting[INTERACTIVE] > 0
+                    if self.tokens >= 1 and not ahead:
+                        self.tokens -= 1
+                        return throttled
+                    throttled = True
+                    self._condition.wait(max(0.01, (1 - self.tokens) / self.rate))
+            finally:
+                self.waiting[level] -= 1
+                self._condition.notify_all()
+
+buckets = {READ: TokenBucket(READ_QUOTA), WRITE: TokenBucket(WRITE_QUOTA)}
+
+@contextlib.contextmanager
+def background():
+    token = priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+# googleapiclient is imported when a request fails, not with the bot
+def _should_retry(error):
+    from googleapiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRY_STATUSES
+    return isinstance(error, (socket.timeout, ConnectionError, TimeoutError))
+
+# A request the API refused, e.g. a range in a deleted tab, sending it again won't help
+def is_client_error(error):
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and 400 <= error.resp.status < 500 and error.resp.status not in RETRY_STATUSES
+
+# Run one Sheets request within quota, retrying throttled and failed requests
+def execute(send, kind):
+    _count('requests', kind)
+    attempt = 0
+    while True:
+        if buckets[kind].acquire(priority.get()):
+            _count('throttled', kind)
+        try:
+            return send()
+        except Exception as e:
+            # full jitter backoff, no retry is started that would end past the deadline
+            backoff = random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+            past_deadline = deadline.get() is not None and time.monotonic() + backoff > deadline.get()
+            if attempt >= MAX_RETRIES or past_deadline or not _should_retry(e):
+                _count('failed', kind)
+                raise
+        _count('retried', kind)
+        time.sleep(backoff)
+        attempt += 1
@@ -1,10 +1,37 @@
 # Import module
+import os
 import sqlite3
-import datetime as dt
+import threading
+from bot.cache import TTLCache
+
+# telegram_id -> sheet_id cache in front of the database. Unlike Firebase nothing tells other
+# instances sharing the file that a user linked another sheet, so entries are kept for a minute
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+NEGATIVE_CACHE_TTL = 60
+sheet_id_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Path of the database file
+SQLITE_DB = os.getenv("SQLITE_DB", "user-tele.db")
+
+# one long-lived connection per thread, sqlite3 connections can't be shared between threads
+_local = threading.local()
+_tables_lock = threading.Lock()
+_tables_created = False
 
 # build connection to database
 def connect_to_db():
-	conn = sqlite3.connect('user-tele.db')
+	global _tables_created
+	conn = getattr(_local, 'conn', None)
+	if conn is None:
+		conn = sqlite3.connect(SQLITE_DB)
+		conn.execute("PRAGMA journal_mode=WAL;")
+		conn.execute("PRAGMA synchronous=NORMAL;")
+		_local.conn = conn
+		with _tables_lock:
+			if not _tables_created:
+				first_time_only()
+				_tables_created = True
 	return conn
 
 # creating table, first time use only
@@ -17,32 +44,129 @@ def first_time_only():
 		sheet_id VARCHAR(255));'''
 		cursor.execute(user_table)
 
+		tracker_table = '''CREATE TABLE IF NOT EXISTS tracker_table(
+		sheet_id VARCHAR(255) PRIMARY KEY,
+		day_tracker INTEGER,
+		other_row_tracker INTEGER,
+		transport_row_tracker INTEGER,
+		first_row INTEGER);'''
+		cursor.execute(tracker_table)
+
+		import_rule_table = '''CREATE TABLE IF NOT EXISTS import_rule_table(
+		telegram_id VARCHAR(255),
+		keyword VARCHAR(255),
+		category VARCHAR(255),
+		payment VARCHAR(255),
+		PRIMARY KEY(telegram_id, keyword));'''
+		cursor.execute(import_rule_table)
+
 # drop table
 def drop_table():
 	with connect_to_db() as conn:
 		cursor = conn.cursor()
 		cursor.execute("DROP TABLE IF EXISTS user_table;")
+		cursor.execute("DROP TABLE IF EXISTS tracker_table;")
+		cursor.execute("DROP TABLE IF EXISTS import_rule_table;")
 
 # first time user, create db records
 def new_user_setup(telegram_id, sheet_id):
 	with connect_to_db() as conn:
 		cursor = conn.cursor()
-		day = dt.datetime.now().day
 		cursor.execute("INSERT OR REPLACE INTO user_table(telegram_id, sheet_id) VALUES (?, ?);", (telegram_id, sheet_id))
-		cursor.execute("INSERT OR REPLACE INTO tracker_table(telegram_id, transport_row_tracker, other_row_tracker, day_row_tracker, first_row) VALUES (?, ?, ?, ?, ?);", (telegram_id, day, 5, 5, 5))
 		conn.commit()
+		sheet_id_cache.set(str(telegram_id), sheet_id)
 		return cursor.lastrowid
 
 # check if user exists
 def check_if_user_exists(telegram_id):
+	return get_user_sheet_id(telegram_id) is not None
+
+def _load_user_sheet_id(telegram_id):
 	with connect_to_db() as conn:
 		cursor = conn.cursor()
-		cursor.execute("SELECT * FROM user_table WHERE telegram_id = ?", (telegram_id,))
-		return bool(cursor.fetchone())
+		cursor.execute("SELECT sheet_id FROM user_table WHERE telegram_id = ?", (telegram_id,))
+		row = cursor.fetchone()
+		return row[0] if row else None
 
 # get user sheet id
 def get_user_sheet_id(telegram_id):
+	return sheet_id_cache.get_or_load(str(telegram_id), lambda: _load_user_sheet_id(telegram_id), negative_ttl=NEGATIVE_CACHE_TTL)
+
+# drop a user from the cache, the next lookup reads the database
+def forget_user(telegram_id):
+	sheet_id_cache.invalidate(str(telegram_id))
+
+# get sheet row trackers, [day, others row, transport row, first row]
+def get_trackers(sheet_id):
 	with connect_to_db() as conn:
 		cursor = conn.cursor()
-		cursor.execute("SELECT sheet_id FROM user_table WHERE telegram_id = ?", (telegram_id,))
-		return cursor.fetchone()[0]
+		cursor.execute("SELECT day_tracker, other_row_tracker, transport_row_tracker, first_row FROM tracker_table WHERE sheet_id = ?", (sheet_id,))
+		row = cursor.fetchone()
+		return list(row) if row else None
+
+# set sheet row trackers
+def set_trackers(sheet_id, trackers):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("INSERT OR REPLACE INTO tracker_table(sheet_id, day_tracker, other_row_tracker, transport_row_tracker, first_row) VALUES (?, ?, ?, ?, ?);", (sheet_id, *trackers))
+		conn.commit()
+
+# atomically replace the row trackers with update_fn(current trackers)
+def update_trackers(sheet_id, update_fn):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("BEGIN IMMEDIATE")
+		cursor.execute("SELECT day_tracker, other_row_tracker, transport_row_tracker, first_row FROM tracker_table WHERE sheet_id = ?", (sheet_id,))
+		row = cursor.fetchone()
+		trackers = update_fn(list(row) if row else None)
+		cursor.execute("INSERT OR REPLACE INTO tracker_table(sheet_id, day_tracker, other_row_tracker, transport_row_tracker, first_row) VALUES (?, ?, ?, ?, ?);", (sheet_id, *trackers))
+		conn.commit()
+		return trackers
+
+# every sheet with row trackers
+def get_tracked_sheets():
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT sheet_id FROM tracker_table")
+		return [row[0] for row in cursor.fetchall()]
+
+# bank statement import rules of a user, [(keyword, category, payment)]
+def get_import_rules(telegram_id):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT keyword, category, payment FROM import_rule_table WHERE telegram_id = ? ORDER BY keyword", (str(telegram_id),))
+		return cursor.fetchall()
+
+def set_import_rule(telegram_id, keyword, category, payment):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("INSERT OR REPLACE INTO import_rule_table(telegram_id, keyword, category, payment) VALUES (?, ?, ?, ?);", (str(telegram_id), keyword, category, payment))
+		conn.commit()
+
+# returns False if there was no such rule
+def delete_import_rule(telegram_id, keyword):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.execute("DELETE FROM import_rule_table WHERE telegram_id = ? AND keyword = ?;", (str(telegram_id), keyword))
+		conn.commit()
+		return cursor.rowcount > 0
+
+# nothing to listen to, the cache is updated on write
+def start_user_listener():
+	return None
+
+# bulk insert users and trackers, used when migrating from another store
+def import_users(users, trackers):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.executemany("INSERT OR REPLACE INTO user_table(telegram_id, sheet_id) VALUES (?, ?);", users)
+		cursor.executemany("INSERT OR REPLACE INTO tracker_table(sheet_id, day_tracker, other_row_tracker, transport_row_tracker, first_row) VALUES (?, ?, ?, ?, ?);", trackers)
+		conn.commit()
+	sheet_id_cache.clear()
+
+# bulk insert import rules [(telegram_id, keyword, category, payment)]
+def import_rules(rules):
+	with connect_to_db() as conn:
+		cursor = conn.cursor()
+		cursor.executemany("INSERT OR REPLACE INTO import_rule_table(telegram_id, keyword, category, payment) VALUES (?, ?, ?, ?);", rules)
+		conn.commit()
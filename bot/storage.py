@@ -0,0 +1,47 @@
+import asyncio
+import contextvars
+import functools
+import importlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import bot.metrics as metrics
+
+# Storage backend holding users and row trackers, chosen with STORAGE_BACKEND
+BACKENDS = {
+    'firebase': 'bot.firebase',
+    'sqlite': 'bot.sql_db',
+}
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firebase").lower()
+if STORAGE_BACKEND not in BACKENDS:
+    raise ValueError(f'Unknown STORAGE_BACKEND {STORAGE_BACKEND}, expected one of {", ".join(BACKENDS)}')
+backend = importlib.import_module(BACKENDS[STORAGE_BACKEND])
+
+def _timed(func):
+    return metrics.instrument(func, 'storage_call', backend=STORAGE_BACKEND)
+
+# Every backend provides the same functions, each call is timed in the storage metrics
+# users
+new_user_setup = _timed(backend.new_user_setup)
+check_if_user_exists = _timed(backend.check_if_user_exists)
+get_user_sheet_id = _timed(backend.get_user_sheet_id)
+forget_user = _timed(backend.forget_user)
+start_user_listener = _timed(backend.start_user_listener)
+# row trackers [day, others row, transport row, first row] by sheet
+get_trackers = _timed(backend.get_trackers)
+set_trackers = _timed(backend.set_trackers)
+update_trackers = _timed(backend.update_trackers)
+get_tracked_sheets = _timed(backend.get_tracked_sheets)
+# bank statement import rules [(keyword, category, payment)] by user
+get_import_rules = _timed(backend.get_import_rules)
+set_import_rule = _timed(backend.set_import_rule)
+delete_import_rule = _timed(backend.delete_import_rule)
+
+# Database calls get their own threads so they never wait behind Google Sheets calls
+STORAGE_MAX_WORKERS = int(os.getenv("STORAGE_MAX_WORKERS", "4"))
+executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+
+# Run a storage function without blocking the event loop
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(executor, call)
@@ -0,0 +1,74 @@
+import os
+import re
+from collections import defaultdict
+import bot.google_sheet as gs
+import bot.journal as journal
+import bot.row_tracker as rt
+from bot.cache import TTLCache
+
+# Monthly spend by category, subcategory, payment and day, read from the sheet in one batchGet.
+# Results are cached per (sheet_id, month, row trackers), any new entry moves the trackers
+SUMMARY_CACHE_TTL = float(os.getenv("SUMMARY_CACHE_TTL", "3600"))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "1024"))
+summary_cache = TTLCache(maxsize=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL)
+
+def _cell(row, index):
+    return str(row[index]).strip() if index < len(row) else ''
+
+# Aggregate the rows of a month tab in a single pass over them. Transport rows are
+# [price, from, to, type, payment], others are [price, remarks, 'category - subcategory', payment]
+def summarize(dates, transport_values, other_values):
+    totals = {'total': 0.0, 'count': 0, 'category': defaultdict(float), 'subcategory': defaultdict(float),
+              'payment': defaultdict(float), 'day': defaultdict(float)}
+    day = None
+    for index in range(max(len(dates), len(transport_values), len(other_values))):
+        date = _cell(dates[index], 0) if index < len(dates) else ''
+        if re.fullmatch(r'\d+(\.0+)?', date):
+            day = int(float(date))
+        entries = []
+        if index < len(transport_values):
+            row = transport_values[index]
+            entries.append((gs.parse_amount(_cell(row, 0)), 'Transport', _cell(row, 3), _cell(row, 4)))
+        if index < len(other_values):
+            row = other_values[index]
+            category, _, subcategory = _cell(row, 2).partition(' - ')
+            entries.append((gs.parse_amount(_cell(row, 0)), category, subcategory, _cell(row, 3)))
+        for amount, category, subcategory, payment in entries:
+            if amount is None:
+                continue
+            totals['total'] += amount
+            totals['count'] += 1
+            totals['category'][category or 'Uncategorised'] += amount
+            if subcategory:
+                totals['subcategory'][f'{category} - {subcategory}'] += amount
+            totals['payment'][payment or 'Unknown'] += amount
+            if day is not None:
+                totals['day'][day] += amount
+    for key in ('category', 'subcategory', 'payment', 'day'):
+        totals[key] = dict(totals[key])
+    return totals
+
+# Summary of a month, entries still waiting in the journal are not on the sheet yet so it is not cached then
+def get_summary(sheet_id, month):
+    key = (sheet_id, month, tuple(rt.get_trackers(sheet_id)))
+    summary = summary_cache.get(key)
+    if summary is None:
+        summary = summarize(*gs.get_month_entries(sheet_id, month))
+        if not journal.has_pending(sheet_id):
+            summary_cache.set(key, summary)
+    return summary
+
+def _section(title, amounts, sort_by_amount=True):
+    if not amounts:
+        return ''
+    items = sorted(amounts.items(), key=lambda item: -item[1]) if sort_by_amount else sorted(amounts.items())
+    return f'\n----{title}----\n' + ''.join(f'{name}: {amount:.2f}\n' for name, amount in items)
+
+def format_summary(month, summary):
+    if not summary['count']:
+        return f'No entries found for {month}.'
+    return (f"Summary for {month}\nTotal Spending: {summary['total']:.2f} ({summary['count']} entries)\n"
+            + _section('CATEGORY', summary['category'])
+            + _section('SUBCATEGORY', summary['subcategory'])
+            + _section('PAYMENT', summary['payment'])
+            + _section('DAY', summary['day'], sort_by_amount=False))
@@ -1,5 +1,9 @@
 import os
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import io
+import asyncio
+import uuid
+import functools
+from telegram import Update
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -7,11 +11,28 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
-import bot.firebase as db
+import bot.storage as db
 import bot.google_sheet as gs
+import bot.async_google_sheet as ags
+import bot.row_tracker as rt
+import bot.journal as journal
+import bot.summary as sm
+import bot.export as ex
+import bot.bank_import as bi
+import bot.keyboards as kb
+import bot.prefetch as prefetch
+import bot.webhook as webhook
+import bot.sharding as sharding
+import bot.rollover as rollover
+import bot.provisioning as provisioning
+import bot.metrics as metrics
+from bot.http_server import HttpServer
 from bot.common import EntryType
+from bot.sheet_lock import sheet_lock
+from bot.persistence import SQLitePersistence
 import re
 import pytz
 import datetime as dt
@@ -23,6 +44,18 @@ filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBU
 
 BOT_TOKEN = os.getenv("TRACKER_TELEGRAM_TOKEN")
 GOOGLE_API_EMAIL = os.getenv("GOOGLE_API_EMAIL")
+# Number of updates processed at the same time, Sheets calls no longer block each other
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# How updates are received, polling or webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Worker processes, above 1 a router shards updates between them by user id
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Keep the user cache fresh from a Firebase stream of /users
+USER_CACHE_LISTEN = os.getenv("USER_CACHE_LISTEN", "true").lower() == "true"
+# Most entries accepted by one /bulkadd
+BULK_MAX_LINES = 100
+# Seconds an /export may take, a full year is read in several pages
+EXPORT_TIMEOUT = 120
 logger = lg.setup_logger()
 
 # Local Timezone
@@ -35,13 +68,27 @@ CONFIG_PAYMENT, CONFIG_SUBPAYMENT, HANDLE_RETRIEVE_TRANSACTION, INCOME, WORK_PLA
     range(22)
 )
 
-# Create inline markup based on list of strings
-def create_inline_markup(list):
-    keyboard_markup_list = []
-    for reply in list:
-        keyboard_markup_list.append([InlineKeyboardButton(reply, callback_data=reply)])
-    
-    return InlineKeyboardMarkup(keyboard_markup_list)
+# Create inline markup based on list of strings, footer buttons are shown on every page
+def create_inline_markup(list, footer=()):
+    return kb.markup(list, footer)
+
+# Label of the button tapped. Page buttons turn the page and return None, which keeps the conversation in its state
+async def callback_reply(update: Update):
+    query = update.callback_query
+    if not kb.is_keyboard_data(query.data):
+        # buttons sent before keyboards were registered carry their label
+        return query.data
+    await kb.restore(query.data)
+    choice = kb.resolve(query.data)
+    markup = kb.page_markup(*choice[1]) if choice and choice[0] == 'page' else None
+    if choice is None or (choice[0] == 'page' and markup is None):
+        await query.answer('This menu has expired, please start again or /cancel.', show_alert=True)
+        return None
+    if markup is not None:
+        await query.answer()
+        await query.edit_message_reply_markup(markup)
+        return None
+    return choice[1]
 
 # Check price is valid
 def is_valid_price(price):
@@ -57,6 +104,65 @@ def check_date_format(date_string):
     camel_cased_date = f"{day} {month}"
     return bool(re.fullmatch(pattern, camel_cased_date))
 
+# Parse a /bulkadd line [price], [remarks], [category], [payment] into row data, a transport
+# type as category makes it a transport entry with [start], [end] as remarks
+def parse_bulk_line(line, dropdown):
+    parts = [part.strip() for part in line.split(',')]
+    if len(parts) < 4:
+        return None, 'please follow the format [price], [remarks], [category], [payment]'
+    price, remarks, category, payment = parts[0], ', '.join(parts[1:-2]), parts[-2], parts[-1]
+    if not price or not is_valid_price(price):
+        return None, f'{price} is not a valid price'
+    payment_value = gs.match_dropdown(payment, dropdown['payment'], dropdown['payment_sub'])
+    if payment_value is None:
+        return None, f'{payment} is not a payment type in your Dropdown sheet'
+    transport_type = gs.match_option(category, dropdown['transport'])
+    if transport_type:
+        if len(parts) != 5:
+            return None, 'transport entries need [price], [start], [end], [type], [payment]'
+        return [EntryType.TRANSPORT, price, remarks, transport_type, payment_value], None
+    category_value = gs.match_dropdown(category, dropdown['others'], dropdown['others_sub'])
+    if category_value is None:
+        return None, f'{category} is not a category in your Dropdown sheet'
+    return [EntryType.OTHERS, price, remarks, category_value, payment_value], None
+
+# Full month name from e.g. Mar or March, None if it isn't a month
+def parse_month(month):
+    for month_format in ('%b', '%B'):
+        try:
+            return dt.datetime.strptime(month.capitalize(), month_format).strftime('%B')
+        except ValueError:
+            pass
+    return None
+
+# Months and days of an export period such as Mar, Jan-Mar or 1 Mar - 15 Apr.
+# Returns [(month, first day, last day)] where None days are unbounded, or None if it can't be read
+def parse_period(text):
+    bounds = []
+    for part in text.split('-'):
+        words = part.split()
+        if len(words) == 1:
+            day, month = None, parse_month(words[0])
+        elif len(words) == 2 and words[0].isdigit():
+            day, month = int(words[0]), parse_month(words[1])
+        else:
+            return None
+        if month is None:
+            return None
+        bounds.append((month, day))
+    if len(bounds) == 1:
+        bounds.append(bounds[0])
+    if len(bounds) != 2:
+        return None
+    (first_month, first_day), (last_month, last_day) = bounds
+    months = [dt.date(2000, month, 1).strftime('%B') for month in range(1, 13)]
+    start = months.index(first_month)
+    span = (months.index(last_month) - start) % 12 + 1
+    periods = [[months[(start + offset) % 12], None, None] for offset in range(span)]
+    periods[0][1] = first_day
+    periods[-1][2] = last_day
+    return [tuple(period) for period in periods]
+
 # Set up text
 async def setup_text():
     text = ('Please set up your Google sheet by following the steps below.\n\n'+
@@ -71,18 +177,20 @@ async def setup_text():
 
 # Send category text
 async def get_category_text(sheet_id,entry_type):
+    await prefetch.wait(sheet_id)
     msg = ""
     markup_list = []
     if entry_type == EntryType.TRANSPORT:
         msg = "What type of transport is this?"
-        markup_list = gs.get_main_dropdown_value(sheet_id, EntryType.TRANSPORT)
+        markup_list = await ags.get_main_dropdown_value(sheet_id, EntryType.TRANSPORT)
     elif entry_type == EntryType.OTHERS:
         msg = "What category is this?"
-        markup_list = gs.get_main_dropdown_value(sheet_id, EntryType.OTHERS)
+        markup_list = await ags.get_main_dropdown_value(sheet_id, EntryType.OTHERS)
     return msg, markup_list
     
 async def get_payment_text(sheet_id):
-    payment_list = gs.get_main_dropdown_value(sheet_id, "Payment")
+    await prefetch.wait(sheet_id)
+    payment_list = await ags.get_main_dropdown_value(sheet_id, "Payment")
     return payment_list
 
 # Start bot
@@ -90,9 +198,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
     try:
-        user_exists = db.check_if_user_exists(telegram_id)
-        if user_exists:
-            context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+        # the sheet may have been linked through another instance, re-read unless a listener keeps the cache fresh
+        await db.run(db.forget_user, telegram_id)
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        if sheet_id:
+            context.user_data["sheet_id"]=sheet_id
             link = f"https://docs.google.com/spreadsheets/d/{context.user_data['sheet_id']}/edit"
             await update.message.reply_text(f"Seems like you have already linked a Google sheet with us, do you want to link a different Google sheet with us?\n\n{link}", reply_markup=create_inline_markup(["Yes", "No"]))
             return RESET_UP
@@ -114,10 +224,10 @@ async def set_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if match:
         sheet_id = match.group(1)
         try:
-            db.new_user_setup(telegram_id, sheet_id)    
+            await db.run(db.new_user_setup, telegram_id, sheet_id)    
             current_datetime = dt.datetime.now(timezone)
-            day = current_datetime.day
-            gs.update_rows(sheet_id, day, 4, 5) #New users start from row 5
+            async with sheet_lock(sheet_id):
+                await ags.run(rt.set_trackers, sheet_id, [gs.date_tracker(current_datetime), 4, 4, 5], timeout=None) #New users start from row 5
             await update.message.reply_text('Google sheet successfully linked!')
             return ConversationHandler.END
         except Exception as e:
@@ -130,7 +240,9 @@ async def set_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # Reset up google sheet ID
 async def reset_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     await update.callback_query.answer()
     if reply == "Yes":
         await update.callback_query.message.reply_text(await setup_text())
@@ -143,14 +255,16 @@ async def reset_up(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def config(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
-    context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+    context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
     list = ["Change Google Sheet", "Configure Quick Transport", "Configure Quick Others", "Cancel"]
     await update.message.reply_text("How can i help you today?", reply_markup=create_inline_markup(list))
     return CONFIG__HANDLER
 
 # Configuration handler
 async def config_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     await update.callback_query.answer()
     if reply == "Cancel":
         await update.callback_query.edit_message_text('Okay!', reply_markup=None)
@@ -165,7 +279,7 @@ async def config_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if reply == "Configure Quick Transport":
                 context.user_data['config'] = EntryType.TRANSPORT
                 msg = f'This is your current Transport settings.\n'                
-                setting_list = gs.get_quick_add_settings(context.user_data['sheet_id'], context.user_data['config'])
+                setting_list = await ags.get_quick_add_settings(context.user_data['sheet_id'], context.user_data['config'])
                 # Retrieve current settings
                 if setting_list == None:
                     msg = f'{msg}Default Payment: None\nDefault Type: None\n'
@@ -178,13 +292,13 @@ async def config_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             elif reply == "Configure Quick Others":
                 context.user_data['config'] = EntryType.OTHERS
                 msg = f'This is your current Others settings.\nClick on "Add new" to add a new one (max 5).\nIf you wish to update, you will have to do so manually in the "Tracker" sheet.\n\nPayment, Category\n'
-                setting_list = gs.get_quick_add_others(context.user_data["sheet_id"])
+                setting_list = await ags.get_quick_add_others(context.user_data["sheet_id"])
                 keyboard_list = []
                 if setting_list == None:
                     msg = f'{msg}No settings found\n'
                 else:
                     for setting in setting_list:
-                        msg = f'{msg}{setting}\n'
+                        msg = f'{msg}{", ".join(setting)}\n'
                 if(len(setting_list)<5):
                     keyboard_list.append("Add new")
                 keyboard_list.append("Cancel")
@@ -197,12 +311,14 @@ async def config_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # Quick add set up
 async def config_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     await update.callback_query.answer()
     config = context.user_data['config']
     try:
         if reply == "Yes" or reply == "Add new":
-            markup_list = gs.get_main_dropdown_value(context.user_data["sheet_id"], config)
+            markup_list = await ags.get_main_dropdown_value(context.user_data["sheet_id"], config)
             await update.callback_query.message.edit_text(f'Choose your default {config.value} type.', reply_markup=create_inline_markup(markup_list))
             return CONFIG_CATEGORY
     except Exception as e:
@@ -214,7 +330,9 @@ async def config_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 # Quick category setup
 async def config_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     await update.callback_query.answer()
     config = context.user_data['config']
     context.user_data['config-category'] = reply
@@ -223,12 +341,12 @@ async def config_category(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.callback_query.answer()
         if config == EntryType.TRANSPORT:
             await update.callback_query.edit_message_text(f'Default transport type: {reply}', reply_markup=None)
-            payment_list = gs.get_main_dropdown_value(sheet_id, "Payment")
+            payment_list = await ags.get_main_dropdown_value(sheet_id, "Payment")
             
             await update.callback_query.message.reply_text('What is your default mode of payment?', reply_markup=create_inline_markup(payment_list))
             return CONFIG_PAYMENT
         elif config == EntryType.OTHERS:
-            sub_markup_list = gs.get_sub_dropdown_value(sheet_id, reply, config)
+            sub_markup_list = await ags.get_sub_dropdown_value(sheet_id, reply, config)
             if len(sub_markup_list) > 1:
                 sub_markup_list.pop(0)
                 msg = "What subcategory is this?"
@@ -241,11 +359,13 @@ async def config_category(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # Quick subcategory setup
 async def config_subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     context.user_data['config-category'] = f'{context.user_data["config-category"]} - {reply}'
     try:
         sheet_id = context.user_data["sheet_id"]
-        payment_list = gs.get_main_dropdown_value(sheet_id, "Payment")
+        payment_list = await ags.get_main_dropdown_value(sheet_id, "Payment")
         await update.callback_query.answer()
         await update.callback_query.edit_message_text(f'Default category type: {context.user_data["config-category"]}', reply_markup=None)
         await update.callback_query.message.reply_text('What is your default mode of payment?', reply_markup=create_inline_markup(payment_list))
@@ -257,12 +377,14 @@ async def config_subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 # Quick payment setup
 async def config_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     try:
         sheet_id = context.user_data["sheet_id"]
         await update.callback_query.answer()
         context.user_data['config-payment'] = reply
-        sub_markup_list = gs.get_sub_dropdown_value(sheet_id, reply, "Payment")
+        sub_markup_list = await ags.get_sub_dropdown_value(sheet_id, reply, "Payment")
         if len(sub_markup_list) > 1:
             sub_markup_list.pop(0)
             msg = "What is your default mode of payment?"
@@ -275,12 +397,14 @@ async def config_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # Get subpayment
 async def config_subpayment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     context.user_data['config-payment'] = f'{context.user_data["config-payment"]} - {reply}'
     try:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text(f'Payment type: {context.user_data["config-payment"]}', reply_markup=None)
-        gs.update_quick_add_settings(context.user_data['sheet_id'], context.user_data['config'] ,context.user_data['config-payment'], context.user_data['config-category'])
+        await ags.update_quick_add_settings(context.user_data['sheet_id'], context.user_data['config'] ,context.user_data['config-payment'], context.user_data['config-category'])
         await update.callback_query.message.reply_text(f'Default {context.user_data["config"].value} settings updated.')
         return ConversationHandler.END
     except Exception as e:
@@ -292,13 +416,17 @@ async def config_subpayment(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def add_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
-    context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+    context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
+    # load what the entry needs while the user answers
+    prefetch.start(context.user_data["sheet_id"])
     await update.message.reply_text("What type of entry is this?", reply_markup=create_inline_markup([entry_type.value for entry_type in EntryType]))
     return ENTRY
 
 # Get entry
 async def entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     context.user_data['entry_type'] = EntryType[reply.upper()]
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(f'Entry type: {reply}', reply_markup=None)
@@ -344,7 +472,9 @@ async def remarks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # Get category, check if have sub
 async def category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     entry_type = context.user_data['entry_type']
     try:
         sheet_id = context.user_data["sheet_id"]
@@ -357,12 +487,11 @@ async def category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return PAYMENT
         elif entry_type == EntryType.OTHERS:
             context.user_data['category'] = reply
-            sub_markup_list = gs.get_sub_dropdown_value(sheet_id, reply, entry_type)
+            sub_markup_list = await ags.get_sub_dropdown_value(sheet_id, reply, entry_type)
             if len(sub_markup_list) > 1:
                 sub_markup_list.pop(0)
-                sub_markup_list.append(" << Back")
                 msg = "What subcategory is this?"
-                await update.callback_query.message.edit_text(msg, reply_markup=create_inline_markup(sub_markup_list))
+                await update.callback_query.message.edit_text(msg, reply_markup=create_inline_markup(sub_markup_list, [" << Back"]))
                 return SUBCATEGORY
             # This won't be called as there will always be a subcategory, but just in case
             else:
@@ -375,7 +504,9 @@ async def category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
 # Get subcategory
 async def subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     sheet_id = context.user_data["sheet_id"]
     entry_type = context.user_data["entry_type"]
     await update.callback_query.answer()
@@ -396,17 +527,18 @@ async def subcategory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 # Get payment
 async def payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     try:
         sheet_id = context.user_data["sheet_id"]
         await update.callback_query.answer()
         context.user_data['payment'] = reply
-        sub_markup_list = gs.get_sub_dropdown_value(sheet_id, reply, "Payment")
+        sub_markup_list = await ags.get_sub_dropdown_value(sheet_id, reply, "Payment")
         if len(sub_markup_list) > 1:
             sub_markup_list.pop(0)
-            sub_markup_list.append(" << Back")
             msg = "What is your mode of payment?"
-            await update.callback_query.message.edit_text(msg, reply_markup=create_inline_markup(sub_markup_list))
+            await update.callback_query.message.edit_text(msg, reply_markup=create_inline_markup(sub_markup_list, [" << Back"]))
             return SUBPAYMENT
     except Exception as e:
         logger.error(f'function payment:{e}')
@@ -415,7 +547,9 @@ async def payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # Get subpayment
 async def subpayment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
     await update.callback_query.answer()
     sheet_id = context.user_data["sheet_id"]
     if reply == " << Back":
@@ -437,19 +571,12 @@ async def subpayment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # logging transaction
 async def log_transaction(user_data, update):
     sheet_id = user_data["sheet_id"]
-    trackers = gs.get_trackers(sheet_id)
 
     # datatime data
     current_datetime = dt.datetime.now(timezone)
     day = current_datetime.day
     month = current_datetime.strftime('%B')
 
-    # tracker data
-    day_tracker = int(trackers[0])
-    other_row_tracker = int(trackers[1])
-    transport_row_tracker = int(trackers[2])
-    first_row = int(trackers[3])
-
     # user input data
     entry_type = user_data['entry_type']
     payment = user_data["payment"]
@@ -458,49 +585,20 @@ async def log_transaction(user_data, update):
     remarks = user_data['remarks']
     row_data = [entry_type, price, remarks, category, payment]
 
-    msg = ""
+    # rows are allocated in the bot's store, the cells are journaled and written to the sheet in the background
+    await prefetch.wait(sheet_id)
+    async with sheet_lock(sheet_id):
+        trackers, data = await ags.run(rt.allocate_transaction, sheet_id, current_datetime, row_data, timeout=None)
+        await journal.record(sheet_id, data, f'{sheet_id}:{update.update_id}', update.effective_chat.id)
 
-    # start new date if date elapsed
-    if day_tracker < day or day == 1:
-        msg = (f'New entry for {day} {month}')
-        if day == 1:
-            month = (current_datetime - dt.timedelta(days=1)).strftime("%B")
-        # update prev day
-        msg = f'{msg}\nCreating sum for day {day_tracker}'
-        gs.update_prev_day(sheet_id, month, first_row)
-        if day == 1:
-            new_row = 5
-            first_row = 6
-            gs.update_rows(sheet_id, 1, new_row, first_row)
-        else:
-            new_row = gs.get_new_row(sheet_id, month)
-            first_row = new_row + 1
-            gs.update_rows(sheet_id, day, new_row, first_row) 
+    latest = gs.tracker_date(trackers[0], current_datetime)
+    if latest != current_datetime.date():
+        msg = f'New entry for {day} {month}\nCreating sum for day {latest.day}'
         if update.callback_query and update.callback_query.message:
             await update.callback_query.message.reply_text(msg)
         elif update.message:
             await update.message.reply_text(msg)
 
-        transport_row_tracker = new_row
-        first_row = new_row + 1
-        other_row_tracker = new_row
-        
-        # enter date into cell
-        gs.create_date(sheet_id, day, month, first_row)
-
-    # update row + 1
-    gs.row_incremental(sheet_id, entry_type)
-    if entry_type == EntryType.TRANSPORT:
-        transport_row_tracker += 1
-    else:
-        other_row_tracker += 1
-
-    # create entry
-    if entry_type == EntryType.TRANSPORT:
-        gs.create_entry(sheet_id, month, transport_row_tracker, row_data)
-    else:
-        gs.create_entry(sheet_id, month, other_row_tracker, row_data)
-
 # cancel
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Conversation cancelled. Good bye.', reply_markup=None)
@@ -511,9 +609,11 @@ async def add_transport(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
     try:
-        context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+        context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
         context.user_data['entry_type'] = EntryType.TRANSPORT
-        setting_list = gs.get_quick_add_settings(context.user_data["sheet_id"], EntryType.TRANSPORT)
+        prefetch.start(context.user_data["sheet_id"])
+        await prefetch.wait(context.user_data["sheet_id"])
+        setting_list = await ags.get_quick_add_settings(context.user_data["sheet_id"], EntryType.TRANSPORT)
     except Exception as e:
         logger.error(f'function add_transport:{e}')
         await update.callback_query.message.reply_text("Can't seem to retrieve transport information, please try again later.")
@@ -533,9 +633,11 @@ async def add_others(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
     try:
-        context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+        context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
         context.user_data['entry_type'] = EntryType.OTHERS
-        setting_list = gs.get_quick_add_settings(context.user_data["sheet_id"], EntryType.OTHERS)
+        prefetch.start(context.user_data["sheet_id"])
+        await prefetch.wait(context.user_data["sheet_id"])
+        setting_list = await ags.get_quick_add_settings(context.user_data["sheet_id"], EntryType.OTHERS)
     except Exception as e:
         logger.error(f'function add_others:{e}')
         await update.callback_query.message.reply_text("Can't seem to retrieve others information, please try again later.")
@@ -544,14 +646,22 @@ async def add_others(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('You have not set up your quick add settings for others yet, please do so by typing /config')
         return ConversationHandler.END
     else:
-        setting_list = gs.get_quick_add_others(context.user_data["sheet_id"])
-        await update.message.reply_text("Quick Add Others, please choose your category.", reply_markup=create_inline_markup(setting_list))
+        setting_list = await ags.get_quick_add_others(context.user_data["sheet_id"])
+        # the settings by label, names may contain commas so the label isn't split back
+        context.user_data['quick_others'] = {', '.join(setting): setting for setting in setting_list}
+        await update.message.reply_text("Quick Add Others, please choose your category.", reply_markup=create_inline_markup(list(context.user_data['quick_others'])))
     return QUICK_ADD_CATEGORY
 
 # quick add category
 async def quick_add_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    reply = update.callback_query.data
-    context.user_data['payment'], context.user_data['category'] = reply.split(",")
+    reply = await callback_reply(update)
+    if reply is None:
+        return None
+    setting = context.user_data.get('quick_others', {}).get(reply)
+    if setting is None:
+        # menu sent before the settings were kept by label
+        setting = [part.strip() for part in reply.split(",", 1)]
+    context.user_data['payment'], context.user_data['category'] = setting
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(f'Quick Add Others\nDefault Payment: {context.user_data["payment"]}\nDefault Type: {context.user_data["category"]}'+
                                     '\n\nPlease enter as follow: [price],[remarks]\n e.g. 19.99, New shirt', reply_markup=None)
@@ -578,15 +688,192 @@ async def quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # help message
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = ("To get started, please type /start\n" + "Remember to configure your Dropdown sheet to get started on this bot.\n\n" + "To configure, type /config\n" + 
-    "To add entry, type /addentry\n" + "To add transport quickly, type /addtransport\n" + "To add others quickly, type /addothers\n")
+    "To add entry, type /addentry\n" + "To add transport quickly, type /addtransport\n" + "To add others quickly, type /addothers\n" +
+    "To reload your Dropdown and Tracker sheets after editing them, type /refresh\n" +
+    "To add several entries in one message, type /bulkadd\n" +
+    "To download your entries as CSV, type /export [month] or /export [from] - [to] e.g. /export Jan - Mar\n" +
+    "To import a bank statement, set up rules with /importrule then upload the CSV file\n" +
+    "To see your spending for a month, type /summary or /summary [month] e.g. /summary Mar\n")
     await update.message.reply_text(msg)
 
+# reload Dropdown values after the user edits their sheet
+async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.effective_user.id
+    try:
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        gs.invalidate_dropdown(sheet_id)
+        await ags.get_dropdown(sheet_id)
+        # the Tracker tab lags behind while journaled entries are still being written
+        msg = 'Your Dropdown and Tracker settings have been refreshed.'
+        async with sheet_lock(sheet_id):
+            # entries that couldn't be written are tried again, e.g. once a deleted tab is back
+            requeued = await ags.run(journal.requeue_dead, sheet_id, timeout=None)
+            if requeued:
+                journal.wake()
+                msg = f'{msg}\n{requeued} unsaved entries will be saved again.'
+            if not await ags.run(journal.has_pending, sheet_id):
+                force = context.args[:1] == ['force']
+                _, taken = await ags.run(rt.reconcile_trackers, sheet_id, force, timeout=None)
+                if not taken:
+                    msg = (f'{msg}\nYour Tracker tab is behind the rows the bot has used and was not loaded, '
+                           'send /refresh force to load it anyway.')
+        await update.message.reply_text(msg)
+    except Exception as e:
+        logger.error(f'function refresh:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
+# log many entries from one message, every line is checked before any of them is written
+async def bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = ('Add several entries at once, one per line:\n/bulkadd\n[price], [remarks], [category], [payment]\n'
+           '[price], [start], [end], [transport type], [payment]\n\ne.g.\n/bulkadd\n12.50, Lunch, Food - Lunch, Card - Visa\n2.10, Home, Work, Bus, Cash')
+    telegram_id = update.effective_user.id
+    first_line, _, other_lines = update.message.text.partition('\n')
+    lines = [line.strip() for line in first_line.split(maxsplit=1)[1:] + other_lines.splitlines() if line.strip()]
+    if not lines:
+        await update.message.reply_text(msg)
+        return
+    if len(lines) > BULK_MAX_LINES:
+        await update.message.reply_text(f'Please send at most {BULK_MAX_LINES} entries at a time.')
+        return
+    try:
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        dropdown = await ags.get_dropdown(sheet_id)
+        rows, errors = [], []
+        for number, line in enumerate(lines, 1):
+            row_data, error = parse_bulk_line(line, dropdown)
+            if error:
+                errors.append(f'Line {number}: {error}')
+            else:
+                rows.append(row_data)
+        if errors:
+            await update.message.reply_text('No entries were logged, please fix these lines and send them again:\n' + '\n'.join(errors))
+            return
+
+        current_datetime = dt.datetime.now(timezone)
+        # one block of rows and one write for every entry
+        async with sheet_lock(sheet_id):
+            trackers, data = await ags.run(rt.allocate_transactions, sheet_id, [(current_datetime, row_data) for row_data in rows], timeout=None)
+            await journal.record(sheet_id, data, f'{sheet_id}:{update.update_id}', update.effective_chat.id)
+        await update.message.reply_text(f'{len(rows)} transactions logged.')
+    except Exception as e:
+        logger.error(f'function bulk_add:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
+# send the entries of a month or date range as a compressed CSV file
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.effective_user.id
+    period = ' '.join(context.args) or dt.datetime.now(timezone).strftime('%b')
+    periods = parse_period(period)
+    if periods is None:
+        await update.message.reply_text('Please specify a month or a date range, e.g.\n/export Mar\n/export Jan - Mar\n/export 1 Mar - 15 Apr')
+        return
+    try:
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        document = await ags.run(ex.build_export, sheet_id, periods, timeout=EXPORT_TIMEOUT)
+        filename = f"expenses-{period.replace(' ', '')}.csv.gz"
+        await update.message.reply_document(document=document, filename=filename)
+    except Exception as e:
+        logger.error(f'function export:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
+# list, add or remove the rules that give bank statement rows a category
+async def import_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = ('Import rules give the rows of an uploaded bank statement CSV a category and payment. '
+           'A rule matches descriptions containing its keyword, * matches every other row.\n'
+           '/importrule [keyword] = [category], [payment]\n/importrule remove [keyword]\n\n'
+           'e.g.\n/importrule grab = Taxi, Card - Visa\n/importrule * = Food - Lunch\n'
+           'Rows without a payment use your quick add others payment.')
+    telegram_id = update.effective_user.id
+    text = update.message.text.partition(' ')[2].strip()
+    try:
+        if not text:
+            rules = await db.run(db.get_import_rules, telegram_id)
+            lines = ''.join(f'{keyword} = {category}{", " + payment if payment else ""}\n' for keyword, category, payment in rules)
+            await update.message.reply_text(f'Your import rules:\n{lines}\n{msg}' if rules else msg)
+            return
+        if text.lower().startswith('remove '):
+            keyword = text[len('remove '):].strip().lower()
+            deleted = await db.run(db.delete_import_rule, telegram_id, keyword)
+            await update.message.reply_text(f'Rule {keyword} removed.' if deleted else f'There is no rule {keyword}.')
+            return
+
+        keyword, separator, target = text.partition('=')
+        keyword = keyword.strip().lower()
+        parts = [part.strip() for part in target.split(',')]
+        if not separator or not keyword or not parts[0] or len(parts) > 2:
+            await update.message.reply_text(msg)
+            return
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        dropdown = await ags.get_dropdown(sheet_id)
+        category = gs.match_option(parts[0], dropdown['transport']) or gs.match_dropdown(parts[0], dropdown['others'], dropdown['others_sub'])
+        payment = gs.match_dropdown(parts[1], dropdown['payment'], dropdown['payment_sub']) if len(parts) > 1 else ''
+        if category is None or payment is None:
+            await update.message.reply_text(f'{parts[0] if category is None else parts[1]} is not in your Dropdown sheet.')
+            return
+        await db.run(db.set_import_rule, telegram_id, keyword, category, payment)
+        await update.message.reply_text(f'Rule saved: {keyword} = {category}{", " + payment if payment else ""}')
+    except Exception as e:
+        logger.error(f'function import_rule:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
+# import an uploaded bank statement CSV
+async def import_statement(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.effective_user.id
+    document = update.message.document
+    if document.file_size and document.file_size > bi.IMPORT_MAX_BYTES:
+        await update.message.reply_text('The statement is too large, please split it into smaller files.')
+        return
+    try:
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        rules = await db.run(db.get_import_rules, telegram_id)
+        if not rules:
+            await update.message.reply_text('Please add import rules with /importrule before uploading a statement.')
+            return
+        buffer = io.BytesIO()
+        file = await document.get_file()
+        await file.download_to_memory(buffer)
+        buffer.seek(0)
+        lines = io.TextIOWrapper(buffer, encoding='utf-8-sig', errors='replace', newline='')
+
+        # duplicates are found from the sheet, so entries still in the journal must be written first
+        if not await journal.wait_flushed(sheet_id):
+            await update.message.reply_text('Your last entries are still being saved, please try again in a minute.')
+            return
+        async with sheet_lock(sheet_id):
+            stats, data = await ags.run(bi.import_statement, sheet_id, lines, rules, dt.datetime.now(timezone), timeout=None)
+            if data:
+                await journal.record(sheet_id, data, f'{sheet_id}:{update.update_id}', update.effective_chat.id)
+        await update.message.reply_text(bi.format_result(stats))
+    except ValueError as e:
+        await update.message.reply_text(f'{e}. Please upload the CSV statement from your bank.')
+    except Exception as e:
+        logger.error(f'function import_statement:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
+# spending of a month by category, payment and day
+async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    telegram_id = update.effective_user.id
+    current_datetime = dt.datetime.now(timezone)
+    month = current_datetime.strftime('%B')
+    if context.args:
+        month = parse_month(context.args[0])
+        if month is None:
+            await update.message.reply_text('Please specify the month in this format: /summary MMM\ne.g. /summary Mar')
+            return
+    try:
+        sheet_id = await db.run(db.get_user_sheet_id, telegram_id)
+        month_summary = await ags.run(sm.get_summary, sheet_id, month)
+        await update.message.reply_text(sm.format_summary(month, month_summary))
+    except Exception as e:
+        logger.error(f'function summary:{e}')
+        await update.message.reply_text('There seems to be an error, please try again later.')
+
 # ask to retrieve transaction
 async def retrieve_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
     try:
-        context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+        context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
         await update.message.reply_text(f"Please specify the date and month you wish to retrieve from in this format: DD MMM\ne.g 16 Mar\nor use /cancel to exit")
         return HANDLE_RETRIEVE_TRANSACTION
     except Exception as e:
@@ -602,7 +889,11 @@ async def handle_retrieve_transaction(update: Update, context: ContextTypes.DEFA
     try:
         if check_date_format(reply):
             day, month = reply.split(' ')
-            total_spend, transport_values, other_values = gs.retrieve_transaction(sheet_id, month, day)
+            # tabs are named after the full month
+            tab = parse_month(month)
+            day_rows = await ags.run(rt.get_day_rows, sheet_id, tab, dt.datetime.now(timezone))
+            first_row, last_row = day_rows[int(day)]
+            total_spend, transport_values, other_values = await ags.retrieve_transaction(sheet_id, tab, first_row, last_row)
             if not total_spend :
                 total_spend = "To be determine"
             else:
@@ -630,7 +921,7 @@ async def add_income(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     telegram_id = update.effective_user.id
     try:
-        context.user_data["sheet_id"]=db.get_user_sheet_id(telegram_id)
+        context.user_data["sheet_id"]=await db.run(db.get_user_sheet_id, telegram_id)
         await update.message.reply_text("Add income\nPlease state your income followed by any remarks: [income],[remarks]\ne.g. 2000, Something")
     except Exception as e:
         logger.error(f'function add_income:{e}')
@@ -654,7 +945,7 @@ async def income(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['remarks'] = remarks.strip()
     try:
         sheet_id = context.user_data["sheet_id"]
-        work_list = gs.get_work_place(sheet_id)
+        work_list = await ags.get_work_place(sheet_id)
         await update.message.reply_text("Choose your source of income", reply_markup=create_inline_markup(work_list))
         return WORK_PLACE
     except Exception as e:
@@ -663,7 +954,9 @@ async def income(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
 async def work_place(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    place = update.callback_query.data
+    place = await callback_reply(update)
+    if place is None:
+        return None
     context.user_data['place'] = place
     await update.callback_query.answer()
     await update.callback_query.message.edit_text(f'Place: {place}', reply_markup=None)
@@ -671,7 +964,9 @@ async def work_place(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return CPF
 
 async def cpf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    cpf = update.callback_query.data
+    cpf = await callback_reply(update)
+    if cpf is None:
+        return None
     income = context.user_data['income']
     remarks = context.user_data['remarks']
     place = context.user_data['place']
@@ -682,7 +977,7 @@ async def cpf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         row_data = [income, place, cpf, remarks]
         current_datetime = dt.datetime.now(timezone)
         month = current_datetime.strftime('%B')
-        if gs.update_income(sheet_id, month, row_data):
+        if await ags.update_income(sheet_id, month, row_data):
             await update.callback_query.message.reply_text('Income has been added!')
         else:
             await update.callback_query.message.reply_text('You have exceed the number of income allowed!')
@@ -693,9 +988,102 @@ async def cpf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
         
 
-def run_telegram_bot():
-    print ("Starting telegram bot...")
-    application = Application.builder().token(BOT_TOKEN).build()
+# Tag the log records of an update with a correlation id and the ids it concerns, runs before every other handler
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_data = context.user_data or {}
+    lg.bind(correlation_id=uuid.uuid4().hex[:16], update_id=update.update_id,
+            user_id=update.effective_user.id if update.effective_user else None, sheet_id=user_data.get('sheet_id'))
+
+# tell a user some of their entries couldn't be written to their sheet
+async def notify_unwritten(application: Application, chat_id, error):
+    await application.bot.send_message(chat_id, 'Some of your entries could not be saved to your Google Sheet, '+
+                                       'e.g. because a month tab was deleted or renamed.\n'+
+                                       f'Google Sheets replied: {error[:200]}\n\n'+
+                                       'Please fix the sheet and send /refresh to save them again.')
+
+# start background jobs
+async def post_init(application: Application):
+    application.bot_data['journal_flusher'] = asyncio.create_task(journal.run_flusher(functools.partial(notify_unwritten, application)))
+    if metrics.METRICS_ENABLED and metrics.METRICS_PORT:
+        try:
+            metrics_server = HttpServer(metrics.routes(), metrics.METRICS_LISTEN, metrics.METRICS_PORT)
+            await metrics_server.start()
+            application.bot_data['metrics_server'] = metrics_server
+        except Exception as e:
+            logger.error(f'function post_init:{e}')
+    application.bot_data['client_loader'] = asyncio.create_task(load_clients(application))
+
+# Sheets the scheduled jobs work on. A worker of the multi-worker mode only takes the sheets of the
+# users it has served, the other sheets' writes belong to other workers' journals
+async def job_sheet_ids(context: ContextTypes.DEFAULT_TYPE):
+    if sharding.worker_name:
+        return {user_data['sheet_id'] for user_data in context.application.user_data.values() if user_data.get('sheet_id')}
+    return await db.run(db.get_tracked_sheets)
+
+# Midnight job starting the new day on every sheet
+async def rollover_job(context: ContextTypes.DEFAULT_TYPE):
+    sheet_ids = await job_sheet_ids(context)
+    count = await rollover.run_rollover(sheet_ids, dt.datetime.now(timezone))
+    # LOG_LEVEL leaves info out by default, the counts are kept as metrics
+    metrics.inc('job_sheets_total', len(sheet_ids), job='rollover', result='seen')
+    metrics.inc('job_sheets_total', count, job='rollover', result='changed')
+    logger.info(f'Rolled over {count} of {len(sheet_ids)} sheets')
+
+# Daily job creating next month's tab in every sheet during the last days of a month
+async def provisioning_job(context: ContextTypes.DEFAULT_TYPE):
+    month = provisioning.due_month(dt.datetime.now(timezone))
+    if month is None:
+        return
+    sheet_ids = await job_sheet_ids(context)
+    count = await provisioning.run_provisioning(sheet_ids, month)
+    metrics.inc('job_sheets_total', len(sheet_ids), job='provisioning', result='seen')
+    metrics.inc('job_sheets_total', count, job='provisioning', result='changed')
+    logger.info(f'Created the {month} tab in {count} of {len(sheet_ids)} sheets')
+
+# Build the Google Sheets client and start the user listener in the background, updates are served
+# meanwhile and the first ones wait for the clients on their executors
+async def load_clients(application: Application):
+    try:
+        await ags.run(gs.get_sheets_api)
+    except Exception as e:
+        logger.error(f'function load_clients:{e}')
+    if USER_CACHE_LISTEN:
+        try:
+            application.bot_data['user_listener'] = await db.run(db.start_user_listener)
+        except Exception as e:
+            logger.error(f'function load_clients:{e}')
+
+# stop background jobs and write what is left in the journal
+async def post_shutdown(application: Application):
+    loader = application.bot_data.pop('client_loader', None)
+    if loader:
+        loader.cancel()
+    listener = application.bot_data.pop('user_listener', None)
+    if listener:
+        listener.close()
+    flusher = application.bot_data.pop('journal_flusher', None)
+    if flusher:
+        flusher.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        await metrics_server.close()
+    try:
+        await journal.flush_pending()
+    except Exception as e:
+        logger.error(f'function post_shutdown:{e}')
+
+# Build the application with every handler registered
+def build_application():
+    persistence = SQLitePersistence()
+    # keyboards sent before a restart are answered from the persistence database
+    kb.store = persistence
+    application = Application.builder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES) \
+        .persistence(persistence).post_init(post_init).post_shutdown(post_shutdown).build()
+    application.add_handler(TypeHandler(Update, bind_log_context), group=-1)
+    application.job_queue.run_daily(rollover_job, dt.time(0, 0, tzinfo=timezone), name='rollover')
+    application.job_queue.run_daily(provisioning_job, dt.time(3, 0, tzinfo=timezone), name='provisioning')
+    # also shortly after start, in case the bot was down at that time
+    application.job_queue.run_once(provisioning_job, 60, name='provisioning_on_start')
 
     # Configuration-related states and handlers
     config_states = {
@@ -754,11 +1142,47 @@ def run_telegram_bot():
             **add_income_states,
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name='conversation',
+        persistent=True,
     )
     application.add_handler(conv_handler)
 
     help_handler = CommandHandler('help', help)
     application.add_handler(help_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
\ No newline at end of file
+    refresh_handler = CommandHandler('refresh', refresh)
+    application.add_handler(refresh_handler)
+
+    bulk_add_handler = CommandHandler('bulkadd', bulk_add)
+    application.add_handler(bulk_add_handler)
+
+    export_handler = CommandHandler('export', export)
+    application.add_handler(export_handler)
+
+    import_rule_handler = CommandHandler('importrule', import_rule)
+    application.add_handler(import_rule_handler)
+
+    import_statement_handler = MessageHandler(filters.Document.FileExtension('csv') | filters.Document.MimeType('text/csv'), import_statement)
+    application.add_handler(import_statement_handler)
+
+    summary_handler = CommandHandler('summary', summary)
+    application.add_handler(summary_handler)
+
+    if metrics.METRICS_ENABLED:
+        metrics.instrument_handlers(application)
+    return application
+
+def run_telegram_bot():
+    print ("Starting telegram bot...")
+    if BOT_WORKERS > 1:
+        asyncio.run(sharding.run_router(BOT_TOKEN, BOT_WORKERS, BOT_MODE))
+        return
+    # entries left in the journals of an earlier multi-worker run are flushed here
+    journal.adopt_orphans()
+    application = build_application()
+
+    # Run the bot until the user presses Ctrl-C, or SIGTERM in webhook mode
+    if BOT_MODE == 'webhook':
+        asyncio.run(webhook.run_webhook(application, metrics.routes()))
+    else:
+        application.run_polling()
\ No newline at end of file
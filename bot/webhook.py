@@ -0,0 +1,110 @@
+import asyncio
+import hmac
+import json
+import os
+import signal
+from telegram import Update
+from bot.http_server import HttpServer
+import bot.logger as lg
+
+# Webhook settings, used when BOT_MODE=webhook
+# Public base URL Telegram sends updates to, e.g. https://tracker.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = '/' + os.getenv("WEBHOOK_PATH", "telegram").strip('/')
+# Telegram sends it back in X-Telegram-Bot-Api-Secret-Token, requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+# Call setWebhook on start, turn off when several instances share one URL registered at deploy time
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() == "true"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Seconds the health check reports unhealthy on shutdown before the instance drains, so a load
+# balancer stops sending it requests first
+WEBHOOK_DRAIN_GRACE = float(os.getenv("WEBHOOK_DRAIN_GRACE", "5"))
+HEALTH_PATH = '/healthz'
+
+logger = lg.setup_logger()
+
+# Routes of the embedded server. enqueue(data) hands over the JSON of a valid update,
+# state['running'] and state['draining'] drive the health check
+def build_routes(enqueue, state):
+    async def receive_update(request):
+        if request.method != 'POST':
+            return 405, b'', 'text/plain'
+        if state['draining']:
+            # Telegram retries, another instance or the next start picks it up
+            return 503, b'', 'text/plain'
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return 403, b'', 'text/plain'
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return 400, b'', 'text/plain'
+        await enqueue(data)
+        return 200, b'', 'text/plain'
+
+    async def health(request):
+        if state['running'] and not state['draining']:
+            return 200, b'ok', 'text/plain'
+        return 503, b'draining', 'text/plain'
+
+    return {WEBHOOK_PATH: receive_update, HEALTH_PATH: health}
+
+# Run the embedded server until SIGINT or SIGTERM. Then report unhealthy and refuse updates for
+# WEBHOOK_DRAIN_GRACE seconds, drain the requests in flight and on_stop, and close the server last
+async def serve(enqueue, bot, on_start=None, on_stop=None, extra_routes=None):
+    if not WEBHOOK_SECRET:
+        raise ValueError('WEBHOOK_SECRET must be set to run in webhook mode')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    state = {'running': False, 'draining': False}
+    routes = build_routes(enqueue, state)
+    routes.update(extra_routes or {})
+    server = HttpServer(routes, WEBHOOK_LISTEN, PORT)
+
+    if on_start:
+        await on_start()
+    state['running'] = True
+    await server.start()
+    if WEBHOOK_URL and WEBHOOK_REGISTER:
+        await bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    print(f"Listening for updates on {WEBHOOK_LISTEN}:{server.port}{WEBHOOK_PATH}")
+
+    try:
+        await stop.wait()
+    finally:
+        state['draining'] = True
+        # the server stays up so the health check can answer 503 while the load balancer notices
+        await asyncio.sleep(WEBHOOK_DRAIN_GRACE)
+        # updates accepted before draining are queued before the application stops
+        await server.wait_idle()
+        if on_stop:
+            await on_stop()
+        await server.close()
+
+# Serve updates to the application over the embedded server, queued updates are processed before shutdown
+async def run_webhook(application, extra_routes=None):
+    async def enqueue(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    async def on_start():
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+    async def on_stop():
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    await serve(enqueue, application.bot, on_start, on_stop, extra_routes)
@@ -0,0 +1,56 @@
+import argparse
+import json
+import math
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# POST recorded Telegram updates to a running webhook, e.g.
+# python replay_updates.py samples/updates.jsonl --url http://localhost:8080/telegram --secret $WEBHOOK_SECRET
+def load_updates(path):
+    with open(path) as file:
+        text = file.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def post(url, secret, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+    started_at = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, (time.perf_counter() - started_at) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded Telegram updates against the webhook')
+    parser.add_argument('updates', help='JSON lines file or JSON array of updates')
+    parser.add_argument('--url', default='http://localhost:8080/telegram')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--repeat', type=int, default=1, help='send every update this many times')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates) * args.repeat
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda update: post(args.url, args.secret, update), updates))
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    print(f'sent {len(results)} updates, statuses: {dict(statuses)}')
+    if latencies:
+        p95 = latencies[math.ceil(len(latencies) * 0.95) - 1]
+        print(f'latency ms: p50 {statistics.median(latencies):.1f}, p95 {p95:.1f}, max {latencies[-1]:.1f}')
+    return 0 if set(statuses) == {200} else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
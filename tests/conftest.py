@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+# The tests run on the SQLite store and a throwaway journal, before any bot module reads its settings
+_tmp_dir = tempfile.mkdtemp(prefix='tele-tracker-tests-')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_DB'] = os.path.join(_tmp_dir, 'user-tele.db')
+os.environ['JOURNAL_DB'] = os.path.join(_tmp_dir, 'journal.db')
+os.environ.setdefault('USER_CACHE_LISTEN', 'false')
+# a raised Sheets quota, the emulator answers at once
+os.environ.setdefault('SHEETS_READ_QUOTA', '60000')
+os.environ.setdefault('SHEETS_WRITE_QUOTA', '60000')
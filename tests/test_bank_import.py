@@ -0,0 +1,39 @@
+import datetime as dt
+import bot.bank_import as bi
+import bot.google_sheet as gs
+from bot.common import EntryType
+from bot.fake_sheets import FakeSheetsService
+
+def _transport(price):
+    return [EntryType.TRANSPORT, price, 'GRAB RIDE,', 'Taxi', 'Cash']
+
+def _other(price):
+    return [EntryType.OTHERS, price, 'Merchant', 'Food', 'Cash']
+
+# Entries for a day that already has a block go into that block, never into a second block of the same date
+def test_past_day_entries_join_its_block():
+    sheet_id = 'import-sheet'
+    service = FakeSheetsService()
+    service.create_spreadsheet(sheet_id, ['September'])
+    gs.set_sheets_api(service)
+    # day 3 in rows 5 to 6 with one transport and two others, day 10 in row 7 with one other
+    service.set_values(sheet_id, 'September!A5:K7', [
+        ['3', '', '1', 'Home', 'Work', 'Bus', 'Cash', '2', 'Lunch', 'Food', 'Cash'],
+        ['', '', '', '', '', '', '', '3', 'Dinner', 'Food', 'Cash'],
+        ['10', '', '', '', '', '', '', '4', 'Lunch', 'Food', 'Cash'],
+    ])
+    counts, row_count, blocks = bi.existing_entries(sheet_id, 'September')
+    assert blocks == {3: [5, 6, 1, 2], 10: [7, 7, 0, 1]}
+
+    entries = [(dt.date(2026, 9, 3), _transport('5')), (dt.date(2026, 9, 3), _transport('6')),
+               (dt.date(2026, 9, 10), _other('7')), (dt.date(2026, 9, 10), _other('8')),
+               (dt.date(2026, 9, 15), _other('9'))]
+    data, left_out = bi.append_days('September', gs.first_entry_row + row_count, entries, blocks)
+    ranges = [item['range'] for item in data]
+    # day 3 has room for one more transport, day 10 is the last block and grows, day 15 starts after it
+    assert left_out == 1
+    assert 'September!C6:G6' in ranges
+    assert ranges.count('September!A5') == 0 and ranges.count('September!A7') == 0
+    assert {'range': 'September!B7', 'values': [['=SUM(C7:H9)']]} in data
+    assert ['September!H8:K8', 'September!H9:K9'] == [r for r in ranges if r.startswith('September!H')][:2]
+    assert {'range': 'September!A10', 'values': [[15]]} in data
@@ -0,0 +1,52 @@
+import asyncio
+import datetime as dt
+import itertools
+from types import SimpleNamespace
+import bot.google_sheet as gs
+import bot.journal as journal
+import bot.storage as db
+import bot.telegram_bot as tb
+from bot.common import EntryType
+from bot.fake_sheets import FakeSheetsService
+
+MONTHS = [dt.date(2000, month, 1).strftime('%B') for month in range(1, 13)]
+_update_ids = itertools.count(1)
+
+class FakeMessage:
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        return self
+
+def _update():
+    return SimpleNamespace(update_id=next(_update_ids), effective_chat=SimpleNamespace(id=1), message=FakeMessage(), callback_query=None)
+
+def _seed(sheet_id, trackers):
+    service = FakeSheetsService(latency=0.002)
+    service.create_spreadsheet(sheet_id, ['Dropdown', 'Tracker'] + MONTHS)
+    gs.set_sheets_api(service)
+    db.set_trackers(sheet_id, trackers)
+    return service
+
+# Entries logged at the same time on one sheet each get their own row, and every one is written
+def test_concurrent_entries_get_distinct_rows():
+    sheet_id, count = 'concurrent-sheet', 30
+    today = dt.datetime.now(tb.timezone)
+    service = _seed(sheet_id, [gs.date_tracker(today), 4, 4, 5])
+    user_datas = [{'sheet_id': sheet_id, 'entry_type': EntryType.OTHERS if index % 2 else EntryType.TRANSPORT,
+                   'price': str(index + 1), 'remarks': f'entry {index}', 'category': 'Food', 'payment': 'Cash'}
+                  for index in range(count)]
+
+    async def log_all():
+        await asyncio.gather(*(tb.log_transaction(user_data, _update()) for user_data in user_datas))
+        await journal.flush_pending()
+
+    asyncio.run(log_all())
+
+    month = today.strftime('%B')
+    rows = service.get_values(sheet_id, f'{month}!A5:K{5 + count}')
+    written = [cell for row in rows for cell in (row[3:4] + row[8:9]) if cell.startswith('entry')]
+    assert sorted(written) == sorted(user_data['remarks'] for user_data in user_datas)
+    # no row holds two entries of the same type, and the trackers moved past every entry
+    day, others_row, transport_row, first_row = db.get_trackers(sheet_id)
+    assert others_row - first_row + 1 == count // 2
+    assert transport_row - first_row + 1 == count - count // 2
+    assert not journal.pending()
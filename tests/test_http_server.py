@@ -0,0 +1,30 @@
+import asyncio
+from bot.http_server import HttpServer, MAX_BODY
+
+async def _request(port, raw):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(raw)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+# Requests that can't be parsed are answered 400, only a body over the limit is 413
+def test_bad_requests():
+    async def handler(request):
+        return 200, b'ok', 'text/plain'
+
+    async def run():
+        server = HttpServer({'/': handler}, '127.0.0.1', 0)
+        await server.start()
+        try:
+            return [await _request(server.port, raw) for raw in (
+                b'GET / HTTP/1.1\r\n\r\n',
+                b'GET /\r\n\r\n',
+                b'POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n',
+                f'POST / HTTP/1.1\r\nContent-Length: {MAX_BODY + 1}\r\n\r\n'.encode(),
+            )]
+        finally:
+            await server.close()
+
+    assert asyncio.run(run()) == [200, 400, 400, 413]
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import bot.google_sheet as gs
+import bot.journal as journal
+from bot.fake_sheets import FakeSheetsService
+
+# An entry and the Tracker mirror written with it
+def _entry(tab, row, text):
+    return [{'range': f'{tab}!H{row}:I{row}', 'values': [[text, 'Food']]}, gs.trackers_data([20261018, row, 4, 5])]
+
+# An entry the API refuses is kept as a dead letter and its user told, the entries around it are written
+def test_refused_entry_does_not_hold_back_the_sheet():
+    sheet_id = 'journal-sheet'
+    service = FakeSheetsService()
+    service.create_spreadsheet(sheet_id, ['October', 'Tracker'])
+    gs.set_sheets_api(service)
+    notified = []
+
+    async def notify(chat_id, error):
+        notified.append(chat_id)
+
+    async def flush():
+        await journal.record(sheet_id, _entry('October', 5, 'first'), chat_id=1)
+        await journal.record(sheet_id, _entry('Deleted', 5, 'refused'), chat_id=2)
+        await journal.record(sheet_id, _entry('October', 6, 'third'), chat_id=3)
+        journal._notify = notify
+        try:
+            await journal.flush_pending()
+        finally:
+            journal._notify = None
+
+    asyncio.run(flush())
+
+    assert service.get_values(sheet_id, 'October!H5:H6') == [['first'], ['third']]
+    assert not journal.has_pending(sheet_id)
+    assert [entry[2] for entry in journal.dead_letters(sheet_id)] == [2]
+    assert notified == [2]
+
+    # once the tab is back the dead letter is written again, without moving the Tracker mirror back
+    service.apply_request(sheet_id, {'duplicateSheet': {'sourceSheetId': 0, 'newSheetName': 'Deleted'}})
+    assert journal.requeue_dead(sheet_id) == 1
+    asyncio.run(journal.flush_pending())
+    assert service.get_values(sheet_id, 'Deleted!H5') == [['refused']]
+    assert not journal.dead_letters(sheet_id)
+    assert service.get_values(sheet_id, gs.tracker_range) == [['20261018', '6', '4', '5']]
+
+# Entries left in the journal of a worker that no longer runs are moved to worker-0's, once
+def test_orphan_journals_are_adopted(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'JOURNAL_DB', str(tmp_path / 'journal.db'))
+    for name in ('worker-1', 'worker-3'):
+        conn = journal._open(journal.worker_path(name))
+        conn.execute("INSERT INTO journal(idempotency_key, sheet_id, data, created_at) VALUES (?, 'sheet', ?, 0);",
+                     (name, json.dumps(_entry('October', 5, name))))
+        conn.close()
+    assert journal.adopt_orphans(2) == 1
+    assert journal.adopt_orphans(2) == 0
+    conn = journal._open(journal.worker_path('worker-0'))
+    rows = conn.execute("SELECT idempotency_key, data FROM journal;").fetchall()
+    conn.close()
+    # the Tracker mirror of an adopted entry is not written, it may be older than the sheet's
+    assert [(key, json.loads(data)) for key, data in rows] == [('worker-3', _entry('October', 5, 'worker-3')[:1])]
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+import bot.keyboards as kb
+from bot.persistence import SQLitePersistence
+
+# Buttons of a keyboard sent before a restart still resolve, the option lists are in the persistence database
+def test_keyboard_survives_restart():
+    path = os.path.join(tempfile.mkdtemp(), 'persistence.db')
+
+    async def send():
+        kb.store = SQLitePersistence(path)
+        markup = kb.markup([f'Option {index}' for index in range(12)], [' << Back'])
+        await kb.store.flush()
+        return markup.inline_keyboard[2][0].callback_data, markup.inline_keyboard[-2][-1].callback_data
+
+    async def restart(option, page):
+        kb.option_lists.clear()
+        kb.markup_cache.clear()
+        kb.store = SQLitePersistence(path)
+        try:
+            await kb.restore(option)
+            await kb.restore(page)
+            return kb.resolve(option), kb.page_markup(*kb.resolve(page)[1])
+        finally:
+            await kb.store.flush()
+            kb.store = None
+
+    choice, markup = asyncio.run(restart(*asyncio.run(send())))
+    assert choice == ('option', 'Option 2')
+    assert markup.inline_keyboard[0][0].text == 'Option 8'
+
+# A list in constant use is saved again once the hour is up, the store drops lists unsaved for a day
+def test_keyboard_in_use_is_saved_again():
+    saved = []
+    kb.store = SimpleNamespace(save_keyboard=lambda key, options, footer: saved.append(key))
+    try:
+        kb.saved_lists.clear()
+        kb.markup(['Yes', 'No'])
+        kb.markup(['Yes', 'No'])
+        assert len(saved) == 1
+        kb.saved_lists.clear()
+        kb.markup(['Yes', 'No'])
+        assert len(saved) == 2
+    finally:
+        kb.store = None
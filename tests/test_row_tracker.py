@@ -0,0 +1,40 @@
+import datetime as dt
+import bot.google_sheet as gs
+import bot.row_tracker as rt
+import bot.storage as db
+from bot.common import EntryType
+from bot.fake_sheets import FakeSheetsService
+
+ROW = [EntryType.OTHERS, '5', 'lunch', 'Food', 'Cash']
+
+# A sheet left idle across a month boundary closes its day in the old month and starts at the top of the new one
+def test_idle_sheet_starts_new_month_at_the_top():
+    trackers = [20260906, 40, 40, 41]
+    data, new_trackers = gs.plan_transaction(trackers, dt.datetime(2026, 10, 20, 9), ROW)
+    ranges = [item['range'] for item in data]
+    assert ranges[:3] == ['September!B41', 'October!A6', 'October!H6:K6']
+    assert new_trackers == [20261020, 6, 5, 6]
+
+# Trackers holding only a day of the month keep working, a day ahead of today is last month's
+def test_day_of_month_trackers():
+    october = dt.datetime(2026, 10, 20, 9)
+    assert gs.tracker_date(20, october) == dt.date(2026, 10, 20)
+    assert gs.tracker_date(31, october) == dt.date(2026, 9, 30)
+    data, new_trackers = gs.plan_transaction([25, 40, 40, 41], october, ROW)
+    assert [item['range'] for item in data[:2]] == ['September!B41', 'October!A6']
+    _, same_day = gs.plan_transaction([20, 40, 40, 41], october, ROW)
+    assert same_day == [20, 41, 40, 41]
+
+# /refresh never moves the store's trackers back to a stale Tracker tab, unless forced
+def test_reconcile_only_moves_forward():
+    sheet_id = 'reconcile-sheet'
+    service = FakeSheetsService()
+    service.create_spreadsheet(sheet_id, ['Tracker'])
+    gs.set_sheets_api(service)
+    db.set_trackers(sheet_id, [20261018, 6, 4, 5])
+    service.set_values(sheet_id, gs.tracker_range, [[20261018, 5, 4, 5]])
+    assert rt.reconcile_trackers(sheet_id) == ([20261018, 6, 4, 5], False)
+    service.set_values(sheet_id, gs.tracker_range, [[20261019, 7, 7, 8]])
+    assert rt.reconcile_trackers(sheet_id) == ([20261019, 7, 7, 8], True)
+    service.set_values(sheet_id, gs.tracker_range, [[20261019, 5, 7, 8]])
+    assert rt.reconcile_trackers(sheet_id, force=True) == ([20261019, 5, 7, 8], True)
@@ -0,0 +1,65 @@
+import threading
+import time
+import pytest
+from googleapiclient.errors import HttpError
+import bot.sheets_quota as sheets_quota
+from bot.fake_sheets import FakeSheetsService
+
+def _read(service):
+    return service.spreadsheets().values().get(spreadsheetId='quota-sheet', range='October!A1').execute()
+
+def _stats():
+    return dict(sheets_quota.stats)
+
+def _delta(before, name):
+    return sheets_quota.stats[name] - before.get(name, 0)
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(sheets_quota, 'BASE_BACKOFF', 0.001)
+    service = FakeSheetsService()
+    service.create_spreadsheet('quota-sheet', ['October'])
+    return service
+
+# 429 and 5xx answers are retried and counted, requests over quota wait for a token and are counted
+def test_retries_and_throttling(service, monkeypatch):
+    before = _stats()
+    service.fail_next(1, 429)
+    service.fail_next(1, 503)
+    _read(service)
+    assert _delta(before, 'read_retried') == 2
+    assert _delta(before, 'read_failed') == 0
+
+    # one token and 100 a second, the second request waits for its token
+    monkeypatch.setitem(sheets_quota.buckets, sheets_quota.READ, sheets_quota.TokenBucket(6000, burst_seconds=0))
+    before = _stats()
+    _read(service)
+    _read(service)
+    assert _delta(before, 'read_throttled') == 1
+
+# No retry is started past the deadline, the error is raised at once
+def test_no_retry_past_deadline(service):
+    before = _stats()
+    service.fail_next(1, 503)
+    token = sheets_quota.deadline.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(HttpError):
+            _read(service)
+    finally:
+        sheets_quota.deadline.reset(token)
+    assert _delta(before, 'read_retried') == 0
+    assert _delta(before, 'read_failed') == 1
+
+# A background request waiting for a token lets an interactive one arriving later go first
+def test_interactive_before_background():
+    bucket = sheets_quota.TokenBucket(1200, burst_seconds=0)
+    bucket.acquire()
+    served = []
+    background = threading.Thread(target=lambda: served.append(bucket.acquire(sheets_quota.BACKGROUND) and 'background'))
+    interactive = threading.Thread(target=lambda: served.append(bucket.acquire(sheets_quota.INTERACTIVE) and 'interactive'))
+    background.start()
+    time.sleep(0.01)
+    interactive.start()
+    background.join()
+    interactive.join()
+    assert served == ['interactive', 'background']